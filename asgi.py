@@ -0,0 +1,11 @@
+
+# Import the Quart application instance named 'app'
+# from the async application file 'final_async.py'
+from final_async import app
+
+if __name__ == "__main__":
+    # Development only. In production run an ASGI server against the 'app' object, e.g.:
+    #   uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 2
+    #   gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+    # A single worker process can then hold many in-flight LLM calls at once.
+    app.run()
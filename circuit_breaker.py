@@ -0,0 +1,98 @@
+import json
+import os
+import threading
+import time
+
+# --- Configuration ---
+CIRCUIT_BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "1") == "1"
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))  # Consecutive failures (or slow calls) that open a circuit
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))  # How long an open circuit fails fast before letting a probe through
+# Per-upstream settings; "azure-openai" applies to every "azure-openai:<deployment>" breaker. Override with
+# e.g. CIRCUIT_BREAKER_SETTINGS='{"clinicaltrials.gov": {"slow_call_seconds": 5, "reset_seconds": 60}}'
+BREAKER_SETTINGS = {
+    "clinicaltrials.gov": {"slow_call_seconds": 8},
+    "api.fda.gov": {"slow_call_seconds": 8},
+    "azure-openai": {"slow_call_seconds": 0},  # Completions are slow by nature; only errors count
+}
+for _name, _settings in json.loads(os.getenv("CIRCUIT_BREAKER_SETTINGS", "{}")).items(): BREAKER_SETTINGS.setdefault(_name, {}).update(_settings)
+
+
+class CircuitOpenError(Exception):
+    """A call was refused without reaching the upstream because its circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Fails calls to an unhealthy upstream fast instead of letting every request wait out its
+    timeouts. After failure_threshold consecutive failures (errors, or calls slower than
+    slow_call_seconds) the circuit opens; after reset_seconds one probe call is let through,
+    and its outcome closes the circuit again or re-opens it.
+    """
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS, slow_call_seconds=0, enabled=CIRCUIT_BREAKER_ENABLED):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self.enabled = enabled
+        self.failures = 0
+        self.opened_at = None  # None = closed
+        self.probe_started = None  # half-open: when the current probe was let through
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None: return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def available(self):
+        """Whether a call would be let through now (does not take the half-open probe slot)."""
+        return not self.enabled or self.state == "closed" or (self.state == "half_open" and not self._probe_running())
+
+    def _probe_running(self):
+        # A probe that never reported back (caller went away) stops blocking after reset_seconds.
+        return self.probe_started is not None and time.monotonic() - self.probe_started < self.reset_seconds
+
+    def allow(self):
+        """True when the call may go ahead; in the half-open state only one probe at a time gets through."""
+        if not self.enabled: return True
+        with self._lock:
+            state = self.state
+            if state == "closed": return True
+            if state == "half_open" and not self._probe_running(): self.probe_started = time.monotonic(); return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok, seconds=0.0):
+        """Reports one call's outcome; a call slower than slow_call_seconds counts as a failure."""
+        if not self.enabled: return
+        if ok and self.slow_call_seconds and seconds > self.slow_call_seconds: ok = False
+        with self._lock:
+            self.probe_started = None
+            if ok:
+                if self.opened_at is not None: print(f"Circuit {self.name} closed")
+                self.failures = 0; self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None: print(f"Circuit {self.name} opened after {self.failures} failures; failing fast for {self.reset_seconds:.0f}s")
+                self.opened_at = time.monotonic()
+
+    def check(self):
+        """Raises CircuitOpenError unless allow()."""
+        if not self.allow(): raise CircuitOpenError(f"{self.name} is unavailable (circuit open); retry in {self.reset_seconds:.0f}s")
+
+
+_breakers = {}
+_lock = threading.Lock()
+
+
+def circuit_breaker(name):
+    """The process-wide breaker for an upstream ("clinicaltrials.gov", "azure-openai:<deployment>", ...)."""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.get(name)
+            if breaker is None: breaker = _breakers[name] = CircuitBreaker(name, **BREAKER_SETTINGS.get(name, BREAKER_SETTINGS.get(name.split(":")[0], {})))
+    return breaker
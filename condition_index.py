@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+from trial_mirror import TRIAL_MIRROR_DB_PATH, TrialMirror
+from trial_projection import parse_projected_study
+
+# --- Configuration ---
+# SQLite FTS5 index over condition names, MeSH terms and brief titles. Unset = remote search only.
+CONDITION_INDEX_DB_PATH = os.getenv("CONDITION_INDEX_DB_PATH")
+SUGGESTION_COUNT = int(os.getenv("SUGGESTION_COUNT", "3"))
+# BM25 column weights: nct_id (unindexed), brief_title, conditions, mesh_terms
+BM25_WEIGHTS = (0.0, 1.0, 4.0, 2.0)
+# Only these members are decoded while building; results and documents are skipped.
+INDEX_SPEC = {"protocolSection": {"identificationModule": None, "conditionsModule": None}, "derivedSection": {"conditionBrowseModule": None}}
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _match_expression(text, prefix=False):
+    """FTS5 query from free text: each word quoted (no operator injection), OR-ed so BM25 ranks by coverage."""
+    words = _WORD_RE.findall(text.lower())
+    if not words: return None
+    if prefix: return " ".join(f'"{w}"*' for w in words) # every word must prefix-match for type-ahead
+    return " OR ".join(f'"{w}"' for w in words)
+
+
+def _index_fields(study):
+    protocol = study.get("protocolSection", {})
+    conditions = protocol.get("conditionsModule", {}).get("conditions", []) or []
+    browse = study.get("derivedSection", {}).get("conditionBrowseModule", {})
+    mesh_terms = [m.get("term") for m in browse.get("meshes", []) or [] if m.get("term")]
+    return protocol.get("identificationModule", {}).get("briefTitle", "") or "", conditions, mesh_terms
+
+
+class ConditionIndex:
+    """Local ranked search for indication -> NCT ID suggestions and condition type-ahead."""
+
+    def __init__(self, db_path=CONDITION_INDEX_DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return bool(self.db_path) and os.path.exists(self.db_path)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS trials_fts USING fts5(nct_id UNINDEXED, brief_title, conditions, mesh_terms, tokenize='porter unicode61')")
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS condition_names_fts USING fts5(name, trial_count UNINDEXED, tokenize='unicode61')")
+            self._local.conn = conn
+        return conn
+
+    def suggest(self, indication, limit=SUGGESTION_COUNT):
+        """Ranked [{"nct_id", "title"}] for an indication; same shape as the live suggestion search."""
+        expression = _match_expression(indication or "")
+        if not expression or not self.enabled: return []
+        try:
+            rows = self._connection().execute(
+                f"SELECT nct_id, brief_title FROM trials_fts WHERE trials_fts MATCH ? ORDER BY bm25(trials_fts, {', '.join(map(str, BM25_WEIGHTS))}) LIMIT ?",
+                (expression, limit)).fetchall()
+        except sqlite3.Error as e: print(f"Condition index suggest error '{indication}': {e}"); return []
+        return [{"nct_id": nct_id, "title": title or "N/A"} for nct_id, title in rows]
+
+    def typeahead(self, prefix, limit=10):
+        """Condition names whose words start with the typed words, most studied first."""
+        expression = _match_expression(prefix or "", prefix=True)
+        if not expression or not self.enabled: return []
+        try:
+            rows = self._connection().execute(
+                "SELECT name, trial_count FROM condition_names_fts WHERE condition_names_fts MATCH ? ORDER BY CAST(trial_count AS INTEGER) DESC, length(name) LIMIT ?",
+                (expression, limit)).fetchall()
+        except sqlite3.Error as e: print(f"Condition index typeahead error '{prefix}': {e}"); return []
+        return [{"condition": name, "trial_count": int(count)} for name, count in rows]
+
+    def build_from_mirror(self, mirror, progress_every=50000):
+        """(Re)builds both FTS tables from every study in a TrialMirror. Returns a stats dict."""
+        conn = self._connection(); start_time = time.time()
+        condition_counts = {}; pending = []; indexed = 0; errors = 0
+        with conn:
+            conn.execute("DELETE FROM trials_fts"); conn.execute("DELETE FROM condition_names_fts")
+            for nct_id, body in mirror._connection().execute("SELECT nct_id, body FROM studies"):
+                try: brief_title, conditions, mesh_terms = _index_fields(parse_projected_study(zlib.decompress(body).decode("utf-8"), INDEX_SPEC))
+                except (zlib.error, ValueError, IndexError) as e: print(f"Condition index: skipping unreadable {nct_id}: {e}"); errors += 1; continue
+                pending.append((nct_id, brief_title, " ; ".join(conditions), " ; ".join(mesh_terms)))
+                for name in set(conditions) | set(mesh_terms): condition_counts[name] = condition_counts.get(name, 0) + 1
+                indexed += 1
+                if len(pending) >= 1000: conn.executemany("INSERT INTO trials_fts VALUES (?, ?, ?, ?)", pending); pending.clear()
+                if progress_every and indexed % progress_every == 0: print(f"Condition index: {indexed} studies ({time.time() - start_time:.0f}s)")
+            if pending: conn.executemany("INSERT INTO trials_fts VALUES (?, ?, ?, ?)", pending)
+            conn.executemany("INSERT INTO condition_names_fts VALUES (?, ?)", condition_counts.items())
+            conn.execute("INSERT INTO trials_fts(trials_fts) VALUES ('optimize')")
+        return {"studies": indexed, "conditions": len(condition_counts), "errors": errors, "duration_seconds": round(time.time() - start_time, 2)}
+
+
+condition_index = ConditionIndex()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local condition/indication search index.")
+    parser.add_argument("--db", default=CONDITION_INDEX_DB_PATH, help="Index SQLite path (default: $CONDITION_INDEX_DB_PATH)")
+    parser.add_argument("--mirror", default=TRIAL_MIRROR_DB_PATH, help="Trial mirror SQLite path (default: $TRIAL_MIRROR_DB_PATH)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="Rebuild the index from the trial mirror")
+    query_parser = subparsers.add_parser("query", help="Show suggestions for an indication")
+    query_parser.add_argument("text")
+    args = parser.parse_args()
+    if not args.db: parser.error("--db or CONDITION_INDEX_DB_PATH is required")
+
+    index = ConditionIndex(args.db)
+    if args.command == "build":
+        if not args.mirror: parser.error("--mirror or TRIAL_MIRROR_DB_PATH is required")
+        print(index.build_from_mirror(TrialMirror(args.mirror)))
+    else:
+        start_time = time.perf_counter()
+        print(json.dumps({"suggestions": index.suggest(args.text, 10), "typeahead": index.typeahead(args.text, 10)}, indent=2))
+        print(f"{(time.perf_counter() - start_time) * 1000:.1f} ms")
@@ -0,0 +1,97 @@
+import math
+import os
+import re
+
+# --- Configuration ---
+# Buckets below the senior cut-off (3-5 is what the insight prompt used to ask the model for).
+AGE_BUCKET_COUNT = int(os.getenv("AGE_BUCKET_COUNT", "4"))
+SENIOR_AGE = int(os.getenv("SENIOR_AGE", "65"))
+MIN_BUCKET_WIDTH_YEARS = 5
+
+_AGE_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*(year|month|week|day|hour|minute)s?\b", re.IGNORECASE)
+_UNIT_YEARS = {"year": 1.0, "month": 1 / 12, "week": 7 / 365.25, "day": 1 / 365.25, "hour": 1 / 8766, "minute": 1 / 525960}
+_GENDERS = {
+    "ALL": ("Both", "Males and females are eligible for this trial"),
+    "FEMALE": ("Female", "Only females are eligible for this trial"),
+    "MALE": ("Male", "Only males are eligible for this trial"),
+}
+
+
+def parse_age_years(value):
+    """ClinicalTrials.gov age ("18 Years", "6 Months", ...) in years; None when absent or unparseable."""
+    match = _AGE_RE.match(value) if isinstance(value, str) else None
+    return float(match.group(1)) * _UNIT_YEARS[match.group(2).lower()] if match else None
+
+
+def _format_years(years):
+    if years == int(years): return str(int(years))
+    if years < 1: return f"{round(years * 12)} months" if years * 12 >= 1 else f"{round(years * 52.18)} weeks"
+    return f"{years:.1f}"
+
+
+def _range_label(low, high):
+    return f"{low}-{high}" if high > low else f"{low}"
+
+
+def _age_phrase(years):
+    text = _format_years(years)
+    return text if text.endswith(("months", "weeks")) else f"{text} year" + ("" if years == 1 else "s")
+
+
+def age_criteria(min_years, max_years):
+    """Short label ("18+", "18-65", "Up to 17", "All ages") and description of the eligible age range."""
+    if min_years is None and max_years is None: return "All ages", "No age limits are specified for this trial"
+    if max_years is None: return f"{_format_years(min_years)}+", f"Includes patients aged {_age_phrase(min_years)} and above"
+    if min_years is None: return f"Up to {_format_years(max_years)}", f"Includes patients up to {_age_phrase(max_years)} of age"
+    return f"{_format_years(min_years)}-{_format_years(max_years)}", f"Includes patients aged {_age_phrase(min_years)} to {_age_phrase(max_years)}"
+
+
+def _split_range(low, high, count):
+    """count contiguous integer ranges covering [low, high], widths differing by at most one year."""
+    span = high - low + 1
+    count = max(1, min(count, span // MIN_BUCKET_WIDTH_YEARS or 1))
+    bounds = [low + span * i // count for i in range(count + 1)]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(count)]
+
+
+def age_buckets(min_years, max_years):
+    """
+    Age group labels spanning the eligible range: up to AGE_BUCKET_COUNT equal buckets below
+    SENIOR_AGE plus one senior bucket ("65+" or "65-80") when the range reaches it.
+    """
+    low = math.floor(min_years) if min_years is not None else 0
+    high = math.floor(max_years) if max_years is not None else None
+    if high is not None and high < low: high = low
+    if low >= SENIOR_AGE:
+        if high is None: return [f"{low}+"]
+        return [_range_label(a, b) for a, b in _split_range(low, high, AGE_BUCKET_COUNT)]
+    core_high = SENIOR_AGE - 1 if high is None or high >= SENIOR_AGE else high
+    labels = [_range_label(a, b) for a, b in _split_range(low, core_high, AGE_BUCKET_COUNT)]
+    if high is None: labels.append(f"{SENIOR_AGE}+")
+    elif high >= SENIOR_AGE: labels.append(_range_label(SENIOR_AGE, high))
+    return labels
+
+
+def extract_demographics(processed_data):
+    """
+    Rule-based age/sex fields for the insights JSON, from the Minimum_Age, Maximum_Age and
+    Sex values process_trial_data() copies out of eligibilityModule.
+    """
+    min_years = parse_age_years(processed_data.get('Minimum_Age')); max_years = parse_age_years(processed_data.get('Maximum_Age'))
+    criteria, criteria_description = age_criteria(min_years, max_years)
+    gender, gender_description = _GENDERS.get(str(processed_data.get('Sex') or '').upper(), ("Does not apply", "Sex eligibility is not specified for this trial"))
+    return {
+        "AgeCriteria": {"AgeCriteria": criteria, "AgeCriteriaDescription": criteria_description},
+        "Age": {f"AgeGroup{i}": {f"AgeGroup{i}": label} for i, label in enumerate(age_buckets(min_years, max_years), 1)},
+        "Gender": gender,
+        "GenderDescription": gender_description,
+    }
+
+
+def merge_demographics(insights, demographics):
+    """Puts the demographic fields at the front of AddressableMarketCriteriaByPatientAttribute, as the old prompt laid them out."""
+    if not isinstance(insights, dict) or "raw_llm_output" in insights: return insights
+    attributes = insights.get("AddressableMarketCriteriaByPatientAttribute")
+    if not isinstance(attributes, dict): attributes = {}
+    insights["AddressableMarketCriteriaByPatientAttribute"] = {**demographics, **{k: v for k, v in attributes.items() if k not in demographics}}
+    return insights
@@ -1,31 +1,37 @@
 import requests
+import http_client
 from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
-from langchain_openai import AzureChatOpenAI
 import re
 import os
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import json
 # import uuid # No longer needed for session IDs
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask_cors import CORS
+from condition_index import SUGGESTION_COUNT, condition_index
+from trial_cache import trial_cache
+from single_flight import trial_fetches
+from trial_mirror import trial_mirror
+from pipeline_state import pipeline_state
+from icd_index import icd10cm_index, without_code_descriptions
+from mesh_icd_index import mesh_icd_index
+from demographics import extract_demographics, merge_demographics
+from prompt_compaction import compact_criteria, count_tokens, minify_json, minify_json_with_stats
+from trial_projection import extract_trial_fields, parse_projected_study, study_url
+from streaming_json import IncrementalJSONParser
+from trial_record import TrialRecord
+from llm_clients import get_llm, run_chain, stream_chain, warm_up
+from llm_schemas import FETCH_SUMMARY_SCHEMA, INSIGHT_SCHEMA, INSIGHT_SUMMARY_SCHEMA, schema_report
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
 CORS(app)
 
-# --- Configuration ---
-AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "https://ciaiaiservices.openai.azure.com/")
-AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY", "817dce22f5a548b8b11fe0b6a3cf2c36") # Replace or set env var
-AZURE_DEPLOYMENT_NAME = os.getenv("AZURE_DEPLOYMENT_NAME", "gpt-35-turbo-0613")
-AZURE_API_VERSION = "2024-05-01-preview"
-
-# --- Check if Config is Set ---
-if AZURE_OPENAI_API_KEY == "YOUR_API_KEY_HERE":
-    print("Warning: AZURE_OPENAI_API_KEY is not set via environment variable. Using placeholder.")
-if not AZURE_OPENAI_ENDPOINT or not AZURE_DEPLOYMENT_NAME:
-     raise ValueError("Azure OpenAI Endpoint and Deployment Name must be configured.")
-
+@app.before_request
+def warm_llm_pool(): warm_up() # Once per worker, in a daemon thread; no-op afterwards
 
 # --- Re-paste Utility Functions for Clarity ---
 def is_valid_nct_format(nct_id):
@@ -34,15 +40,15 @@ def is_valid_nct_format(nct_id):
 
 def does_nct_id_exist(nct_id):
     if not is_valid_nct_format(nct_id): return False
-    url = f"https://clinicaltrials.gov/api/v2/studies/{nct_id.strip().upper()}"
-    try: response = requests.get(url, timeout=10); return response.status_code == 200
-    except requests.exceptions.RequestException as e: print(f"Exist check error {nct_id}: {e}"); return False
+    _, _, status_code = fetch_trial_record(nct_id.strip().upper())
+    return status_code in (200, TRIAL_STALE_STATUS)
 
 def suggest_nct_ids_by_indication(indication):
     if not indication or not isinstance(indication, str): return []
-    query = indication.strip().replace(" ", "+"); url = f"https://clinicaltrials.gov/api/v2/studies?query.cond={query}&pageSize=3"
+    if condition_index.enabled: return condition_index.suggest(indication, SUGGESTION_COUNT) # Local ranked search, no remote round trip
+    query = indication.strip().replace(" ", "+"); url = f"https://clinicaltrials.gov/api/v2/studies?query.cond={query}&pageSize={SUGGESTION_COUNT}"
     try:
-        response = requests.get(url, timeout=15); response.raise_for_status(); results = response.json().get("studies", []); suggestions = []
+        response = http_client.get(url, timeout=15); response.raise_for_status(); results = response.json().get("studies", []); suggestions = []
         for r in results:
             if r:
                 id_module = r.get("protocolSection", {}).get("identificationModule", {}); nct_id = id_module.get("nctId"); title = id_module.get("briefTitle", "N/A")
@@ -51,45 +57,132 @@ def suggest_nct_ids_by_indication(indication):
     except requests.exceptions.RequestException as e: print(f"Suggest error '{indication}': {e}"); return []
     except json.JSONDecodeError as e: print(f"Suggest JSON error '{indication}': {e}"); return []
 
-def get_clinical_trial_info(nct_id):
-    if not is_valid_nct_format(nct_id): return None, "Invalid NCT ID format."
-    nct_id_upper = nct_id.strip().upper(); base_url = "https://clinicaltrials.gov/api/v2/studies"
+# fetch_trial_record() status for an expired cached trial served while it refreshes in the background.
+TRIAL_STALE_STATUS = 203
+_trial_refresh_executor = ThreadPoolExecutor(max_workers=int(os.getenv("TRIAL_REFRESH_WORKERS", "4")), thread_name_prefix="trial-refresh")
+_refreshing_trials = set(); _refreshing_trials_lock = threading.Lock()
+
+def fetch_trial_record(nct_id_upper):
+    """
+    Single fetch of a trial as a TrialRecord, served from the trial cache or local mirror when possible.
+    Concurrent requests for the same trial share one fetch (single_flight.trial_fetches).
+    Returns (trial_record, error_msg, status_code); status_code is None on network errors, 503 while
+    ClinicalTrials.gov's circuit breaker is open and TRIAL_STALE_STATUS for a stale cached trial.
+    """
+    cached = cached_trial_result(nct_id_upper, allow_stale=True)
+    if cached is not None: return cached
+    return trial_fetches.do(nct_id_upper, lambda: fetch_trial_record_uncached(nct_id_upper), recheck=lambda: cached_trial_result(nct_id_upper))
+
+def cached_trial_result(nct_id_upper, allow_stale=False):
+    """
+    fetch_trial_record() result from the trial cache, or None on a miss. With allow_stale an expired
+    entry (within TRIAL_CACHE_STALE_SECONDS) is returned with TRIAL_STALE_STATUS and refreshed in the background.
+    """
+    cached, stale = trial_cache.get_or_stale(nct_id_upper)
+    if cached is None or (stale and not allow_stale): return None
+    if stale: refresh_trial_in_background(nct_id_upper); return cached, None, TRIAL_STALE_STATUS
+    return cached, None, 200
+
+def refresh_trial_in_background(nct_id_upper):
+    """Re-fetches a stale cached trial off the request path; if the refresh fails the stale copy keeps being served."""
+    with _refreshing_trials_lock:
+        if nct_id_upper in _refreshing_trials: return
+        _refreshing_trials.add(nct_id_upper)
+    def refresh():
+        try:
+            _, error_msg, _ = trial_fetches.do(nct_id_upper, lambda: fetch_trial_record_uncached(nct_id_upper), recheck=lambda: cached_trial_result(nct_id_upper))
+            if error_msg: print(f"Background refresh of {nct_id_upper} failed, still serving stale copy: {error_msg}")
+        finally:
+            with _refreshing_trials_lock: _refreshing_trials.discard(nct_id_upper)
+    _trial_refresh_executor.submit(refresh)
+
+def fetch_trial_record_uncached(nct_id_upper):
+    trial_json, error_msg, status_code = fetch_trial_document(nct_id_upper)
+    if trial_json is None: return None, error_msg, status_code
+    return cache_trial_record(nct_id_upper, trial_json), None, status_code
+
+def fetch_trial_document(nct_id_upper):
+    """(study JSON, error_msg, status_code) from the local mirror or, on a miss, the live API; not cached."""
+    mirrored = trial_mirror.get(nct_id_upper) # Local bulk mirror first; live API only on a miss
+    if mirrored is not None: return mirrored, None, 200
+    base_url = "https://clinicaltrials.gov/api/v2/studies"
     try:
-        response = requests.get(f"{base_url}/{nct_id_upper}", timeout=20)
+        response = http_client.get(study_url(base_url, nct_id_upper))
         if response.status_code == 200:
-            if not response.content: return None, f"{nct_id_upper} empty content."
-            try: return response.json(), None
-            except json.JSONDecodeError: return None, f"{nct_id_upper} invalid JSON."
-        elif response.status_code == 404: return None, f"{nct_id_upper} not found."
-        else: error_detail = response.text[:500]; return None, f"Fetch fail {response.status_code}. Detail: {error_detail}"
-    except requests.exceptions.Timeout: return None, f"Timeout fetching {nct_id_upper}."
-    except requests.exceptions.RequestException as e: print(f"Fetch error {nct_id_upper}: {e}"); return None, f"Network error: {e}"
+            if not response.content: return None, f"{nct_id_upper} empty content.", 200
+            # Only the modules process_trial_data() reads are decoded, whatever the fetch mode.
+            try: return parse_projected_study(response.text), None, 200
+            except (ValueError, IndexError): return None, f"{nct_id_upper} invalid JSON.", 200
+        elif response.status_code == 404: return None, f"{nct_id_upper} not found.", 404
+        else: error_detail = response.text[:500]; return None, f"Fetch fail {response.status_code}. Detail: {error_detail}", response.status_code
+    except http_client.HostCircuitOpen as e: return None, f"{e}; try again shortly.", 503
+    except requests.exceptions.Timeout: return None, f"Timeout fetching {nct_id_upper}.", None
+    except requests.exceptions.RequestException as e: print(f"Fetch error {nct_id_upper}: {e}"); return None, f"Network error: {e}", None
+
+def cache_trial_record(nct_id_upper, trial_json):
+    """Processes a study document into a TrialRecord, caching it when it has an NCT ID."""
+    trial_record = TrialRecord.from_processed(process_trial_data(trial_json))
+    if trial_record.nct_id: trial_cache.set(nct_id_upper, trial_record)
+    return trial_record
+
+def get_trial_record(nct_id):
+    """(TrialRecord, error_msg) for one trial, served from the trial cache when possible."""
+    if not is_valid_nct_format(nct_id): return None, "Invalid NCT ID format."
+    trial_record, error_msg, _ = fetch_trial_record(nct_id.strip().upper())
+    return trial_record, error_msg
+
+def get_clinical_trial_info(nct_id):
+    """
+    (study JSON, error_msg), the original contract, for callers that run process_trial_data() themselves.
+    The trial cache holds TrialRecords, not documents, so this always fetches; prefer get_trial_record().
+    """
+    if not is_valid_nct_format(nct_id): return None, "Invalid NCT ID format."
+    nct_id_upper = nct_id.strip().upper()
+    trial_json, error_msg, _ = fetch_trial_document(nct_id_upper)
+    if trial_json is not None: cache_trial_record(nct_id_upper, trial_json)
+    return trial_json, error_msg
 
 def process_trial_data(json_data):
-    extracted_info = {'NCT_ID': None, 'Brief_Title': None, 'Official_Title': None, 'Status': None, 'Conditions': None, 'Interventions': None, 'Intervention_Types': None, 'Minimum_Age': None, 'Maximum_Age': None, 'Sex': None, 'Inclusion_Criteria': None, 'Exclusion_Criteria': None, 'Drugs': None, 'Phase': None, 'Study_Type': None}
+    extracted_info = {'NCT_ID': None, 'Brief_Title': None, 'Official_Title': None, 'Status': None, 'Conditions': None, 'Interventions': None, 'Intervention_Types': None, 'Minimum_Age': None, 'Maximum_Age': None, 'Sex': None, 'Inclusion_Criteria': None, 'Exclusion_Criteria': None, 'Drugs': None, 'Phase': None, 'Study_Type': None, 'MeSH_Terms': [], 'MeSH_Ancestors': []}
     if not json_data or not isinstance(json_data, dict): print("Warning: process_trial_data invalid input."); return extracted_info
-    try:
-        protocol = json_data.get('protocolSection', {});
-        if not isinstance(protocol, dict): print(f"Warning: 'protocolSection' missing/invalid."); return extracted_info
-        id_mod = protocol.get("identificationModule", {}); status_mod = protocol.get("statusModule", {}); cond_mod = protocol.get("conditionsModule", {}); arms_mod = protocol.get("armsInterventionsModule", {}); elig_mod = protocol.get("eligibilityModule", {}); design_mod = protocol.get("designModule", {})
-        extracted_info['NCT_ID'] = id_mod.get("nctId"); extracted_info['Brief_Title'] = id_mod.get("briefTitle"); extracted_info['Official_Title'] = id_mod.get("officialTitle"); extracted_info['Status'] = status_mod.get("overallStatus")
-        conditions_list = cond_mod.get("conditions", []); extracted_info['Conditions'] = ', '.join(conditions_list) if conditions_list else "Not specified"
-        interventions_list = arms_mod.get("interventions", [])
-        if interventions_list: extracted_info['Interventions'] = '; '.join(f"{i.get('type', 'N/A')}: {i.get('name', 'N/A')}" for i in interventions_list if i); extracted_info['Intervention_Types'] = list(set(i.get('type') for i in interventions_list if i and i.get('type'))); extracted_info['Drugs'] = ', '.join(i.get('name') for i in interventions_list if i and i.get('type', '').upper() == 'DRUG' and i.get('name')) or "No specific drugs listed"
-        else: extracted_info['Interventions'] = "Not specified"; extracted_info['Intervention_Types'] = []; extracted_info['Drugs'] = "Not specified"
-        extracted_info['Minimum_Age'] = elig_mod.get("minimumAge", "Not specified"); extracted_info['Maximum_Age'] = elig_mod.get("maximumAge", "No maximum age specified"); extracted_info['Sex'] = elig_mod.get("sex", "Not specified"); eligibility_criteria = elig_mod.get("eligibilityCriteria", "")
-        if isinstance(eligibility_criteria, str) and 'Exclusion Criteria:' in eligibility_criteria: parts = eligibility_criteria.split('Exclusion Criteria:', 1); extracted_info['Inclusion_Criteria'] = parts[0].replace('Inclusion Criteria:', '').strip(); extracted_info['Exclusion_Criteria'] = parts[1].strip()
-        elif isinstance(eligibility_criteria, str): extracted_info['Inclusion_Criteria'] = eligibility_criteria.replace('Inclusion Criteria:', '').strip(); extracted_info['Exclusion_Criteria'] = "Not specified"
-        else: extracted_info['Inclusion_Criteria'] = "Not provided"; extracted_info['Exclusion_Criteria'] = "Not provided"
-        if not extracted_info['Inclusion_Criteria']: extracted_info['Inclusion_Criteria'] = "Not provided";
-        if not extracted_info['Exclusion_Criteria']: extracted_info['Exclusion_Criteria'] = "Not provided"
-        phases_list = design_mod.get("phases", []); extracted_info['Phase'] = ', '.join(phases_list) if phases_list else "Not Applicable/Not Specified"; extracted_info['Study_Type'] = design_mod.get("studyType", "Not specified")
-    except Exception as e: print(f"Error processing trial data for {extracted_info.get('NCT_ID', 'Unknown')}: {e}")
-    return extracted_info
+    protocol = json_data.get('protocolSection', {});
+    if not isinstance(protocol, dict): print(f"Warning: 'protocolSection' missing/invalid."); return extracted_info
+    derived = json_data.get('derivedSection')
+    return extract_trial_fields(protocol, derived if isinstance(derived, dict) else None)
+
+def load_processed_trial(nct_id):
+    """
+    Validates, fetches (once, via the trial cache) and processes a single trial.
+    Returns (trial_record, error_msg, http_status); http_status is 200 on success, TRIAL_STALE_STATUS
+    when a stale cached copy was served (responses flag it as "trial_data_stale").
+    """
+    if not is_valid_nct_format(nct_id): return None, f"Invalid NCT ID format: '{nct_id}'.", 400
+    # One upstream fetch (or cache hit) doubles as the existence check.
+    trial_record, error_msg, fetch_status = fetch_trial_record(nct_id)
+    if fetch_status == 404: return None, f"NCT ID '{nct_id}' not found.", 404
+    if error_msg: return None, f"Fetch error for {nct_id}: {error_msg}", 503 if fetch_status == 503 else 500
+    if not trial_record: return None, f"No data returned for {nct_id}.", 500
+    if not trial_record.nct_id: return None, f"Failed to process critical data for {nct_id}.", 500
+    return trial_record, None, TRIAL_STALE_STATUS if fetch_status == TRIAL_STALE_STATUS else 200
+
+# Opt-in: start the indication search alongside the trial fetch so error responses need one round trip, not three
+# (costs a clinicaltrials.gov search on every uncached fetch, including the ones that succeed).
+SPECULATIVE_SUGGESTIONS = os.getenv("SPECULATIVE_SUGGESTIONS", "0") == "1"
+_suggestion_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SPECULATIVE_SUGGESTION_WORKERS", "8")), thread_name_prefix="speculative-suggest")
+
+def start_speculative_suggestions(nct_id, indication):
+    """
+    Returns a Future for suggest_nct_ids_by_indication(indication), or None when speculation
+    would not save a round trip (mode off, local condition index, malformed ID, or the trial is
+    already cached or mirrored).
+    """
+    if not SPECULATIVE_SUGGESTIONS or condition_index.enabled or not is_valid_nct_format(nct_id): return None
+    if trial_cache.get_or_stale(nct_id)[0] is not None or trial_mirror.contains(nct_id): return None
+    return _suggestion_executor.submit(suggest_nct_ids_by_indication, indication)
 
 def initialize_llm(temperature=0.0):
-    try: llm = AzureChatOpenAI(api_key=AZURE_OPENAI_API_KEY, api_version=AZURE_API_VERSION, azure_endpoint=AZURE_OPENAI_ENDPOINT, deployment_name=AZURE_DEPLOYMENT_NAME, temperature=temperature, max_retries=3, request_timeout=60); return llm
-    except Exception as e: print(f"Error initializing LLM: {e}"); raise
+    # Kept for callers that expect a client per call; returns the shared, pre-built client.
+    return get_llm(temperature=temperature)
 
 # # --- Endpoint 1: Returns Summary + All Data Needed for Endpoint 2 ---
 # @app.route('/fetch_and_summarize', methods=['POST'])
@@ -182,40 +275,7 @@ def initialize_llm(temperature=0.0):
 #     }), 200
 
 
-@app.route('/fetch_and_summarize', methods=['POST'])
-def fetch_and_summarize_trial_for_client_state():
-    
-    start_time = time.time()
-    if not request.is_json:
-        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
-
-    original_input_data = request.get_json()
-    nct_id = original_input_data.get('nct_id')
-    indication = original_input_data.get('indication')
-
-    if not nct_id: return jsonify({"status": "error", "message": "Missing 'nct_id'"}), 400
-    if not indication: return jsonify({"status": "error", "message": "Missing 'indication'"}), 400
-
-    nct_id = nct_id.strip().upper()
-
-    if not is_valid_nct_format(nct_id):
-        suggestions = suggest_nct_ids_by_indication(indication)
-        return jsonify({"status": "error", "message": f"Invalid NCT ID format: '{nct_id}'.", "suggestions": suggestions}), 400
-    if not does_nct_id_exist(nct_id):
-        suggestions = suggest_nct_ids_by_indication(indication)
-        return jsonify({"status": "error", "message": f"NCT ID '{nct_id}' not found.", "suggestions": suggestions}), 404
-
-    trial_json, error_msg = get_clinical_trial_info(nct_id)
-    if error_msg:
-        suggestions = suggest_nct_ids_by_indication(indication)
-        return jsonify({"status": "error", "message": f"Fetch error for {nct_id}: {error_msg}", "suggestions": suggestions}), 500
-    if not trial_json: return jsonify({"status": "error", "message": f"No data returned for {nct_id}."}), 500
-
-    processed_data = process_trial_data(trial_json)
-    if not processed_data.get('NCT_ID'): return jsonify({"status": "error", "message": f"Failed to process critical data for {nct_id}."}), 500
-
-    # --- Generate Summary ---
-    prompt_trial_template = """You are a clinical data summarization expert. Given the structured JSON input below describing a clinical market definition, generate a summary in a **valid JSON format only**.
+FETCH_SUMMARY_PROMPT_TEMPLATE_TEXT = """You are a clinical data summarization expert. Given the structured JSON input below describing a clinical market definition, generate a summary in a **valid JSON format only**.
 
 Your summary must:
 - Clearly describe the **Broad Market Definition**, including all ICD codes.
@@ -236,9 +296,9 @@ Your summary must:
 
 📘 **Example Output Format to Follow Exactly:**
 ```json
-{
-  "MarketDefinitionSummary": {
-    "BroadMarketDefinition": {
+{{
+  "MarketDefinitionSummary": {{
+    "BroadMarketDefinition": {{
       "Description": "All ICD codes related to malignant neoplasm of breast are included to define the broader population.",
       "ICDCodes": [
         "C50.9", "C50.011", "C50.012", "C50.111", "C50.112",
@@ -246,16 +306,16 @@ Your summary must:
         "C50.412", "C50.511", "C50.512", "C50.611", "C50.612",
         "C50.811", "C50.812", "C50.911", "C50.912"
       ]
-    },
-    "AddressableMarketDefinition": {
+    }},
+    "AddressableMarketDefinition": {{
       "Description": "Women aged 18 to 85 years with non-metastatic invasive breast carcinoma or carcinoma in situ treated via breast-conserving surgery."
-    },
-    "PatientAttributes": {
+    }},
+    "PatientAttributes": {{
       "AgeRange": "18–85",
       "SubGroups": ["18–40", "41–60", "61–85"],
       "Gender": "Female",
       "ASAClassICDCodes": ["Z02.5", "Z02.6", "Z02.7"]
-    },
+    }},
     "ExclusionICDCodes": [
       "Z85.3", "Z85.4",
       "C50.9", "C79.81",
@@ -266,107 +326,112 @@ Your summary must:
       "Z59.0",
       "Z00.6"
     ]
-  }
-}
+  }}
+}}
+```
+
+Structured JSON input:
+```json
+{trial_data_for_summary}
+```
 """
+FETCH_SUMMARY_PROMPT_VERSION = "fetch-summary-v1" # Bump when the template changes so cached responses are not reused
+FETCH_SUMMARY_MAX_TOKENS = int(os.getenv("FETCH_SUMMARY_MAX_TOKENS", "1500"))
+FETCH_SUMMARY_OUTPUT = {"output_schema": FETCH_SUMMARY_SCHEMA, "max_tokens": FETCH_SUMMARY_MAX_TOKENS} # run_chain() structured-output options
+fetch_summary_prompt = PromptTemplate.from_template(FETCH_SUMMARY_PROMPT_TEMPLATE_TEXT) # input_variables: ['trial_data_for_summary']
+fetch_summary_chain = LLMChain(llm=get_llm(temperature=0.1), prompt=fetch_summary_prompt)
+
+
+def build_trial_data_for_summary(processed_data):
+    """
+    Curated, minified JSON string of processed_data (criteria compacted) for the market-definition
+    summary prompt. Returns (json_string, compaction_stats); token counts compare with the old indent=2 payload.
+    """
+    # The keys here should match what the prompt tells the LLM to look for (e.g., "conditions", "Inclusion Criteria")
+    data_for_summary_llm = {
+        "nctId": processed_data.get('NCT_ID', 'N/A'),
+        "title": processed_data.get('Brief_Title', 'N/A'), # Prompt refers to "title"
+        "officialTitle": processed_data.get('Official_Title', 'N/A'), # Good to include for context
+        "conditions": processed_data.get('Conditions', 'N/A'), # Prompt refers to "conditions"
+        "interventions": processed_data.get('Interventions', 'N/A'), # Prompt refers to "interventions"
+        "Inclusion Criteria": processed_data.get('Inclusion_Criteria', 'N/A'), # Prompt refers to "Inclusion Criteria"
+        "Exclusion Criteria": processed_data.get('Exclusion_Criteria', 'N/A')  # Prompt refers to "Exclusion Criteria"
+    }
+    tokens_before = count_tokens(json.dumps(data_for_summary_llm, indent=2))
+    data_for_summary_llm["Inclusion Criteria"], data_for_summary_llm["Exclusion Criteria"], stats = compact_criteria(data_for_summary_llm["Inclusion Criteria"], data_for_summary_llm["Exclusion Criteria"])
+    trial_data_for_summary_string = minify_json(data_for_summary_llm)
+    stats.update(tokens_before=tokens_before, tokens_after=count_tokens(trial_data_for_summary_string))
+    return trial_data_for_summary_string, stats
+
+
+@app.route('/fetch_and_summarize', methods=['POST'])
+def fetch_and_summarize_trial_for_client_state():
+    
+    start_time = time.time()
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+
+    original_input_data = request.get_json()
+    nct_id = original_input_data.get('nct_id')
+    indication = original_input_data.get('indication')
+    bypass_cache = bool(original_input_data.get('bypass_cache')) # Force a fresh LLM call
+
+    if not nct_id: return jsonify({"status": "error", "message": "Missing 'nct_id'"}), 400
+    if not indication: return jsonify({"status": "error", "message": "Missing 'indication'"}), 400
+
+    nct_id = nct_id.strip().upper()
+
+    speculative_suggestions = start_speculative_suggestions(nct_id, indication)
+    trial_record, error_msg, fetch_status = load_processed_trial(nct_id)
+    if error_msg:
+        suggestions = speculative_suggestions.result() if speculative_suggestions else suggest_nct_ids_by_indication(indication)
+        return jsonify({"status": "error", "message": error_msg, "suggestions": suggestions}), fetch_status
+    if speculative_suggestions: speculative_suggestions.cancel() # Not needed; result (if any) is discarded
+    processed_data = trial_record.to_processed()
+
+    # --- Generate Summary ---
     trial_summary = "Summary generation failed." # Default
+    prompt_compaction = None; schema_validation = None
     try:
-        llm_summarizer = initialize_llm(temperature=0.1)
-        prompt = PromptTemplate.from_template(prompt_trial_template) # input_variables will be ['trial_data_for_summary']
-        chain_trial = LLMChain(llm=llm_summarizer, prompt=prompt)
-
-        # Prepare a smaller dictionary for summarization, using processed_data
-        # The keys here should match what the prompt tells the LLM to look for (e.g., "conditions", "Inclusion Criteria")
-        data_for_summary_llm = {
-            "nctId": processed_data.get('NCT_ID', 'N/A'),
-            "title": processed_data.get('Brief_Title', 'N/A'), # Prompt refers to "title"
-            "officialTitle": processed_data.get('Official_Title', 'N/A'), # Good to include for context
-            "conditions": processed_data.get('Conditions', 'N/A'), # Prompt refers to "conditions"
-            "interventions": processed_data.get('Interventions', 'N/A'), # Prompt refers to "interventions"
-            "Inclusion Criteria": processed_data.get('Inclusion_Criteria', 'N/A'), # Prompt refers to "Inclusion Criteria"
-            "Exclusion Criteria": processed_data.get('Exclusion_Criteria', 'N/A')  # Prompt refers to "Exclusion Criteria"
-        }
-        # Convert this smaller dictionary to a JSON string
-        trial_data_for_summary_string = json.dumps(data_for_summary_llm, indent=2)
+        trial_data_for_summary_string, prompt_compaction = build_trial_data_for_summary(processed_data)
 
         # Pass only the curated JSON string to the chain.
         # The prompt template expects a variable named 'trial_data_for_summary'.
-        trial_summary = chain_trial.run(trial_data_for_summary=trial_data_for_summary_string)
+        trial_summary = run_chain(fetch_summary_chain, FETCH_SUMMARY_PROMPT_VERSION, bypass_cache=bypass_cache, **FETCH_SUMMARY_OUTPUT, trial_data_for_summary=trial_data_for_summary_string)
+        schema_validation = schema_report(trial_summary, FETCH_SUMMARY_SCHEMA)
 
     except Exception as e:
         print(f"Error during LLM summarization for {nct_id}: {e}")
         trial_summary = f"Summary generation failed: {e}" # Include actual error
 
     end_time = time.time()
-    return jsonify({
+    # Later steps can pass state_handle instead of posting processed_data/original_input back.
+    state_handle = pipeline_state.put(trial_record, original_input_data)
+    response_body = {
         "status": "success",
-        "message": "Trial data processed and summarized. Client should retain 'processed_data' and 'original_input' for the next step.",
+        "message": "Trial data processed and summarized. Client should retain 'state_handle' (or 'processed_data' and 'original_input') for the next step.",
         "duration_seconds": round(end_time - start_time, 2),
         "trial_summary": trial_summary,
-        "processed_data": processed_data,
-        "original_input": original_input_data
-    }), 200
-
-
-# --- Endpoint 2: Generates Insights Using Data Provided by Client ---
-@app.route('/generate_insights', methods=['POST'])
-def generate_trial_insights_from_client_state():
-    """
-    Generates detailed commercial insights using processed data and original inputs
-    provided directly by the client in the request body.
-    Expects JSON: {
-        "processed_data": { ... },
-        "original_input": { "nct_id": "...", "indication": "...", "product": "...", "scenario_name": "..." }
+        "prompt_compaction": prompt_compaction,
+        "schema_validation": schema_validation,
+        "trial_data_stale": fetch_status == TRIAL_STALE_STATUS,
+        "state_handle": state_handle
     }
-    """
-    start_time = time.time()
-    if not request.is_json:
-        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+    if not original_input_data.get('state_only'): response_body.update(processed_data=processed_data, original_input=original_input_data)
+    return jsonify(response_body), 200
 
-    input_data = request.get_json()
-    processed_data = input_data.get('processed_data')
-    original_input = input_data.get('original_input')
-
-    # --- Validate Received Data ---
-    if not processed_data or not isinstance(processed_data, dict):
-        return jsonify({"status": "error", "message": "Missing or invalid 'processed_data' in request body"}), 400
-    if not original_input or not isinstance(original_input, dict):
-        return jsonify({"status": "error", "message": "Missing or invalid 'original_input' in request body"}), 400
-    # Basic check for essential keys within the dictionaries
-    if not processed_data.get('NCT_ID') or not original_input.get('indication'):
-         return jsonify({"status": "error", "message": "Received data is incomplete ('NCT_ID' or 'indication' missing)"}), 400
 
-    # --- Prepare Inputs for Insight Generation from Received Data ---
-    nct_id = processed_data.get('NCT_ID', 'Not specified') # Get NCT ID for logging
-    print(f"[{nct_id}] Generating final insights from client-provided data...")
-    brief_title = processed_data.get('Brief_Title', 'Not specified')
-    conditions = processed_data.get('Conditions', 'Not specified')
-    interventions = processed_data.get('Interventions', 'Not specified')
-    min_age = processed_data.get('Minimum_Age', 'Not specified')
-    max_age = processed_data.get('Maximum_Age', 'No maximum age specified')
-    sex = processed_data.get('Sex', 'Not specified')
-    inclusion_only = processed_data.get('Inclusion_Criteria', 'Not provided')
-    exclusion_only = processed_data.get('Exclusion_Criteria', 'Not provided')
-    # --- Get scenario info from original_input dict ---
-    scenario_name = original_input.get('scenario_name', 'Default Scenario')
-    indication = original_input.get('indication', 'Not Provided')
-    product = original_input.get('product', 'Not Provided')
-    # --- Construct derived fields ---
-    target_population = f"Ages: {min_age} to {max_age}, Sex: {sex}"
-
-    # --- Define the Detailed Insight Prompt (Same as before) ---
-    insight_prompt_template = '''You are a pharmaceutical commercial strategist and market access analyst. Your task is to analyze the following clinical trial data and generate structured, comprehensive, and clinically valid insights tailored for life sciences commercial teams.
+INSIGHT_PROMPT_TEMPLATE_TEXT = '''You are a pharmaceutical commercial strategist and market access analyst. Your task is to analyze the following clinical trial data and generate structured, comprehensive, and clinically valid insights tailored for life sciences commercial teams.
 Using the provided medical indication name and the corresponding Inclusion and Exclusion Criteria extracted from ClinicalTrials data, identify and compile all relevant ICD-10 codes. Thoroughly interpret the clinical context described in each criterion to determine the appropriate diagnostic codes.
 For the inclusion criteria, focus on identifying ICD-10 codes that accurately represent the underlying medical conditions or diagnoses specified. Organize the resulting codes into logically defined groups based on clinical similarity, comorbidities, or related pathologies.
 For the exclusion criteria, evaluate each condition or contraindication described, and select corresponding ICD-10 codes that clearly reflect those exclusion parameters. Group these codes meaningfully to mirror the structure and intent of the criteria.
 Exclude any codes that refer to medical procedures, surgeries, or adverse events, as the focus should remain strictly on diagnostic classifications.
 Ensure that all selected codes are accurate, up-to-date, and aligned with standard classifications, referencing authoritative sources such as the WHO ICD-10 database or equivalent coding guidelines.
 Carefully examine the inclusion and exclusion criteria to extract:
-1. Age Groups – Analyze the clinical condition specified in the trial and categorize participants into meaningful age groups. While a separate group for ages 65+ can be considered, always create 3 to 5 distinct age buckets within the 1–60 age range based on the nature of the disease and the trial's inclusion criteria. Do not restrict the categorization to just the 1–60 and 65+ groups. Ensure that each age group is clearly defined, contextually relevant, and accurately reflects the trial's requirements.
-2. Age Criteria – Review the details related to age mentioned in the inclusion criteria, if available.
-2. Gender eligibility, if mentioned (e.g., "All", "Male", "Female").
-3. In AddressableMarketDefinition - Analyze the text in the inclusion criteria thoroughly and provide it.
-4. Disease Groups - Always create disease groups between 1 to 8. Please note that, it should not exceed more than 8 groups.
+1. In AddressableMarketDefinition - Analyze the text in the inclusion criteria thoroughly and provide it.
+2. Disease Groups - Always create disease groups between 1 to 8. Please note that, it should not exceed more than 8 groups.
+3. BroadMarketDefinition ICDCodes - Choose from the candidate ICD-10-CM codes when any fit the indication; add other codes only when no candidate covers it. Disease groups may use other codes where a criterion requires them.
+Age criteria, age groups and gender eligibility are derived from the trial record separately; do not return them.
 Ensure the extracted insights are based strictly on the given clinical trial data and ICD definitions.
 
 Ensure the extracted insights are based strictly on the given clinical trial data and ICD definitions.
@@ -379,6 +444,7 @@ CLINICAL TRIAL INFORMATION:
 - Target Population: {target_population}
 - Inclusion Criteria: {inclusion_only}
 - Exclusion Criteria: {exclusion_only}
+- Candidate ICD-10-CM codes (from the trial's MeSH condition terms): {icd_candidates}
 SCENARIO INFORMATION:
 - Scenario Name: {scenario_name}
 - Indication: {indication}
@@ -392,20 +458,6 @@ Return the following insights in the below JSON Format ONLY:
   }},
   "AddressableMarketDefinition": "A brief blurb summarizing how we will define the addressable market (e.g., this will be along the lines of 'In order to identify...')",
   "AddressableMarketCriteriaByPatientAttribute": {{
-   	"AgeCriteria":{{
-	"AgeCriteria":"Age criteria value",
-	"AgeCriteriaDescription":"Includes most commonly diagnosed for this condition"
-	}},
-    "Age": {{
-      "AgeGroup1": {{
-        "AgeGroup1": "Group 1 Name",
-      }},
-      "AgeGroup2": {{
-        "AgeGroup2": "Group 2 Name",
-      }},
-     ...
-    "Gender": "Male, Female, Both or Does not apply",
-	"GenderDescription": "This condition is observed in both males and females",
     "AdditionalICDCodesRequired": {{
       "Group1": {{
         "GroupName": "Group 1 Name",
@@ -461,32 +513,6 @@ Here is the one such example:
   }},
   "AddressableMarketDefinition": "To refine the addressable population, we will stratify atrial fibrillation patients into clinically meaningful subgroups based on comorbidities and trial exclusion patterns observed in real-world data.",
   "AddressableMarketCriteriaByPatientAttribute": {{
-	"AgeCriteria":{{
-	"AgeCriteria":"21+",
-	"AgeCriteriaDescription":"Includes adult patients aged 21 years and above, in line with typical clinical trial eligibility and disease onset."
-	}},
-    "Age": {{
-      "AgeGroup1": {{
-        "AgeGroup1": "0-18"
-        }},
-      "AgeGroup2": {{
-        "AgeGroup2": "19-36"
-      }},
-      "AgeGroup3": {{
-        "AgeGroup3": "37-54"
-      }},
-      "AgeGroup4": {{
-        "AgeGroup4": "55-72"
-      }},
-      "AgeGroup5": {{
-        "AgeGroup5": "73-90"
-      }},
-      "AgeGroup6": {{
-        "AgeGroup6": "91-100"
-      }}
-    }},
-    "Gender": "Both",
-	"GenderDescription":"This condition is observed in both males and females"
     "AdditionalICDCodesRequired": {{
       "Group1": {{
         "GroupName": "Hypertension Comorbidity",
@@ -535,41 +561,123 @@ Here is the one such example:
 }}
 
     IMPORTANT: Populate the JSON structure accurately based only on the provided CLINICAL TRIAL INFORMATION and SCENARIO INFORMATION. Generate valid ICD-10 codes relevant to the clinical descriptions in the criteria. If criteria are vague or don't map clearly to ICD-10, state that in the description and leave the ICDCodes array empty for that section. Fill in the group names and descriptions logically.'''
+INSIGHT_PROMPT_VERSION = "insight-v3" # v2: age/sex fields come from demographics.extract_demographics(), not the model; v3: MeSH-derived ICD candidates
+INSIGHT_MAX_TOKENS = int(os.getenv("INSIGHT_MAX_TOKENS", "2000"))
+INSIGHT_OUTPUT = {"output_schema": INSIGHT_SCHEMA, "max_tokens": INSIGHT_MAX_TOKENS}
+insight_prompt = PromptTemplate.from_template(INSIGHT_PROMPT_TEMPLATE_TEXT)
+insight_chain = LLMChain(llm=get_llm(temperature=0.0), prompt=insight_prompt)
 
-    # --- Generate Insights via LLM ---
-    final_output = None
+
+def validate_insight_request(input_data):
+    """
+    Returns (processed_data, original_input, error_msg) for a /generate_insights style body:
+    either a 'state_handle' from /fetch_and_summarize, or the full processed_data/original_input.
+    An 'original_input' sent alongside a handle overrides the stored one.
+    """
+    state_handle = input_data.get('state_handle')
+    if state_handle:
+        state = pipeline_state.get(str(state_handle))
+        if state is None: return None, None, "Unknown or expired 'state_handle'; call /fetch_and_summarize again or send 'processed_data' and 'original_input'"
+        trial_record, original_input = state
+        return trial_record.to_processed(), input_data.get('original_input') or original_input, None
+    processed_data = input_data.get('processed_data')
+    original_input = input_data.get('original_input')
+    if not processed_data or not isinstance(processed_data, dict):
+        return None, None, "Missing or invalid 'processed_data' in request body"
+    if not original_input or not isinstance(original_input, dict):
+        return None, None, "Missing or invalid 'original_input' in request body"
+    # Basic check for essential keys within the dictionaries
+    if not processed_data.get('NCT_ID') or not original_input.get('indication'):
+        return None, None, "Received data is incomplete ('NCT_ID' or 'indication' missing)"
+    return processed_data, original_input, None
+
+def build_insight_variables(processed_data, original_input):
+    """
+    Prompt variables for insight_prompt, taken from BOTH processed_data and original_input,
+    with the criteria compacted to the token budget and ICD candidates looked up from the trial's
+    MeSH terms. Returns (variables, compaction_stats).
+    """
+    min_age = processed_data.get('Minimum_Age', 'Not specified')
+    max_age = processed_data.get('Maximum_Age', 'No maximum age specified')
+    sex = processed_data.get('Sex', 'Not specified')
+    inclusion_only, exclusion_only, stats = compact_criteria(processed_data.get('Inclusion_Criteria', 'Not provided'), processed_data.get('Exclusion_Criteria', 'Not provided'))
+    candidates = mesh_icd_index.candidates(processed_data.get('MeSH_Terms') or [], processed_data.get('MeSH_Ancestors') or [])
+    stats["icd_candidates"] = len(candidates)
+    return {
+        "nct_id": processed_data.get('NCT_ID', 'Not specified'),
+        "brief_title": processed_data.get('Brief_Title', 'Not specified'),
+        "conditions": processed_data.get('Conditions', 'Not specified'),
+        "interventions": processed_data.get('Interventions', 'Not specified'),
+        "target_population": f"Ages: {min_age} to {max_age}, Sex: {sex}", # Constructed string
+        "inclusion_only": inclusion_only,
+        "exclusion_only": exclusion_only,
+        "icd_candidates": "; ".join(f"{code} {description}" for code, description in candidates) or "None available",
+        "scenario_name": original_input.get('scenario_name', 'Default Scenario'),
+        "indication": original_input.get('indication', 'Not Provided'),
+        "product": original_input.get('product', 'Not Provided'),
+    }, stats
+
+def parse_insights_output(final_insights_str, nct_id, processed_data=None, parser=None):
+    """
+    Extracts the insights JSON from the LLM output, repairing trailing commas, unclosed fences and
+    truncation (streaming_json); falls back to the raw text with a warning when nothing is recoverable.
+    parser: an IncrementalJSONParser already fed final_insights_str (streaming endpoints).
+    With processed_data, the rule-based age/sex fields are merged in (the prompt no longer asks for them).
+    """
+    print(f"[{nct_id}] Parsing LLM response for final insights...")
     try:
-        llm_insight = initialize_llm(temperature=0.0)
-        prompt = PromptTemplate.from_template(insight_prompt_template)
-        chain_insight = LLMChain(llm=llm_insight, prompt=prompt)
-
-        final_insights_str = chain_insight.run(
-            # Pass variables extracted from BOTH processed_data and original_input
-            nct_id=nct_id, brief_title=brief_title, conditions=conditions, interventions=interventions,
-            target_population=target_population, # Use constructed string
-            scenario_name=scenario_name, indication=indication, product=product, # From original_input
-            exclusion_only=exclusion_only, inclusion_only=inclusion_only, # From processed_data
-            min_age=min_age, max_age=max_age, sex=sex # Also needed if prompt uses them directly
-        )
-
-        # --- Post-process LLM Output (Extract and Parse JSON) ---
-        print(f"[{nct_id}] Parsing LLM response for final insights...")
-        try:
-            match = re.search(r"```json\s*(\{.*?\})\s*```", final_insights_str, re.DOTALL | re.IGNORECASE)
-            if match: json_str = match.group(1)
-            elif final_insights_str.strip().startswith('{') and final_insights_str.strip().endswith('}'): json_str = final_insights_str.strip()
-            else: raise ValueError("Could not find JSON block in LLM output.")
-            parsed_insights = json.loads(json_str); final_output = parsed_insights
-        except (json.JSONDecodeError, ValueError) as json_e:
-            error_message = f"LLM output for {nct_id} could not be parsed as JSON: {json_e}"
-            print(f"Warning: {error_message}"); final_output = {"parsing_warning": error_message, "raw_llm_output": final_insights_str}
-        except Exception as parse_e:
-            error_message = f"Unexpected error parsing LLM output for {nct_id}: {parse_e}"
-            print(f"Error: {error_message}"); final_output = {"parsing_error": error_message, "raw_llm_output": final_insights_str}
+        if parser is None: parser = IncrementalJSONParser(); parser.feed(final_insights_str)
+        insights = parser.finish()
+        if parser.repairs: print(f"[{nct_id}] Repaired LLM JSON output: {', '.join(parser.repairs)}")
+        if not isinstance(insights, dict): raise ValueError("LLM output JSON is not an object.")
+        return merge_demographics(insights, extract_demographics(processed_data)) if processed_data else insights
+    except ValueError as json_e:
+        error_message = f"LLM output for {nct_id} could not be parsed as JSON: {json_e}"
+        print(f"Warning: {error_message}"); return {"parsing_warning": error_message, "raw_llm_output": final_insights_str}
+    except Exception as parse_e:
+        error_message = f"Unexpected error parsing LLM output for {nct_id}: {parse_e}"
+        print(f"Error: {error_message}"); return {"parsing_error": error_message, "raw_llm_output": final_insights_str}
+
+def insight_section_event(key, value, processed_data):
+    """One completed top-level insights member, post-processed like the final result, for the SSE "section" event."""
+    section = {key: value}
+    if key == "AddressableMarketCriteriaByPatientAttribute": merge_demographics(section, extract_demographics(processed_data))
+    section, _ = icd10cm_index.clean_insights(section)
+    return {"name": key, "value": section[key]}
+
+
+# --- Endpoint 2: Generates Insights Using Data Provided by Client ---
+@app.route('/generate_insights', methods=['POST'])
+def generate_trial_insights_from_client_state():
+    """
+    Generates detailed commercial insights using processed data and original inputs
+    provided directly by the client in the request body.
+    Expects JSON: {
+        "processed_data": { ... },
+        "original_input": { "nct_id": "...", "indication": "...", "product": "...", "scenario_name": "..." }
+    }
+    or, with the handle returned by /fetch_and_summarize: {"state_handle": "..."}
+    """
+    start_time = time.time()
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+
+    input_data = request.get_json()
+    bypass_cache = bool(input_data.get('bypass_cache')) # Force a fresh LLM call
+    processed_data, original_input, validation_error = validate_insight_request(input_data)
+    if validation_error: return jsonify({"status": "error", "message": validation_error}), 400
+
+    prompt_variables, prompt_compaction = build_insight_variables(processed_data, original_input)
+    nct_id = prompt_variables['nct_id'] # For logging
+    print(f"[{nct_id}] Generating final insights from client-provided data...")
 
+    # --- Generate Insights via LLM ---
+    try:
+        final_insights_str = run_chain(insight_chain, INSIGHT_PROMPT_VERSION, bypass_cache=bypass_cache, **INSIGHT_OUTPUT, **prompt_variables)
     except Exception as llm_e:
         print(f"Error during LLM insight generation for {nct_id}: {llm_e}")
         return jsonify({"status": "error", "message": f"Failed to generate final insights via LLM: {llm_e}"}), 500
+    final_output, icd_validation = icd10cm_index.clean_insights(parse_insights_output(final_insights_str, nct_id, processed_data))
 
     # --- Return Success Response ---
     end_time = time.time()
@@ -577,10 +685,146 @@ Here is the one such example:
         "status": "success",
         "message": "Final insights generated from provided data.",
         "duration_seconds": round(end_time - start_time, 2),
+        "prompt_compaction": prompt_compaction,
+        "icd_validation": icd_validation,
+        "schema_validation": schema_report(final_output, INSIGHT_SCHEMA),
         "insights": final_output
     }), 200
 
 
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# --- Endpoint 2 (streaming): Same insights, tokens forwarded as Server-Sent Events ---
+@app.route('/generate_insights/stream', methods=['POST'])
+def generate_trial_insights_stream():
+    """
+    Same request body as /generate_insights. Responds with text/event-stream:
+      event: start  -> {"nct_id": ...} sent immediately
+      event: token  -> {"text": "..."} for each completion chunk as it arrives
+      event: section -> {"name", "value"} for each top-level insights member as soon as it is complete
+      event: result -> {"status", "message", "duration_seconds", "time_to_first_token_seconds", "prompt_compaction", "icd_validation", "schema_validation", "insights"}
+      event: error  -> {"status": "error", "message": ...}
+    """
+    start_time = time.time()
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+
+    input_data = request.get_json()
+    bypass_cache = bool(input_data.get('bypass_cache')) # Force a fresh LLM call
+    processed_data, original_input, validation_error = validate_insight_request(input_data)
+    if validation_error: return jsonify({"status": "error", "message": validation_error}), 400
+
+    prompt_variables, prompt_compaction = build_insight_variables(processed_data, original_input)
+    nct_id = prompt_variables['nct_id']
+    print(f"[{nct_id}] Streaming final insights from client-provided data...")
+
+    def generate():
+        yield sse_event("start", {"nct_id": nct_id})
+        chunks = []; first_token_time = None; parser = IncrementalJSONParser()
+        try:
+            for chunk in stream_chain(insight_chain, INSIGHT_PROMPT_VERSION, bypass_cache=bypass_cache, **INSIGHT_OUTPUT, **prompt_variables):
+                if first_token_time is None: first_token_time = time.time()
+                chunks.append(chunk)
+                yield sse_event("token", {"text": chunk})
+                for key, value in parser.feed(chunk): yield sse_event("section", insight_section_event(key, value, processed_data))
+        except Exception as llm_e:
+            print(f"Error during streamed LLM insight generation for {nct_id}: {llm_e}")
+            yield sse_event("error", {"status": "error", "message": f"Failed to generate final insights via LLM: {llm_e}"}); return
+        final_output, icd_validation = icd10cm_index.clean_insights(parse_insights_output("".join(chunks), nct_id, processed_data, parser))
+        yield sse_event("result", {
+            "status": "success",
+            "message": "Final insights generated from provided data.",
+            "duration_seconds": round(time.time() - start_time, 2),
+            "time_to_first_token_seconds": round(first_token_time - start_time, 2) if first_token_time else None,
+            "prompt_compaction": prompt_compaction,
+            "icd_validation": icd_validation,
+            "schema_validation": schema_report(final_output, INSIGHT_SCHEMA),
+            "insights": final_output
+        })
+
+    # X-Accel-Buffering stops reverse proxies from holding tokens back until the response ends.
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# --- Endpoint 2 (batch): Fetch -> process -> insights for many trials, streamed as NDJSON ---
+BATCH_MAX_TRIALS = int(os.getenv("BATCH_MAX_TRIALS", "200"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+BATCH_DEFAULT_CONCURRENCY = int(os.getenv("BATCH_DEFAULT_CONCURRENCY", "4"))
+
+def run_trial_insight_job(trial_input, bypass_cache=False):
+    """Full pipeline for one batch entry. Never raises; failures are reported in the result dict."""
+    start_time = time.time()
+    nct_id = str(trial_input.get('nct_id') or '').strip().upper()
+    result = {"nct_id": nct_id}
+    if not trial_input.get('indication'):
+        result.update(status="error", message="Missing 'indication'", http_status=400)
+    else:
+        trial_record, error_msg, fetch_status = load_processed_trial(nct_id)
+        if error_msg:
+            result.update(status="error", message=error_msg, http_status=fetch_status)
+        else:
+            try:
+                processed_data = trial_record.to_processed() # Jobs share the cached record; the dict lives only for this result
+                prompt_variables, prompt_compaction = build_insight_variables(processed_data, trial_input)
+                final_insights_str = run_chain(insight_chain, INSIGHT_PROMPT_VERSION, bypass_cache=bypass_cache, **INSIGHT_OUTPUT, **prompt_variables)
+                insights, icd_validation = icd10cm_index.clean_insights(parse_insights_output(final_insights_str, nct_id, processed_data))
+                result.update(status="success", processed_data=processed_data, prompt_compaction=prompt_compaction, icd_validation=icd_validation, schema_validation=schema_report(insights, INSIGHT_SCHEMA), insights=insights, trial_data_stale=fetch_status == TRIAL_STALE_STATUS)
+            except Exception as llm_e:
+                print(f"Error during batch LLM insight generation for {nct_id}: {llm_e}")
+                result.update(status="error", message=f"Failed to generate final insights via LLM: {llm_e}", http_status=500)
+    result["duration_seconds"] = round(time.time() - start_time, 2)
+    return result
+
+@app.route('/generate_insights/batch', methods=['POST'])
+def generate_trial_insights_batch():
+    """
+    Runs fetch -> process_trial_data -> insight generation for many trials concurrently.
+    Expects JSON: {
+        "trials": [{"nct_id": "...", "indication": "...", "product": "...", "scenario_name": "..."}, ...],
+        "concurrency": 4,        # optional, capped at BATCH_MAX_CONCURRENCY
+        "bypass_cache": false    # optional
+    }
+    Responds with application/x-ndjson: one line per trial, in completion order, each carrying
+    its "index" in the request list.
+    """
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+
+    input_data = request.get_json()
+    trials = input_data.get('trials')
+    bypass_cache = bool(input_data.get('bypass_cache'))
+    if not trials or not isinstance(trials, list) or not all(isinstance(t, dict) for t in trials):
+        return jsonify({"status": "error", "message": "Missing or invalid 'trials' list in request body"}), 400
+    if len(trials) > BATCH_MAX_TRIALS:
+        return jsonify({"status": "error", "message": f"Too many trials ({len(trials)}); the limit is {BATCH_MAX_TRIALS}."}), 400
+    try: concurrency = int(input_data.get('concurrency', BATCH_DEFAULT_CONCURRENCY))
+    except (TypeError, ValueError): return jsonify({"status": "error", "message": "'concurrency' must be an integer"}), 400
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY, len(trials)))
+    print(f"Batch insight generation for {len(trials)} trials, concurrency {concurrency}...")
+
+    def generate():
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="insight-batch")
+        try:
+            futures = {executor.submit(run_trial_insight_job, trial, bypass_cache): index for index, trial in enumerate(trials)}
+            for future in as_completed(futures):
+                yield json.dumps(dict(future.result(), index=futures[future])) + "\n"
+        finally:
+            # If the client disconnects, drop the trials that have not started yet.
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return Response(generate(), mimetype="application/x-ndjson", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# --- Indication type-ahead (served from the local condition index) ---
+@app.route('/indications/typeahead', methods=['GET'])
+def indication_typeahead():
+    """GET /indications/typeahead?q=atrial fib&limit=10 -> condition names ranked by number of trials."""
+    query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    if not condition_index.enabled:
+        return jsonify({"status": "error", "message": "Condition index is not configured (CONDITION_INDEX_DB_PATH)."}), 503
+    return jsonify({"status": "success", "query": query, "suggestions": condition_index.typeahead(query, limit)}), 200
+
 import json
 import time
 from flask import request, jsonify # Assuming Flask app context
@@ -692,6 +936,19 @@ CRITICAL: ALWAYS GIVE OUTPUT IN THE BELOW FORMAT ONLY
 Concise Narrative Summary of Insights:
 """
 
+INSIGHT_SUMMARY_PROMPT_VERSION = "insight-summary-v1"
+INSIGHT_SUMMARY_MAX_TOKENS = int(os.getenv("INSIGHT_SUMMARY_MAX_TOKENS", "1500"))
+INSIGHT_SUMMARY_OUTPUT = {"output_schema": INSIGHT_SUMMARY_SCHEMA, "max_tokens": INSIGHT_SUMMARY_MAX_TOKENS}
+insight_summary_prompt = PromptTemplate.from_template(INSIGHT_SUMMARY_PROMPT_TEMPLATE_TEXT)
+insight_summary_chain = LLMChain(llm=get_llm(temperature=0.2), prompt=insight_summary_prompt)
+
+def clean_insight_summary(summary_output):
+    # Basic cleanup of the LLM's response
+    summary_text = summary_output.strip()
+    if summary_text.lower().startswith("concise narrative summary of insights:"):
+        summary_text = summary_text[len("concise narrative summary of insights:"):].strip()
+    return summary_text
+
 @app.route('/summarize_trial_insights', methods=['POST'])
 def summarize_trial_insights():
     
@@ -702,6 +959,7 @@ def summarize_trial_insights():
     input_data = request.get_json()
     # The key in the input JSON body that holds the output from '/generate_insights'
     detailed_insights_payload = input_data.get('detailed_trial_insights')
+    bypass_cache = bool(input_data.get('bypass_cache')) # Force a fresh LLM call
 
     if not detailed_insights_payload or not isinstance(detailed_insights_payload, dict):
         return jsonify({
@@ -709,25 +967,20 @@ def summarize_trial_insights():
             "message": "Missing or invalid 'detailed_trial_insights' JSON in request body. This should be the JSON output from the '/generate_insights' endpoint."
         }), 400
 
-    # Convert the provided detailed insights JSON to a string for the LLM
-    insights_json_string_to_summarize = json.dumps(detailed_insights_payload, indent=2)
+    # Convert the provided detailed insights JSON to a (minified) string for the LLM
+    # Invalid codes are dropped (and wildcards/ranges expanded) so the summary never repeats them
+    detailed_insights_payload, icd_validation = icd10cm_index.clean_insights(detailed_insights_payload)
+    insights_json_string_to_summarize, prompt_compaction = minify_json_with_stats(without_code_descriptions(detailed_insights_payload))
 
     summary_text = "Insights summary generation failed."
-    llm_error_message = None
+    llm_error_message = None; schema_validation = None
 
     try:
-        # Initialize LLM (you might want a specific temperature for summarization)
-        llm_summarizer = initialize_llm(temperature=0.2)
-        prompt = PromptTemplate.from_template(INSIGHT_SUMMARY_PROMPT_TEMPLATE_TEXT)
-        chain_summarize_insights = LLMChain(llm=llm_summarizer, prompt=prompt)
+        # Run the pre-built chain to get the summary
+        summary_output = run_chain(insight_summary_chain, INSIGHT_SUMMARY_PROMPT_VERSION, bypass_cache=bypass_cache, **INSIGHT_SUMMARY_OUTPUT, insights_json_string=insights_json_string_to_summarize)
 
-        # Run the LLM chain to get the summary
-        summary_output = chain_summarize_insights.run(insights_json_string=insights_json_string_to_summarize)
-
-        # Basic cleanup of the LLM's response
-        summary_text = summary_output.strip()
-        if summary_text.lower().startswith("concise narrative summary of insights:"):
-            summary_text = summary_text[len("concise narrative summary of insights:"):].strip()
+        summary_text = clean_insight_summary(summary_output)
+        schema_validation = schema_report(summary_text, INSIGHT_SUMMARY_SCHEMA)
 
     except Exception as e:
         llm_error_message = f"Error during LLM insights summarization: {e}"
@@ -749,10 +1002,103 @@ def summarize_trial_insights():
         "status": final_status,
         "message": final_message,
         "duration_seconds": round(end_time - start_time, 2),
+        "prompt_compaction": prompt_compaction,
+        "icd_validation": icd_validation,
+        "schema_validation": schema_validation,
         "trial_summary": summary_text # This is the primary output for the client to display
     }), 200
 
 
+# --- Endpoint 4: One-shot pipeline (fetch once; summary and insights run concurrently) ---
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "16"))
+_pipeline_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+PIPELINE_OUTPUT_KEYS = ("trial_summary", "insights", "insights_summary") # Moved from the stage entries to the top level of the response
+
+def market_summary_stage(processed_data, bypass_cache=False):
+    trial_data_for_summary_string, prompt_compaction = build_trial_data_for_summary(processed_data)
+    trial_summary = run_chain(fetch_summary_chain, FETCH_SUMMARY_PROMPT_VERSION, bypass_cache=bypass_cache, **FETCH_SUMMARY_OUTPUT, trial_data_for_summary=trial_data_for_summary_string)
+    return {"trial_summary": trial_summary, "prompt_compaction": prompt_compaction, "schema_validation": schema_report(trial_summary, FETCH_SUMMARY_SCHEMA)}
+
+def insights_stage(processed_data, original_input, bypass_cache=False):
+    prompt_variables, prompt_compaction = build_insight_variables(processed_data, original_input)
+    final_insights_str = run_chain(insight_chain, INSIGHT_PROMPT_VERSION, bypass_cache=bypass_cache, **INSIGHT_OUTPUT, **prompt_variables)
+    insights, icd_validation = icd10cm_index.clean_insights(parse_insights_output(final_insights_str, prompt_variables['nct_id'], processed_data))
+    return {"insights": insights, "prompt_compaction": prompt_compaction, "icd_validation": icd_validation, "schema_validation": schema_report(insights, INSIGHT_SCHEMA)}
+
+def insight_summary_stage(insights, bypass_cache=False):
+    """Narrative summary of insights that insights_stage() already ICD-cleaned."""
+    insights_json_string, prompt_compaction = minify_json_with_stats(without_code_descriptions(insights))
+    summary_text = clean_insight_summary(run_chain(insight_summary_chain, INSIGHT_SUMMARY_PROMPT_VERSION, bypass_cache=bypass_cache, **INSIGHT_SUMMARY_OUTPUT, insights_json_string=insights_json_string))
+    return {"insights_summary": summary_text, "prompt_compaction": prompt_compaction, "schema_validation": schema_report(summary_text, INSIGHT_SUMMARY_SCHEMA)}
+
+def run_pipeline_stage(request_start, stage, *args):
+    """
+    Runs one /pipeline stage and never raises. The result carries "status" and its "start_seconds"
+    and "duration_seconds" relative to the request, so overlapping stages show in the response.
+    """
+    stage_start = time.time()
+    try: result = dict(stage(*args), status="success")
+    except Exception as e: print(f"Pipeline stage {stage.__name__} failed: {e}"); result = {"status": "error", "message": f"{stage.__name__} failed: {e}"}
+    result.update(start_seconds=round(stage_start - request_start, 2), duration_seconds=round(time.time() - stage_start, 2))
+    return result
+
+def pipeline_response(start_time, stages, trial_record, original_input):
+    """
+    Response body for /pipeline: stage outputs at the top level, per-stage status and timings under "stages".
+    "partial" when a stage that ran failed; a skipped stage (nothing to do) does not count against success.
+    """
+    body = {"status": "success" if all(stage["status"] == "success" for stage in stages.values() if stage["status"] != "skipped") else "partial",
+            "nct_id": trial_record.nct_id, "duration_seconds": round(time.time() - start_time, 2),
+            "sequential_seconds": round(sum(stage["duration_seconds"] for stage in stages.values()), 2)} # What the three-call flow would have spent
+    for stage in stages.values():
+        for key in PIPELINE_OUTPUT_KEYS:
+            if key in stage: body[key] = stage.pop(key)
+    body["stages"] = stages
+    body["state_handle"] = pipeline_state.put(trial_record, original_input)
+    if not original_input.get('state_only'): body.update(processed_data=trial_record.to_processed(), original_input=original_input)
+    return body
+
+@app.route('/pipeline', methods=['POST'])
+def run_trial_pipeline():
+    """
+    /fetch_and_summarize + /generate_insights + /summarize_trial_insights in one call. The trial is
+    fetched once; the market-definition summary and the detailed insights then run concurrently, and
+    the narrative summary starts as soon as the insights JSON is ready.
+    Expects the /fetch_and_summarize body: {"nct_id", "indication", "product", "scenario_name", "bypass_cache", "state_only"}.
+    Responds with "trial_summary", "insights", "insights_summary", "state_handle" and "stages":
+    {"fetch", "market_summary", "insights", "insight_summary"}, each with "status", "start_seconds" and "duration_seconds".
+    """
+    start_time = time.time()
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+
+    original_input_data = request.get_json()
+    nct_id = original_input_data.get('nct_id')
+    indication = original_input_data.get('indication')
+    bypass_cache = bool(original_input_data.get('bypass_cache'))
+    if not nct_id: return jsonify({"status": "error", "message": "Missing 'nct_id'"}), 400
+    if not indication: return jsonify({"status": "error", "message": "Missing 'indication'"}), 400
+    nct_id = nct_id.strip().upper()
+
+    speculative_suggestions = start_speculative_suggestions(nct_id, indication)
+    trial_record, error_msg, fetch_status = load_processed_trial(nct_id)
+    if error_msg:
+        suggestions = speculative_suggestions.result() if speculative_suggestions else suggest_nct_ids_by_indication(indication)
+        return jsonify({"status": "error", "message": error_msg, "suggestions": suggestions}), fetch_status
+    if speculative_suggestions: speculative_suggestions.cancel()
+    fetch_stage = {"status": "success", "trial_data_stale": fetch_status == TRIAL_STALE_STATUS, "start_seconds": 0.0, "duration_seconds": round(time.time() - start_time, 2)}
+    processed_data = trial_record.to_processed()
+
+    # The market summary runs in the pool while this thread does insights -> narrative summary.
+    market_summary_future = _pipeline_executor.submit(run_pipeline_stage, start_time, market_summary_stage, processed_data, bypass_cache)
+    insights_result = run_pipeline_stage(start_time, insights_stage, processed_data, original_input_data, bypass_cache)
+    insights = insights_result.get("insights")
+    if insights_result["status"] == "success" and "raw_llm_output" not in insights: insight_summary_result = run_pipeline_stage(start_time, insight_summary_stage, insights, bypass_cache)
+    else: insight_summary_result = {"status": "skipped", "message": "No insights JSON to summarize.", "start_seconds": None, "duration_seconds": 0.0}
+    stages = {"fetch": fetch_stage, "market_summary": market_summary_future.result(), "insights": insights_result, "insight_summary": insight_summary_result}
+    return jsonify(pipeline_response(start_time, stages, trial_record, original_input_data)), 200
+
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
     app.run(host='0.0.0.0', port=port, debug=True)
@@ -0,0 +1,390 @@
+import asyncio
+import json
+import time
+
+import httpx
+from quart import Quart, Response, request, jsonify
+from quart_cors import cors
+
+import http_client
+from final import (
+    BATCH_DEFAULT_CONCURRENCY, BATCH_MAX_CONCURRENCY, BATCH_MAX_TRIALS, SPECULATIVE_SUGGESTIONS, TRIAL_STALE_STATUS,
+    FETCH_SUMMARY_OUTPUT, FETCH_SUMMARY_PROMPT_VERSION, INSIGHT_OUTPUT, INSIGHT_PROMPT_VERSION, INSIGHT_SUMMARY_OUTPUT, INSIGHT_SUMMARY_PROMPT_VERSION,
+    build_insight_variables, build_trial_data_for_summary, cache_trial_record, cached_trial_result, clean_insight_summary, fetch_summary_chain,
+    insight_chain, insight_section_event, insight_summary_chain, is_valid_nct_format, parse_insights_output,
+    pipeline_response, sse_event, validate_insight_request,
+)
+from llm_clients import arun_chain, astream_chain, warm_up
+from llm_schemas import FETCH_SUMMARY_SCHEMA, INSIGHT_SCHEMA, INSIGHT_SUMMARY_SCHEMA, schema_report
+from condition_index import SUGGESTION_COUNT, condition_index
+from trial_cache import trial_cache
+from single_flight import trial_fetches
+from trial_mirror import trial_mirror
+from pipeline_state import pipeline_state
+from icd_index import icd10cm_index, without_code_descriptions
+from prompt_compaction import minify_json_with_stats
+from streaming_json import IncrementalJSONParser
+from trial_projection import parse_projected_study, study_url
+
+# Async twin of final.py: same routes and response shapes, but upstream fetches and LLM
+# calls are awaited, so one process can hold many in-flight requests. Served via asgi.py.
+
+# --- Quart App Initialization ---
+app = Quart(__name__)
+app = cors(app)
+
+@app.before_serving
+async def warm_llm_pool(): warm_up()
+
+
+# --- Async Upstream Helpers ---
+async def afetch_trial_record(nct_id_upper):
+    """Async counterpart of final.fetch_trial_record(); same cache, coalescing and return shape (stale refreshes run in final's thread pool)."""
+    cached = await asyncio.to_thread(cached_trial_result, nct_id_upper, allow_stale=True)
+    if cached is not None: return cached
+
+    async def recheck(): return await asyncio.to_thread(cached_trial_result, nct_id_upper)
+    return await trial_fetches.ado(nct_id_upper, lambda: afetch_trial_record_uncached(nct_id_upper), recheck=recheck)
+
+async def afetch_trial_record_uncached(nct_id_upper):
+    mirrored = await asyncio.to_thread(trial_mirror.get, nct_id_upper) # Local bulk mirror first; live API only on a miss
+    if mirrored is not None: return await asyncio.to_thread(cache_trial_record, nct_id_upper, mirrored), None, 200
+    base_url = "https://clinicaltrials.gov/api/v2/studies"
+    try:
+        response = await http_client.aget(study_url(base_url, nct_id_upper))
+        if response.status_code == 200:
+            if not response.content: return None, f"{nct_id_upper} empty content.", 200
+            try: trial_json = parse_projected_study(response.text)
+            except (ValueError, IndexError): return None, f"{nct_id_upper} invalid JSON.", 200
+            return await asyncio.to_thread(cache_trial_record, nct_id_upper, trial_json), None, 200
+        elif response.status_code == 404: return None, f"{nct_id_upper} not found.", 404
+        else: error_detail = response.text[:500]; return None, f"Fetch fail {response.status_code}. Detail: {error_detail}", response.status_code
+    except http_client.AsyncHostCircuitOpen as e: return None, f"{e}; try again shortly.", 503
+    except httpx.TimeoutException: return None, f"Timeout fetching {nct_id_upper}.", None
+    except httpx.HTTPError as e: print(f"Fetch error {nct_id_upper}: {e}"); return None, f"Network error: {e}", None
+
+async def asuggest_nct_ids_by_indication(indication):
+    if not indication or not isinstance(indication, str): return []
+    if condition_index.enabled: return await asyncio.to_thread(condition_index.suggest, indication, SUGGESTION_COUNT) # Local ranked search, no remote round trip
+    query = indication.strip().replace(" ", "+"); url = f"https://clinicaltrials.gov/api/v2/studies?query.cond={query}&pageSize={SUGGESTION_COUNT}"
+    try:
+        response = await http_client.aget(url, timeout=15); response.raise_for_status(); results = response.json().get("studies", []); suggestions = []
+        for r in results:
+            if r:
+                id_module = r.get("protocolSection", {}).get("identificationModule", {}); nct_id = id_module.get("nctId"); title = id_module.get("briefTitle", "N/A")
+                if nct_id: suggestions.append({"nct_id": nct_id, "title": title})
+        return suggestions
+    except httpx.HTTPError as e: print(f"Suggest error '{indication}': {e}"); return []
+    except json.JSONDecodeError as e: print(f"Suggest JSON error '{indication}': {e}"); return []
+
+async def aload_processed_trial(nct_id):
+    """Async counterpart of final.load_processed_trial()."""
+    if not is_valid_nct_format(nct_id): return None, f"Invalid NCT ID format: '{nct_id}'.", 400
+    trial_record, error_msg, fetch_status = await afetch_trial_record(nct_id)
+    if fetch_status == 404: return None, f"NCT ID '{nct_id}' not found.", 404
+    if error_msg: return None, f"Fetch error for {nct_id}: {error_msg}", 503 if fetch_status == 503 else 500
+    if not trial_record: return None, f"No data returned for {nct_id}.", 500
+    if not trial_record.nct_id: return None, f"Failed to process critical data for {nct_id}.", 500
+    return trial_record, None, TRIAL_STALE_STATUS if fetch_status == TRIAL_STALE_STATUS else 200
+
+async def start_speculative_suggestions(nct_id, indication):
+    """Async counterpart of final.start_speculative_suggestions(); returns an asyncio.Task or None."""
+    if not SPECULATIVE_SUGGESTIONS or condition_index.enabled or not is_valid_nct_format(nct_id): return None
+    if await asyncio.to_thread(lambda: trial_cache.get_or_stale(nct_id)[0] is not None or trial_mirror.contains(nct_id)): return None
+    return asyncio.create_task(asuggest_nct_ids_by_indication(indication))
+
+
+# --- Endpoint 1 ---
+@app.route('/fetch_and_summarize', methods=['POST'])
+async def fetch_and_summarize_trial_for_client_state():
+    start_time = time.time()
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+
+    original_input_data = await request.get_json()
+    nct_id = original_input_data.get('nct_id')
+    indication = original_input_data.get('indication')
+    bypass_cache = bool(original_input_data.get('bypass_cache'))
+
+    if not nct_id: return jsonify({"status": "error", "message": "Missing 'nct_id'"}), 400
+    if not indication: return jsonify({"status": "error", "message": "Missing 'indication'"}), 400
+
+    nct_id = nct_id.strip().upper()
+
+    speculative_suggestions = await start_speculative_suggestions(nct_id, indication)
+    trial_record, error_msg, fetch_status = await aload_processed_trial(nct_id)
+    if error_msg:
+        suggestions = await speculative_suggestions if speculative_suggestions else await asuggest_nct_ids_by_indication(indication)
+        return jsonify({"status": "error", "message": error_msg, "suggestions": suggestions}), fetch_status
+    if speculative_suggestions: speculative_suggestions.cancel()
+    processed_data = trial_record.to_processed()
+
+    prompt_compaction = None; schema_validation = None
+    try:
+        trial_data_for_summary, prompt_compaction = await asyncio.to_thread(build_trial_data_for_summary, processed_data)
+        trial_summary = await arun_chain(fetch_summary_chain, FETCH_SUMMARY_PROMPT_VERSION, bypass_cache=bypass_cache, **FETCH_SUMMARY_OUTPUT, trial_data_for_summary=trial_data_for_summary)
+        schema_validation = schema_report(trial_summary, FETCH_SUMMARY_SCHEMA)
+    except Exception as e:
+        print(f"Error during LLM summarization for {nct_id}: {e}")
+        trial_summary = f"Summary generation failed: {e}"
+
+    # Later steps can pass state_handle instead of posting processed_data/original_input back.
+    state_handle = await asyncio.to_thread(pipeline_state.put, trial_record, original_input_data)
+    response_body = {
+        "status": "success",
+        "message": "Trial data processed and summarized. Client should retain 'state_handle' (or 'processed_data' and 'original_input') for the next step.",
+        "duration_seconds": round(time.time() - start_time, 2),
+        "trial_summary": trial_summary,
+        "prompt_compaction": prompt_compaction,
+        "schema_validation": schema_validation,
+        "trial_data_stale": fetch_status == TRIAL_STALE_STATUS,
+        "state_handle": state_handle
+    }
+    if not original_input_data.get('state_only'): response_body.update(processed_data=processed_data, original_input=original_input_data)
+    return jsonify(response_body), 200
+
+
+# --- Endpoint 2 ---
+@app.route('/generate_insights', methods=['POST'])
+async def generate_trial_insights_from_client_state():
+    start_time = time.time()
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+
+    input_data = await request.get_json()
+    bypass_cache = bool(input_data.get('bypass_cache'))
+    processed_data, original_input, validation_error = await asyncio.to_thread(validate_insight_request, input_data)
+    if validation_error: return jsonify({"status": "error", "message": validation_error}), 400
+
+    prompt_variables, prompt_compaction = await asyncio.to_thread(build_insight_variables, processed_data, original_input)
+    nct_id = prompt_variables['nct_id']
+    print(f"[{nct_id}] Generating final insights from client-provided data...")
+    try:
+        final_insights_str = await arun_chain(insight_chain, INSIGHT_PROMPT_VERSION, bypass_cache=bypass_cache, **INSIGHT_OUTPUT, **prompt_variables)
+    except Exception as llm_e:
+        print(f"Error during LLM insight generation for {nct_id}: {llm_e}")
+        return jsonify({"status": "error", "message": f"Failed to generate final insights via LLM: {llm_e}"}), 500
+    insights, icd_validation = await asyncio.to_thread(icd10cm_index.clean_insights, parse_insights_output(final_insights_str, nct_id, processed_data))
+
+    return jsonify({
+        "status": "success",
+        "message": "Final insights generated from provided data.",
+        "duration_seconds": round(time.time() - start_time, 2),
+        "prompt_compaction": prompt_compaction,
+        "icd_validation": icd_validation,
+        "schema_validation": schema_report(insights, INSIGHT_SCHEMA),
+        "insights": insights
+    }), 200
+
+
+@app.route('/generate_insights/stream', methods=['POST'])
+async def generate_trial_insights_stream():
+    start_time = time.time()
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+
+    input_data = await request.get_json()
+    bypass_cache = bool(input_data.get('bypass_cache'))
+    processed_data, original_input, validation_error = await asyncio.to_thread(validate_insight_request, input_data)
+    if validation_error: return jsonify({"status": "error", "message": validation_error}), 400
+
+    prompt_variables, prompt_compaction = await asyncio.to_thread(build_insight_variables, processed_data, original_input)
+    nct_id = prompt_variables['nct_id']
+    print(f"[{nct_id}] Streaming final insights from client-provided data...")
+
+    async def generate():
+        yield sse_event("start", {"nct_id": nct_id})
+        chunks = []; first_token_time = None; parser = IncrementalJSONParser()
+        try:
+            async for chunk in astream_chain(insight_chain, INSIGHT_PROMPT_VERSION, bypass_cache=bypass_cache, **INSIGHT_OUTPUT, **prompt_variables):
+                if first_token_time is None: first_token_time = time.time()
+                chunks.append(chunk)
+                yield sse_event("token", {"text": chunk})
+                for key, value in parser.feed(chunk): yield sse_event("section", insight_section_event(key, value, processed_data))
+        except Exception as llm_e:
+            print(f"Error during streamed LLM insight generation for {nct_id}: {llm_e}")
+            yield sse_event("error", {"status": "error", "message": f"Failed to generate final insights via LLM: {llm_e}"}); return
+        insights, icd_validation = await asyncio.to_thread(icd10cm_index.clean_insights, parse_insights_output("".join(chunks), nct_id, processed_data, parser))
+        yield sse_event("result", {
+            "status": "success",
+            "message": "Final insights generated from provided data.",
+            "duration_seconds": round(time.time() - start_time, 2),
+            "time_to_first_token_seconds": round(first_token_time - start_time, 2) if first_token_time else None,
+            "prompt_compaction": prompt_compaction,
+            "icd_validation": icd_validation,
+            "schema_validation": schema_report(insights, INSIGHT_SCHEMA),
+            "insights": insights
+        })
+
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def arun_trial_insight_job(trial_input, bypass_cache=False):
+    """Async counterpart of final.run_trial_insight_job()."""
+    start_time = time.time()
+    nct_id = str(trial_input.get('nct_id') or '').strip().upper()
+    result = {"nct_id": nct_id}
+    if not trial_input.get('indication'):
+        result.update(status="error", message="Missing 'indication'", http_status=400)
+    else:
+        trial_record, error_msg, fetch_status = await aload_processed_trial(nct_id)
+        if error_msg:
+            result.update(status="error", message=error_msg, http_status=fetch_status)
+        else:
+            try:
+                processed_data = trial_record.to_processed()
+                prompt_variables, prompt_compaction = await asyncio.to_thread(build_insight_variables, processed_data, trial_input)
+                final_insights_str = await arun_chain(insight_chain, INSIGHT_PROMPT_VERSION, bypass_cache=bypass_cache, **INSIGHT_OUTPUT, **prompt_variables)
+                insights, icd_validation = await asyncio.to_thread(icd10cm_index.clean_insights, parse_insights_output(final_insights_str, nct_id, processed_data))
+                result.update(status="success", processed_data=processed_data, prompt_compaction=prompt_compaction, icd_validation=icd_validation, schema_validation=schema_report(insights, INSIGHT_SCHEMA), insights=insights, trial_data_stale=fetch_status == TRIAL_STALE_STATUS)
+            except Exception as llm_e:
+                print(f"Error during batch LLM insight generation for {nct_id}: {llm_e}")
+                result.update(status="error", message=f"Failed to generate final insights via LLM: {llm_e}", http_status=500)
+    result["duration_seconds"] = round(time.time() - start_time, 2)
+    return result
+
+
+@app.route('/generate_insights/batch', methods=['POST'])
+async def generate_trial_insights_batch():
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+
+    input_data = await request.get_json()
+    trials = input_data.get('trials')
+    bypass_cache = bool(input_data.get('bypass_cache'))
+    if not trials or not isinstance(trials, list) or not all(isinstance(t, dict) for t in trials):
+        return jsonify({"status": "error", "message": "Missing or invalid 'trials' list in request body"}), 400
+    if len(trials) > BATCH_MAX_TRIALS:
+        return jsonify({"status": "error", "message": f"Too many trials ({len(trials)}); the limit is {BATCH_MAX_TRIALS}."}), 400
+    try: concurrency = int(input_data.get('concurrency', BATCH_DEFAULT_CONCURRENCY))
+    except (TypeError, ValueError): return jsonify({"status": "error", "message": "'concurrency' must be an integer"}), 400
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY, len(trials)))
+    print(f"Batch insight generation for {len(trials)} trials, concurrency {concurrency}...")
+
+    async def generate():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(index, trial):
+            async with semaphore:
+                return dict(await arun_trial_insight_job(trial, bypass_cache), index=index)
+
+        tasks = [asyncio.create_task(run(index, trial)) for index, trial in enumerate(trials)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + "\n"
+        finally:
+            for task in tasks: task.cancel()
+
+    return Response(generate(), mimetype="application/x-ndjson", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route('/indications/typeahead', methods=['GET'])
+async def indication_typeahead():
+    query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    if not condition_index.enabled:
+        return jsonify({"status": "error", "message": "Condition index is not configured (CONDITION_INDEX_DB_PATH)."}), 503
+    return jsonify({"status": "success", "query": query, "suggestions": await asyncio.to_thread(condition_index.typeahead, query, limit)}), 200
+
+# --- Endpoint 3 ---
+@app.route('/summarize_trial_insights', methods=['POST'])
+async def summarize_trial_insights():
+    start_time = time.time()
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+
+    input_data = await request.get_json()
+    detailed_insights_payload = input_data.get('detailed_trial_insights')
+    bypass_cache = bool(input_data.get('bypass_cache'))
+
+    if not detailed_insights_payload or not isinstance(detailed_insights_payload, dict):
+        return jsonify({
+            "status": "error",
+            "message": "Missing or invalid 'detailed_trial_insights' JSON in request body. This should be the JSON output from the '/generate_insights' endpoint."
+        }), 400
+
+    detailed_insights_payload, icd_validation = await asyncio.to_thread(icd10cm_index.clean_insights, detailed_insights_payload)
+    insights_json_string, prompt_compaction = await asyncio.to_thread(minify_json_with_stats, without_code_descriptions(detailed_insights_payload))
+    llm_error_message = None; schema_validation = None
+    try:
+        summary_output = await arun_chain(insight_summary_chain, INSIGHT_SUMMARY_PROMPT_VERSION, bypass_cache=bypass_cache, **INSIGHT_SUMMARY_OUTPUT, insights_json_string=insights_json_string)
+        summary_text = clean_insight_summary(summary_output)
+        schema_validation = schema_report(summary_text, INSIGHT_SUMMARY_SCHEMA)
+    except Exception as e:
+        llm_error_message = f"Error during LLM insights summarization: {e}"
+        print(f"Error in /summarize_trial_insights endpoint: {llm_error_message}")
+        summary_text = f"Insights summary generation failed: Could not connect to summarization service or an internal error occurred."
+
+    return jsonify({
+        "status": "success" if not llm_error_message else "error",
+        "message": "Trial insights summarized successfully." if not llm_error_message else "Failed to summarize trial insights. Please check the summary content for error details.",
+        "duration_seconds": round(time.time() - start_time, 2),
+        "prompt_compaction": prompt_compaction,
+        "icd_validation": icd_validation,
+        "schema_validation": schema_validation,
+        "trial_summary": summary_text
+    }), 200
+
+
+# --- Endpoint 4 ---
+async def amarket_summary_stage(processed_data, bypass_cache=False):
+    trial_data_for_summary, prompt_compaction = await asyncio.to_thread(build_trial_data_for_summary, processed_data)
+    trial_summary = await arun_chain(fetch_summary_chain, FETCH_SUMMARY_PROMPT_VERSION, bypass_cache=bypass_cache, **FETCH_SUMMARY_OUTPUT, trial_data_for_summary=trial_data_for_summary)
+    return {"trial_summary": trial_summary, "prompt_compaction": prompt_compaction, "schema_validation": schema_report(trial_summary, FETCH_SUMMARY_SCHEMA)}
+
+
+async def ainsights_stage(processed_data, original_input, bypass_cache=False):
+    prompt_variables, prompt_compaction = await asyncio.to_thread(build_insight_variables, processed_data, original_input)
+    final_insights_str = await arun_chain(insight_chain, INSIGHT_PROMPT_VERSION, bypass_cache=bypass_cache, **INSIGHT_OUTPUT, **prompt_variables)
+    insights, icd_validation = await asyncio.to_thread(icd10cm_index.clean_insights, parse_insights_output(final_insights_str, prompt_variables['nct_id'], processed_data))
+    return {"insights": insights, "prompt_compaction": prompt_compaction, "icd_validation": icd_validation, "schema_validation": schema_report(insights, INSIGHT_SCHEMA)}
+
+
+async def ainsight_summary_stage(insights, bypass_cache=False):
+    insights_json_string, prompt_compaction = await asyncio.to_thread(minify_json_with_stats, without_code_descriptions(insights))
+    summary_text = clean_insight_summary(await arun_chain(insight_summary_chain, INSIGHT_SUMMARY_PROMPT_VERSION, bypass_cache=bypass_cache, **INSIGHT_SUMMARY_OUTPUT, insights_json_string=insights_json_string))
+    return {"insights_summary": summary_text, "prompt_compaction": prompt_compaction, "schema_validation": schema_report(summary_text, INSIGHT_SUMMARY_SCHEMA)}
+
+
+async def arun_pipeline_stage(request_start, stage, *args):
+    """Async counterpart of final.run_pipeline_stage()."""
+    stage_start = time.time()
+    try: result = dict(await stage(*args), status="success")
+    except Exception as e: print(f"Pipeline stage {stage.__name__} failed: {e}"); result = {"status": "error", "message": f"{stage.__name__} failed: {e}"}
+    result.update(start_seconds=round(stage_start - request_start, 2), duration_seconds=round(time.time() - stage_start, 2))
+    return result
+
+
+@app.route('/pipeline', methods=['POST'])
+async def run_trial_pipeline():
+    start_time = time.time()
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+
+    original_input_data = await request.get_json()
+    nct_id = original_input_data.get('nct_id')
+    indication = original_input_data.get('indication')
+    bypass_cache = bool(original_input_data.get('bypass_cache'))
+    if not nct_id: return jsonify({"status": "error", "message": "Missing 'nct_id'"}), 400
+    if not indication: return jsonify({"status": "error", "message": "Missing 'indication'"}), 400
+    nct_id = nct_id.strip().upper()
+
+    speculative_suggestions = await start_speculative_suggestions(nct_id, indication)
+    trial_record, error_msg, fetch_status = await aload_processed_trial(nct_id)
+    if error_msg:
+        suggestions = await speculative_suggestions if speculative_suggestions else await asuggest_nct_ids_by_indication(indication)
+        return jsonify({"status": "error", "message": error_msg, "suggestions": suggestions}), fetch_status
+    if speculative_suggestions: speculative_suggestions.cancel()
+    fetch_stage = {"status": "success", "trial_data_stale": fetch_status == TRIAL_STALE_STATUS, "start_seconds": 0.0, "duration_seconds": round(time.time() - start_time, 2)}
+    processed_data = trial_record.to_processed()
+
+    async def insights_then_summary():
+        insights_result = await arun_pipeline_stage(start_time, ainsights_stage, processed_data, original_input_data, bypass_cache)
+        insights = insights_result.get("insights")
+        if insights_result["status"] == "success" and "raw_llm_output" not in insights: return insights_result, await arun_pipeline_stage(start_time, ainsight_summary_stage, insights, bypass_cache)
+        return insights_result, {"status": "skipped", "message": "No insights JSON to summarize.", "start_seconds": None, "duration_seconds": 0.0}
+
+    market_summary_result, (insights_result, insight_summary_result) = await asyncio.gather(
+        arun_pipeline_stage(start_time, amarket_summary_stage, processed_data, bypass_cache), insights_then_summary())
+    stages = {"fetch": fetch_stage, "market_summary": market_summary_result, "insights": insights_result, "insight_summary": insight_summary_result}
+    return jsonify(pipeline_response(start_time, stages, trial_record, original_input_data)), 200
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from circuit_breaker import CircuitOpenError, circuit_breaker
+
+# --- Configuration ---
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "20"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_BACKOFF_BASE_SECONDS = float(os.getenv("HTTP_BACKOFF_BASE_SECONDS", "0.25"))
+HTTP_BACKOFF_MAX_SECONDS = float(os.getenv("HTTP_BACKOFF_MAX_SECONDS", "4"))
+# Retries may use at most this fraction of recent request volume per host, so an
+# unhealthy upstream does not get hit with a retry storm.
+HTTP_RETRY_BUDGET_RATIO = float(os.getenv("HTTP_RETRY_BUDGET_RATIO", "0.2"))
+HTTP_DEFAULT_TIMEOUT = (5, 20)  # (connect, read) seconds
+# Per-host timeouts, overridable with e.g. HTTP_HOST_TIMEOUTS='{"api.fda.gov": [5, 30]}'
+HOST_TIMEOUTS = {
+    "clinicaltrials.gov": (5, 20),
+    "api.fda.gov": (5, 20),
+}
+HOST_TIMEOUTS.update({host: tuple(value) if isinstance(value, list) else value for host, value in json.loads(os.getenv("HTTP_HOST_TIMEOUTS", "{}")).items()})
+
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+class HostCircuitOpen(CircuitOpenError, requests.exceptions.ConnectionError):
+    """Raised by get() without a request while the host's circuit breaker is open."""
+
+
+class AsyncHostCircuitOpen(CircuitOpenError, httpx.ConnectError):
+    """Raised by aget() without a request while the host's circuit breaker is open."""
+
+
+class RetryBudget:
+    """Token bucket credited by every request and debited by every retry."""
+
+    def __init__(self, ratio=HTTP_RETRY_BUDGET_RATIO, min_tokens=3.0, max_tokens=20.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = min_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock: self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1: return False
+            self.tokens -= 1; return True
+
+
+_sessions = {}
+_async_clients = {}
+_budgets = {}
+_lock = threading.Lock()
+
+
+def _budget(host):
+    # Caller holds _lock. Sync and async clients for a host draw on the same budget.
+    budget = _budgets.get(host)
+    if budget is None: budget = _budgets[host] = RetryBudget()
+    return budget
+
+
+def _host_state(host):
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount("https://", adapter); session.mount("http://", adapter)
+            _sessions[host] = session
+        return session, _budget(host)
+
+
+def _async_host_state(host):
+    with _lock:
+        client = _async_clients.get(host)
+        if client is None:
+            limits = httpx.Limits(max_connections=HTTP_POOL_MAXSIZE, max_keepalive_connections=HTTP_POOL_MAXSIZE)
+            client = _async_clients[host] = httpx.AsyncClient(limits=limits)
+        return client, _budget(host)
+
+
+def _httpx_timeout(timeout):
+    if isinstance(timeout, tuple): return httpx.Timeout(timeout[1], connect=timeout[0])
+    return httpx.Timeout(timeout)
+
+
+def _backoff_delay(attempt):
+    # Full jitter: spreads retries from concurrent workers instead of aligning them.
+    return random.uniform(0, min(HTTP_BACKOFF_MAX_SECONDS, HTTP_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+def _healthy(response):
+    return response.status_code < 500 and response.status_code != 429
+
+
+def get(url, timeout=None, **kwargs):
+    """
+    GET through a keep-alive, connection-pooled session for the URL's host.
+    Retries connection failures and 429/5xx gateway responses with jittered backoff
+    while the host's retry budget allows. Raises requests exceptions like requests.get;
+    HostCircuitOpen (a ConnectionError) at once while the host's circuit breaker is open.
+    """
+    host = urlsplit(url).hostname or ""
+    breaker = circuit_breaker(host)
+    if not breaker.allow(): raise HostCircuitOpen(f"{host} is unavailable (circuit open)")
+    started = time.monotonic()
+    try: response = _get(host, url, timeout, **kwargs)
+    except requests.exceptions.RequestException: breaker.record(False); raise
+    breaker.record(_healthy(response), time.monotonic() - started)
+    return response
+
+
+def _get(host, url, timeout, **kwargs):
+    session, budget = _host_state(host)
+    if timeout is None: timeout = HOST_TIMEOUTS.get(host, HTTP_DEFAULT_TIMEOUT)
+    budget.deposit()
+    attempt = 0
+    while True:
+        try:
+            response = session.get(url, timeout=timeout, **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= HTTP_MAX_RETRIES or not budget.withdraw():
+                return response
+            print(f"HTTP {response.status_code} from {host}, retrying (attempt {attempt + 1})")
+        except requests.exceptions.ConnectionError as e:  # includes ConnectTimeout; read timeouts are not retried
+            if attempt >= HTTP_MAX_RETRIES or not budget.withdraw(): raise
+            print(f"HTTP error from {host}, retrying (attempt {attempt + 1}): {e}")
+        time.sleep(_backoff_delay(attempt))
+        attempt += 1
+
+
+async def aget(url, timeout=None, **kwargs):
+    """
+    Async counterpart of get() on a pooled httpx.AsyncClient per host, with the same
+    retry policy, budget and circuit breaker. Raises httpx exceptions (httpx.HTTPError
+    subclasses; AsyncHostCircuitOpen is an httpx.ConnectError).
+    """
+    host = urlsplit(url).hostname or ""
+    breaker = circuit_breaker(host)
+    if not breaker.allow(): raise AsyncHostCircuitOpen(f"{host} is unavailable (circuit open)")
+    started = time.monotonic()
+    try: response = await _aget(host, url, timeout, **kwargs)
+    except httpx.HTTPError: breaker.record(False); raise
+    breaker.record(_healthy(response), time.monotonic() - started)
+    return response
+
+
+async def _aget(host, url, timeout, **kwargs):
+    client, budget = _async_host_state(host)
+    if timeout is None: timeout = HOST_TIMEOUTS.get(host, HTTP_DEFAULT_TIMEOUT)
+    budget.deposit()
+    attempt = 0
+    while True:
+        try:
+            response = await client.get(url, timeout=_httpx_timeout(timeout), **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= HTTP_MAX_RETRIES or not budget.withdraw():
+                return response
+            print(f"HTTP {response.status_code} from {host}, retrying (attempt {attempt + 1})")
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:  # read timeouts are not retried
+            if attempt >= HTTP_MAX_RETRIES or not budget.withdraw(): raise
+            print(f"HTTP error from {host}, retrying (attempt {attempt + 1}): {e}")
+        await asyncio.sleep(_backoff_delay(attempt))
+        attempt += 1
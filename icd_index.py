@@ -0,0 +1,215 @@
+import argparse
+import bisect
+import gzip
+import os
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+# --- Configuration ---
+# Code table: "CODE<TAB>description" (optionally .gz), or a CMS icd10cm_codes/icd10cm_order file.
+# Missing table = post-processing is skipped and LLM codes pass through unchanged.
+ICD10CM_TABLE_PATH = os.getenv("ICD10CM_TABLE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "icd10cm_codes.tsv.gz"))
+ICD_VALIDATION_ENABLED = os.getenv("ICD_VALIDATION_ENABLED", "1") == "1"
+ICD_EXPANSION_LIMIT = int(os.getenv("ICD_EXPANSION_LIMIT", "100"))  # Max codes one wildcard/range entry may expand to
+ICD10CM_PRELOAD = os.getenv("ICD10CM_PRELOAD", "1") == "1"  # Load the table in the background at import, not on the first request
+
+_CODE = r"[A-Z]\d[0-9A-Z](?:\.?[0-9A-Z]{1,4})?"
+_CODE_RE = re.compile(rf"^({_CODE})")
+_RANGE_RE = re.compile(rf"^({_CODE})\s*[-–—]\s*({_CODE})$")
+_WILDCARD_RE = re.compile(r"^([A-Z]\d[0-9A-Z](?:\.?[0-9A-Z]{1,3})?)\.?(?:[X*]+|-)$")
+_ORDER_LINE_RE = re.compile(r"^\d{5} ([A-Z0-9]{3,7})\s+[01] (.{60}) (.*)$")
+
+
+def _undotted(code):
+    return code.replace(".", "")
+
+
+def _dotted(code):
+    return f"{code[:3]}.{code[3:]}" if len(code) > 3 else code
+
+
+def without_code_descriptions(node):
+    """Copy of insights JSON minus the "ICDCodeDescriptions" maps: they are for the client, and would only inflate a prompt."""
+    if isinstance(node, dict): return {key: without_code_descriptions(value) for key, value in node.items() if key != "ICDCodeDescriptions"}
+    if isinstance(node, list): return [without_code_descriptions(item) for item in node]
+    return node
+
+
+class ICD10CMIndex:
+    """
+    In-process ICD-10-CM code index: a sorted array of undotted codes (prefix and range queries by
+    bisection) plus descriptions. Used to validate, expand and describe codes in LLM insights JSON.
+    """
+
+    def __init__(self, table_path=ICD10CM_TABLE_PATH):
+        self.table_path = table_path
+        self._codes = None  # sorted undotted codes
+        self._descriptions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self._load())
+
+    def _load(self):
+        if self._codes is None:
+            with self._lock:
+                if self._codes is None:
+                    descriptions = {}
+                    if self.table_path and os.path.exists(self.table_path):
+                        start_time = time.time()
+                        try:
+                            opener = gzip.open if self.table_path.endswith(".gz") else open
+                            with opener(self.table_path, "rt", encoding="utf-8") as table:
+                                for line in table:
+                                    line = line.rstrip("\r\n")
+                                    order_match = _ORDER_LINE_RE.match(line)
+                                    if order_match: code, description = order_match.group(1), order_match.group(3) or order_match.group(2).strip()
+                                    elif "\t" in line: code, description = line.split("\t", 1)
+                                    else: code, _, description = line.partition(" ")
+                                    code = _undotted(code.strip().upper())
+                                    if code: descriptions[code] = description.strip()
+                            print(f"ICD-10-CM index: {len(descriptions)} codes from {self.table_path} ({(time.time() - start_time) * 1000:.0f} ms)")
+                        except (OSError, UnicodeDecodeError) as e: print(f"ICD-10-CM table unreadable ({self.table_path}): {e}"); descriptions = {}
+                    else: print(f"ICD-10-CM table not found ({self.table_path}); code validation disabled")
+                    self._descriptions = descriptions
+                    self._codes = sorted(descriptions)
+        return self._codes
+
+    def __len__(self):
+        return len(self._load())
+
+    def items(self):
+        """(undotted code, description) pairs for every listed code."""
+        self._load(); return self._descriptions.items()
+
+    def _prefixed(self, prefix):
+        """Slice bounds of the codes starting with prefix."""
+        codes = self._load()
+        return bisect.bisect_left(codes, prefix), bisect.bisect_left(codes, prefix + "\x7f")
+
+    def describe(self, code):
+        self._load(); return self._descriptions.get(_undotted(code.upper()))
+
+    def is_valid(self, code):
+        """True for a listed code or any category/subcategory prefix of one (e.g. "E11", "I48.1")."""
+        start, end = self._prefixed(_undotted(code.upper()))
+        return end > start
+
+    def children(self, prefix):
+        """Immediate next-level codes under prefix ("I48" -> I48.0, I48.1, ...)."""
+        prefix = _undotted(prefix); start, end = self._prefixed(prefix); codes = self._codes
+        return list(dict.fromkeys(codes[i][:len(prefix) + 1] for i in range(start, end) if len(codes[i]) > len(prefix)))
+
+    def expand_range(self, low, high):
+        """Codes between low and high (inclusive, children of high included) at the endpoints' level."""
+        low = _undotted(low); high = _undotted(high); level = min(len(low), len(high)); codes = self._load()
+        start = bisect.bisect_left(codes, low[:level]); end = bisect.bisect_left(codes, high[:level] + "\x7f")
+        return list(dict.fromkeys(codes[i][:level] for i in range(start, end)))
+
+    def resolve(self, entry):
+        """
+        (codes, status) for one ICDCodes entry: status is "valid", "expanded" (wildcard/range),
+        "too_broad" (a wildcard/range over ICD_EXPANSION_LIMIT codes, kept as written rather than
+        cut to a partial list) or "invalid" (codes empty). Codes are returned dotted.
+        """
+        text = re.sub(r"\s+", " ", str(entry).strip().upper()).rstrip(".")
+        range_match = _RANGE_RE.match(text)
+        if range_match:
+            expanded = self.expand_range(range_match.group(1), range_match.group(2))
+            if len(expanded) > ICD_EXPANSION_LIMIT: return [text], "too_broad"
+            return [_dotted(c) for c in expanded], "expanded" if expanded else "invalid"
+        compact = text.replace(" ", "")
+        if re.fullmatch(_CODE, compact) and self.is_valid(compact): return [_dotted(_undotted(compact))], "valid"
+        wildcard_match = _WILDCARD_RE.match(compact)
+        if wildcard_match and self.is_valid(wildcard_match.group(1)):
+            expanded = self.children(wildcard_match.group(1)) or [_undotted(wildcard_match.group(1))]
+            if len(expanded) > ICD_EXPANSION_LIMIT: return [text], "too_broad"
+            return [_dotted(c) for c in expanded], "expanded"
+        code_match = _CODE_RE.match(text)  # "I10 - Essential hypertension"
+        if code_match and self.is_valid(code_match.group(1)): return [_dotted(_undotted(code_match.group(1)))], "valid"
+        return [], "invalid"
+
+    def clean_insights(self, insights):
+        """
+        Validates every "ICDCodes" list in the insights JSON in place: wildcards and ranges expanded
+        (kept as written when broader than ICD_EXPANSION_LIMIT), invalid codes dropped, duplicates
+        removed, and an "ICDCodeDescriptions" map added alongside.
+        Returns (insights, stats); stats is None when the index is unavailable or disabled.
+        """
+        if not ICD_VALIDATION_ENABLED or not isinstance(insights, dict) or "raw_llm_output" in insights or not self.enabled: return insights, None
+        start_time = time.perf_counter()
+        stats = {"checked": 0, "valid": 0, "expanded": 0, "too_broad": 0, "dropped": []}
+
+        def visit(node):
+            if isinstance(node, list):
+                for item in node: visit(item)
+                return
+            if not isinstance(node, dict): return
+            for key, value in list(node.items()):
+                if key == "ICDCodes" and isinstance(value, list):
+                    cleaned = []
+                    for entry in value:
+                        codes, status = self.resolve(entry); stats["checked"] += 1
+                        if status == "invalid": stats["dropped"].append(str(entry)); continue
+                        stats[status] += 1; cleaned.extend(codes)
+                    node["ICDCodes"] = list(dict.fromkeys(cleaned))
+                    node["ICDCodeDescriptions"] = {code: self._descriptions.get(_undotted(code), "") for code in node["ICDCodes"]}
+                else: visit(value)
+
+        visit(insights)
+        stats["duration_ms"] = round((time.perf_counter() - start_time) * 1000, 3)
+        return insights, stats
+
+
+def build_table_from_tabular_xml(xml_path, out_path):
+    """
+    Writes a "CODE<TAB>description" table from the CMS ICD-10-CM tabular XML: every category and
+    subcategory, plus the 7th-character extensions defined by <sevenChrDef> (padded with X).
+    """
+    rows = []
+
+    def walk(diag, seventh):
+        name = diag.findtext("name"); description = diag.findtext("desc") or ""
+        definition = diag.find("sevenChrDef")
+        if definition is not None: seventh = [(extension.get("char"), extension.text or "") for extension in definition.findall("extension")]
+        rows.append((name, description))
+        children = diag.findall("diag")
+        for child in children: walk(child, seventh)
+        if seventh and not children:
+            base = _undotted(name).ljust(6, "X")
+            for char, extension_description in seventh: rows.append((_dotted(base + char), f"{description}, {extension_description}"))
+
+    for diag in ET.parse(xml_path).getroot().iter("section"):
+        for top in diag.findall("diag"): walk(top, None)
+    opener = gzip.open if out_path.endswith(".gz") else open
+    with opener(out_path, "wt", encoding="utf-8", newline="\n") as out:
+        for code, description in rows: out.write(f"{code}\t{description}\n")
+    return len(rows)
+
+
+icd10cm_index = ICD10CMIndex()
+
+if ICD10CM_PRELOAD and ICD_VALIDATION_ENABLED and __name__ != "__main__":
+    threading.Thread(target=icd10cm_index._load, name="icd10cm-load", daemon=True).start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local ICD-10-CM code index.")
+    parser.add_argument("--table", default=ICD10CM_TABLE_PATH, help="Code table path (default: $ICD10CM_TABLE_PATH)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build-table", help="Generate the code table from the CMS tabular XML")
+    build_parser.add_argument("xml_path")
+    lookup_parser = subparsers.add_parser("lookup", help="Resolve codes, wildcards (I48.x) or ranges (C00-C14)")
+    lookup_parser.add_argument("entries", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "build-table": print(f"{build_table_from_tabular_xml(args.xml_path, args.table)} codes written to {args.table}")
+    else:
+        index = ICD10CMIndex(args.table)
+        for entry in args.entries:
+            start_time = time.perf_counter(); codes, status = index.resolve(entry); elapsed = (time.perf_counter() - start_time) * 1e6
+            print(f"{entry}: {status} ({elapsed:.0f} us)")
+            for code in codes: print(f"  {code}\t{index.describe(code) or ''}")
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# --- Configuration ---
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_DB_PATH = os.getenv("LLM_CACHE_DB_PATH", os.path.join(tempfile.gettempdir(), "dasaapp_llm_cache.sqlite3"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+def make_key(rendered_prompt, deployment, temperature, prompt_version):
+    """Content address of an LLM call: identical inputs map to the same cached response."""
+    payload = json.dumps([prompt_version, deployment, float(temperature), rendered_prompt], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Persistent SQLite cache of LLM completions keyed by make_key().
+    Shared by every worker on the host; least recently used rows are evicted
+    once the stored responses exceed max_bytes.
+    """
+
+    def __init__(self, db_path=LLM_CACHE_DB_PATH, max_bytes=LLM_CACHE_MAX_BYTES, enabled=LLM_CACHE_ENABLED):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._local = threading.local()
+        if self.enabled:
+            try: self._create_schema(self._connection())
+            except sqlite3.Error as e: print(f"LLM response cache disabled ({self.db_path}): {e}"); self.enabled = False
+
+    def _create_schema(self, conn):
+        """Tables plus triggers that keep the running total of stored bytes, so eviction never scans the table."""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS llm_responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_responses_last_access ON llm_responses (last_access)")
+            conn.execute("CREATE TABLE IF NOT EXISTS llm_cache_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO llm_cache_meta SELECT 'total_size', COALESCE(SUM(size), 0) FROM llm_responses")  # Caches created before the running total
+            conn.execute("CREATE TRIGGER IF NOT EXISTS llm_responses_insert AFTER INSERT ON llm_responses BEGIN UPDATE llm_cache_meta SET value = value + NEW.size WHERE key = 'total_size'; END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS llm_responses_update AFTER UPDATE OF size ON llm_responses BEGIN UPDATE llm_cache_meta SET value = value + NEW.size - OLD.size WHERE key = 'total_size'; END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS llm_responses_delete AFTER DELETE ON llm_responses BEGIN UPDATE llm_cache_meta SET value = value - OLD.size WHERE key = 'total_size'; END")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK"); raise
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        if not self.enabled: return None
+        try:
+            conn = self._connection()
+            row = conn.execute("SELECT response FROM llm_responses WHERE key = ?", (key,)).fetchone()
+            if row is None: return None
+            conn.execute("UPDATE llm_responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+        except sqlite3.Error as e: print(f"LLM cache read error: {e}"); return None
+
+    def set(self, key, response):
+        if not self.enabled or not isinstance(response, str): return
+        now = time.time(); size = len(response.encode("utf-8"))
+        try:
+            conn = self._connection()
+            # An upsert, not INSERT OR REPLACE: REPLACE's implicit delete would not fire the size trigger.
+            conn.execute("INSERT INTO llm_responses (key, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET response = excluded.response, size = excluded.size, created_at = excluded.created_at, last_access = excluded.last_access", (key, response, size, now, now))
+            self._evict(conn)
+        except sqlite3.Error as e: print(f"LLM cache write error: {e}")
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT value FROM llm_cache_meta WHERE key = 'total_size'").fetchone()[0]
+        if total <= self.max_bytes: return
+        # Walk rows oldest-access first until enough bytes are freed.
+        excess = total - self.max_bytes; freed = 0; stale_keys = []
+        cursor = conn.execute("SELECT key, size FROM llm_responses ORDER BY last_access ASC")
+        for key, size in cursor:
+            stale_keys.append((key,)); freed += size
+            if freed >= excess: break
+        cursor.close()
+        conn.executemany("DELETE FROM llm_responses WHERE key = ?", stale_keys)
+
+
+llm_cache = LLMResponseCache()
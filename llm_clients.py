@@ -0,0 +1,435 @@
+import asyncio
+import operator
+import os
+import random
+import threading
+import time
+from functools import reduce
+
+import httpx
+import openai
+from langchain_core.messages import AIMessageChunk
+from langchain_openai import AzureChatOpenAI
+
+from circuit_breaker import CircuitOpenError
+from llm_cache import llm_cache, make_key
+from llm_hedging import LLM_HEDGE_DEPLOYMENT, ahedged_stream, hedge_cancelled, hedge_policies, hedged_stream, track_response
+from llm_rate_limiter import RateLimitTimeout, azure_rate_limiter
+from llm_router import DEPLOYMENTS, deployment_breaker, llm_router
+from llm_schemas import schema_report
+from prompt_compaction import count_tokens
+from single_flight import llm_calls
+
+# --- Configuration ---
+AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "https://ciaiaiservices.openai.azure.com/")
+AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY", "817dce22f5a548b8b11fe0b6a3cf2c36") # Replace or set env var
+AZURE_DEPLOYMENT_NAME = os.getenv("AZURE_DEPLOYMENT_NAME", "gpt-35-turbo-0613")
+AZURE_API_VERSION = "2024-05-01-preview"
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_HTTP_POOL_MAXSIZE = int(os.getenv("LLM_HTTP_POOL_MAXSIZE", "32"))
+LLM_HTTP_KEEPALIVE_SECONDS = float(os.getenv("LLM_HTTP_KEEPALIVE_SECONDS", "300"))
+LLM_POOL_WARMUP = os.getenv("LLM_POOL_WARMUP", "1") == "1"
+# How an output_schema reaches the model: "tools" (forced function call; gpt-35-turbo-0613 and later),
+# "json_schema" (response_format; needs gpt-4o-2024-08-06+ and API version 2024-08-01-preview+),
+# or "off" (the prompt's prose instructions only).
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "tools")
+LLM_DEFAULT_COMPLETION_TOKENS = int(os.getenv("LLM_DEFAULT_COMPLETION_TOKENS", "1000"))  # Tokens/min estimate for calls without max_tokens
+# With the rate limiter on, 429/5xx retries queue behind it again instead of running the SDK's own retry loop in lockstep.
+_SDK_MAX_RETRIES = 0 if azure_rate_limiter.enabled else LLM_MAX_RETRIES
+_LIMITER_RETRIES = LLM_MAX_RETRIES - _SDK_MAX_RETRIES
+_RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+_FAILOVER_ERRORS = (openai.APIError, RateLimitTimeout, CircuitOpenError)  # A routed stage moves on to its next deployment after these
+
+# --- Check if Config is Set ---
+if AZURE_OPENAI_API_KEY == "YOUR_API_KEY_HERE":
+    print("Warning: AZURE_OPENAI_API_KEY is not set via environment variable. Using placeholder.")
+if not AZURE_OPENAI_ENDPOINT or not AZURE_DEPLOYMENT_NAME:
+     raise ValueError("Azure OpenAI Endpoint and Deployment Name must be configured.")
+
+# One keep-alive connection pool per process, shared by every client in the registry.
+_http_limits = httpx.Limits(max_connections=LLM_HTTP_POOL_MAXSIZE, max_keepalive_connections=LLM_HTTP_POOL_MAXSIZE, keepalive_expiry=LLM_HTTP_KEEPALIVE_SECONDS)
+# Every Azure response (429s and x-ratelimit headers included) feeds the shared rate limiter; sync ones are
+# also tracked so a hedged call that loses its race can be aborted mid-read.
+_http_client = httpx.Client(limits=_http_limits, timeout=LLM_REQUEST_TIMEOUT, event_hooks={"response": [azure_rate_limiter.observe_response, track_response]})
+_http_async_client = httpx.AsyncClient(limits=_http_limits, timeout=LLM_REQUEST_TIMEOUT, event_hooks={"response": [azure_rate_limiter.aobserve_response]})
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_llm(deployment=AZURE_DEPLOYMENT_NAME, temperature=0.0):
+    """
+    Returns the process-wide AzureChatOpenAI client for (deployment, temperature),
+    building it on first use. Clients are stateless per call and safe to share across threads.
+    Deployments listed in llm_router.DEPLOYMENTS may use their own endpoint, key and API version.
+    """
+    key = (deployment, float(temperature))
+    llm = _clients.get(key)
+    if llm is not None: return llm
+    with _lock:
+        llm = _clients.get(key)
+        if llm is None:
+            spec = DEPLOYMENTS.get(deployment, {})
+            api_key = os.getenv(spec["api_key_env"], AZURE_OPENAI_API_KEY) if spec.get("api_key_env") else AZURE_OPENAI_API_KEY
+            try: llm = AzureChatOpenAI(api_key=api_key, api_version=spec.get("api_version", AZURE_API_VERSION), azure_endpoint=spec.get("endpoint", AZURE_OPENAI_ENDPOINT), deployment_name=deployment, temperature=temperature, max_retries=_SDK_MAX_RETRIES, request_timeout=LLM_REQUEST_TIMEOUT, http_client=_http_client, http_async_client=_http_async_client)
+            except Exception as e: print(f"Error initializing LLM: {e}"); raise
+            _clients[key] = llm
+        return llm
+
+
+def _bind_output(llm, output_schema, max_tokens):
+    """llm with the structured-output request and max_tokens limit bound for one call."""
+    kwargs = {"max_tokens": max_tokens} if max_tokens else {}
+    if output_schema and LLM_STRUCTURED_OUTPUT == "tools":
+        name = output_schema["title"]
+        kwargs.update(tools=[{"type": "function", "function": {"name": name, "description": output_schema.get("description", ""), "parameters": output_schema}}],
+                      tool_choice={"type": "function", "function": {"name": name}})
+    elif output_schema and LLM_STRUCTURED_OUTPUT == "json_schema":
+        kwargs["response_format"] = {"type": "json_schema", "json_schema": {"name": output_schema["title"], "schema": output_schema, "strict": False}}
+    return llm.bind(**kwargs) if kwargs else llm
+
+
+def _cache_version(prompt_version, output_schema, max_tokens):
+    """prompt_version extended with the output mode, so structured and prose responses are cached apart."""
+    if not output_schema and not max_tokens: return prompt_version
+    return f"{prompt_version}|{LLM_STRUCTURED_OUTPUT if output_schema else 'off'}:{output_schema['title'] if output_schema else ''}|max_tokens={max_tokens}"
+
+
+def _message_text(message):
+    """Completion text of a message or chunk: the forced function call's arguments in "tools" mode, else the content."""
+    tool_call_chunks = getattr(message, "tool_call_chunks", None)
+    if tool_call_chunks: return "".join(chunk.get("args") or "" for chunk in tool_call_chunks)
+    tool_calls = message.additional_kwargs.get("tool_calls")
+    if tool_calls: return tool_calls[0]["function"]["arguments"]
+    return message.content
+
+
+def _lane(prompt_version):
+    """Prompt family of a version string ("insight" for "insight-v3"): the rate limiter lane and hedging policy key."""
+    return prompt_version.rsplit("-v", 1)[0]
+
+
+def _admission(llm, rendered_prompt, prompt_version, max_tokens):
+    """(deployment, estimated tokens, lane) for the rate limiter."""
+    return llm.deployment_name, count_tokens(rendered_prompt) + (max_tokens or LLM_DEFAULT_COMPLETION_TOKENS), _lane(prompt_version)
+
+
+def _retry_delay(error, attempt):
+    # A 429 already paused the deployment in the limiter (retry-after); other failures back off with full jitter.
+    return 0.0 if isinstance(error, openai.RateLimitError) else random.uniform(0, min(8.0, 0.5 * 2 ** attempt))
+
+
+def _invoke(llm, bound, rendered_prompt, prompt_version, max_tokens):
+    """bound.invoke() once the rate limiter admits it; retryable failures queue again."""
+    deployment, tokens, lane = _admission(llm, rendered_prompt, prompt_version, max_tokens)
+    for attempt in range(_LIMITER_RETRIES + 1):
+        azure_rate_limiter.acquire(deployment, tokens, lane)
+        try: return bound.invoke(rendered_prompt)
+        except _RETRYABLE_ERRORS as e:
+            if attempt >= _LIMITER_RETRIES: raise
+            print(f"LLM {lane} call failed ({type(e).__name__}), retry {attempt + 1}/{_LIMITER_RETRIES}")
+            time.sleep(_retry_delay(e, attempt))
+
+
+def _stream(llm, bound, rendered_prompt, prompt_version, max_tokens):
+    """bound.stream() behind the rate limiter; retried only while no chunk has been yielded."""
+    deployment, tokens, lane = _admission(llm, rendered_prompt, prompt_version, max_tokens)
+    for attempt in range(_LIMITER_RETRIES + 1):
+        azure_rate_limiter.acquire(deployment, tokens, lane)
+        started = False
+        try:
+            for message_chunk in bound.stream(rendered_prompt): started = True; yield message_chunk
+            return
+        except _RETRYABLE_ERRORS as e:
+            if started or attempt >= _LIMITER_RETRIES or hedge_cancelled(): raise
+            print(f"LLM {lane} stream failed ({type(e).__name__}), retry {attempt + 1}/{_LIMITER_RETRIES}")
+            time.sleep(_retry_delay(e, attempt))
+
+
+async def _ainvoke(llm, bound, rendered_prompt, prompt_version, max_tokens):
+    deployment, tokens, lane = _admission(llm, rendered_prompt, prompt_version, max_tokens)
+    for attempt in range(_LIMITER_RETRIES + 1):
+        await azure_rate_limiter.aacquire(deployment, tokens, lane)
+        try: return await bound.ainvoke(rendered_prompt)
+        except _RETRYABLE_ERRORS as e:
+            if attempt >= _LIMITER_RETRIES: raise
+            print(f"LLM {lane} call failed ({type(e).__name__}), retry {attempt + 1}/{_LIMITER_RETRIES}")
+            await asyncio.sleep(_retry_delay(e, attempt))
+
+
+async def _astream(llm, bound, rendered_prompt, prompt_version, max_tokens):
+    deployment, tokens, lane = _admission(llm, rendered_prompt, prompt_version, max_tokens)
+    for attempt in range(_LIMITER_RETRIES + 1):
+        await azure_rate_limiter.aacquire(deployment, tokens, lane)
+        started = False
+        try:
+            async for message_chunk in bound.astream(rendered_prompt): started = True; yield message_chunk
+            return
+        except _RETRYABLE_ERRORS as e:
+            if started or attempt >= _LIMITER_RETRIES: raise
+            print(f"LLM {lane} stream failed ({type(e).__name__}), retry {attempt + 1}/{_LIMITER_RETRIES}")
+            await asyncio.sleep(_retry_delay(e, attempt))
+
+
+def _hedge_llm(llm, prompt_version, tokens, output_schema):
+    """Routed stages hedge to their next-best other deployment; others to LLM_HEDGE_DEPLOYMENT or the same one."""
+    stage = _lane(prompt_version)
+    if llm_router.routed(stage):
+        deployment = llm_router.choose(stage, tokens, _structured_output(output_schema), exclude={llm.deployment_name})
+        if deployment: return get_llm(deployment, llm.temperature)
+    return get_llm(LLM_HEDGE_DEPLOYMENT, llm.temperature) if LLM_HEDGE_DEPLOYMENT else llm
+
+
+def _hedge_admission(llm, output_schema, max_tokens, rendered_prompt, prompt_version):
+    """(hedge llm, deployment, tokens) for the hedged duplicate of a call."""
+    hedge_llm = _hedge_llm(llm, prompt_version, _admission(llm, rendered_prompt, prompt_version, max_tokens)[1], output_schema)
+    deployment, tokens, _ = _admission(hedge_llm, rendered_prompt, prompt_version, max_tokens)
+    return hedge_llm, deployment, tokens
+
+
+def _hedge(llm, output_schema, max_tokens, rendered_prompt, prompt_version):
+    """The hedged duplicate's chunk iterator, or None when the rate limiter has no quota to spare for it."""
+    hedge_llm, deployment, tokens = _hedge_admission(llm, output_schema, max_tokens, rendered_prompt, prompt_version)
+    if not azure_rate_limiter.try_acquire(deployment, tokens): return None
+    return _bind_output(hedge_llm, output_schema, max_tokens).stream(rendered_prompt)
+
+
+async def _ahedge(llm, output_schema, max_tokens, rendered_prompt, prompt_version):
+    hedge_llm, deployment, tokens = _hedge_admission(llm, output_schema, max_tokens, rendered_prompt, prompt_version)
+    if not await azure_rate_limiter.atry_acquire(deployment, tokens): return None
+    return _bind_output(hedge_llm, output_schema, max_tokens).astream(rendered_prompt)
+
+
+def _completion_stream(llm, output_schema, max_tokens, rendered_prompt, prompt_version, first_chunk_wins=True):
+    """Message chunks of one completion, hedged when the prompt family has a policy (llm_hedging.LLM_HEDGE_LANES)."""
+    bound = _bind_output(llm, output_schema, max_tokens)
+    policy = hedge_policies.get(_lane(prompt_version))
+    if policy is None: return _stream(llm, bound, rendered_prompt, prompt_version, max_tokens)
+    return hedged_stream(policy, lambda: _stream(llm, bound, rendered_prompt, prompt_version, max_tokens),
+                         lambda: _hedge(llm, output_schema, max_tokens, rendered_prompt, prompt_version), first_chunk_wins)
+
+
+def _acompletion_stream(llm, output_schema, max_tokens, rendered_prompt, prompt_version, first_chunk_wins=True):
+    bound = _bind_output(llm, output_schema, max_tokens)
+    policy = hedge_policies.get(_lane(prompt_version))
+    if policy is None: return _astream(llm, bound, rendered_prompt, prompt_version, max_tokens)
+    return ahedged_stream(policy, lambda: _astream(llm, bound, rendered_prompt, prompt_version, max_tokens),
+                          lambda: _ahedge(llm, output_schema, max_tokens, rendered_prompt, prompt_version), first_chunk_wins)
+
+
+def _structured_output(output_schema):
+    return LLM_STRUCTURED_OUTPUT if output_schema and LLM_STRUCTURED_OUTPUT != "off" else None
+
+
+class _Route:
+    """Deployment choice for one LLM call: the stage's best deployment (llm_router), or the chain's own llm when the stage has no route."""
+
+    def __init__(self, llm, prompt_version, rendered_prompt, output_schema, max_tokens):
+        self.base = llm
+        self.stage = _lane(prompt_version)
+        self.routed = llm_router.routed(self.stage)
+        self.tokens = _admission(llm, rendered_prompt, prompt_version, max_tokens)[1]
+        self.structured_output = _structured_output(output_schema)
+        self.tried = set()
+        self.llm = (self._next() if self.routed else None) or llm  # No candidate fits the call: the chain's own deployment
+
+    def _next(self):
+        deployment = llm_router.choose(self.stage, self.tokens, self.structured_output, exclude=self.tried)
+        return get_llm(deployment, self.base.temperature) if deployment else None
+
+    def admit(self):
+        """Raises CircuitOpenError while the chosen deployment's circuit breaker is open."""
+        deployment_breaker(self.llm.deployment_name).check()
+
+    def succeeded(self, started):
+        deployment_breaker(self.llm.deployment_name).record(True, time.monotonic() - started)
+        if self.routed: llm_router.record(self.stage, self.llm.deployment_name, time.monotonic() - started, ok=True)
+
+    def fail_over(self, error, started, yielded=False):
+        """Records the failure; True when the call should be repeated on self.llm, now the next-best deployment."""
+        # Only outages count against the breaker; a 400 (content filter, bad schema) still means the deployment answered.
+        if isinstance(error, openai.APIError): deployment_breaker(self.llm.deployment_name).record(not isinstance(error, _RETRYABLE_ERRORS), time.monotonic() - started)
+        if not self.routed: return False
+        llm_router.record(self.stage, self.llm.deployment_name, time.monotonic() - started, ok=False); self.tried.add(self.llm.deployment_name)
+        next_llm = None if yielded else self._next()
+        if next_llm is None: return False
+        print(f"LLM {self.stage}: {self.llm.deployment_name} failed ({type(error).__name__}); failing over to {next_llm.deployment_name}")
+        self.llm = next_llm
+        return True
+
+
+def _with_failover(llm, prompt_version, rendered_prompt, output_schema, max_tokens, call):
+    """call(llm) on the stage's chosen deployment, failing over to the next one on an API error."""
+    route = _Route(llm, prompt_version, rendered_prompt, output_schema, max_tokens)
+    while True:
+        started = time.monotonic()
+        try: route.admit(); result = call(route.llm)
+        except _FAILOVER_ERRORS as e:
+            if route.fail_over(e, started): continue
+            raise
+        route.succeeded(started)
+        return result
+
+
+async def _awith_failover(llm, prompt_version, rendered_prompt, output_schema, max_tokens, call):
+    route = _Route(llm, prompt_version, rendered_prompt, output_schema, max_tokens)
+    while True:
+        started = time.monotonic()
+        try: route.admit(); result = await call(route.llm)
+        except _FAILOVER_ERRORS as e:
+            if route.fail_over(e, started): continue
+            raise
+        route.succeeded(started)
+        return result
+
+
+def _stream_with_failover(llm, prompt_version, rendered_prompt, output_schema, max_tokens, stream):
+    """Streaming counterpart of _with_failover(): fails over only while no chunk has been yielded."""
+    route = _Route(llm, prompt_version, rendered_prompt, output_schema, max_tokens)
+    while True:
+        started = time.monotonic(); yielded = False
+        try:
+            route.admit()
+            for message_chunk in stream(route.llm): yielded = True; yield message_chunk
+        except _FAILOVER_ERRORS as e:
+            if route.fail_over(e, started, yielded): continue
+            raise
+        route.succeeded(started)
+        return
+
+
+async def _astream_with_failover(llm, prompt_version, rendered_prompt, output_schema, max_tokens, stream):
+    route = _Route(llm, prompt_version, rendered_prompt, output_schema, max_tokens)
+    while True:
+        started = time.monotonic(); yielded = False
+        try:
+            route.admit()
+            async for message_chunk in stream(route.llm): yielded = True; yield message_chunk
+        except _FAILOVER_ERRORS as e:
+            if route.fail_over(e, started, yielded): continue
+            raise
+        route.succeeded(started)
+        return
+
+
+def _cache_key(chain, rendered_prompt, prompt_version, output_schema, max_tokens):
+    """LLM cache key; a routed stage's responses are keyed by its route, so any of its deployments can serve a hit."""
+    stage = _lane(prompt_version)
+    deployment = llm_router.route_key(stage) if llm_router.routed(stage) else chain.llm.deployment_name
+    return make_key(rendered_prompt, deployment, chain.llm.temperature, _cache_version(prompt_version, output_schema, max_tokens))
+
+
+def _check_output(output, output_schema, prompt_version, finish_reason=None):
+    """True when output may be cached: it did not hit max_tokens and (with a schema) validates."""
+    if finish_reason == "length": print(f"LLM output hit max_tokens ({prompt_version}); not cached")
+    if not output_schema: return finish_reason != "length"
+    report = schema_report(output, output_schema)
+    if not report["valid"]: print(f"LLM output failed {report['schema']} schema ({prompt_version}); not cached: {'; '.join(report['errors'][:3])}")
+    return report["valid"] and finish_reason != "length"
+
+
+def run_chain(chain, prompt_version, bypass_cache=False, output_schema=None, max_tokens=None, **variables):
+    """
+    Runs an LLMChain's prompt through the persistent response cache. The cache key covers the
+    rendered prompt, deployment, temperature, prompt_version and output mode, so bump the version
+    whenever a template or its post-processing changes meaning. With output_schema the model is
+    asked for schema-conforming JSON (LLM_STRUCTURED_OUTPUT) and the response is validated on
+    receipt; invalid or max_tokens-truncated responses are returned but not cached.
+    Identical concurrent calls share one completion (single_flight.llm_calls). In a hedged prompt
+    family the call is streamed so a slow first token can trigger a duplicate; the first to finish wins.
+    """
+    rendered_prompt = chain.prompt.format(**variables)
+    key = _cache_key(chain, rendered_prompt, prompt_version, output_schema, max_tokens)
+    if not bypass_cache:
+        cached = llm_cache.get(key)
+        if cached is not None: print(f"LLM cache hit ({prompt_version})"); return cached
+
+    def call(llm):
+        if _lane(prompt_version) in hedge_policies: return reduce(operator.add, _completion_stream(llm, output_schema, max_tokens, rendered_prompt, prompt_version, first_chunk_wins=False), AIMessageChunk(content=""))
+        return _invoke(llm, _bind_output(llm, output_schema, max_tokens), rendered_prompt, prompt_version, max_tokens)
+
+    def complete():
+        message = _with_failover(chain.llm, prompt_version, rendered_prompt, output_schema, max_tokens, call)
+        output = _message_text(message)
+        if _check_output(output, output_schema, prompt_version, message.response_metadata.get("finish_reason")): llm_cache.set(key, output)
+        return output
+    return llm_calls.do(key, complete, recheck=None if bypass_cache else lambda: llm_cache.get(key))
+
+
+def stream_chain(chain, prompt_version, bypass_cache=False, output_schema=None, max_tokens=None, **variables):
+    """
+    Streaming counterpart of run_chain(): yields completion text chunks as they arrive.
+    A cache hit is yielded as a single chunk; a completed, valid stream is written to the cache.
+    """
+    rendered_prompt = chain.prompt.format(**variables)
+    key = _cache_key(chain, rendered_prompt, prompt_version, output_schema, max_tokens)
+    if not bypass_cache:
+        cached = llm_cache.get(key)
+        if cached is not None: print(f"LLM cache hit ({prompt_version})"); yield cached; return
+    chunks = []; finish_reason = None
+    for message_chunk in _stream_with_failover(chain.llm, prompt_version, rendered_prompt, output_schema, max_tokens, lambda llm: _completion_stream(llm, output_schema, max_tokens, rendered_prompt, prompt_version)):
+        finish_reason = message_chunk.response_metadata.get("finish_reason") or finish_reason
+        text = _message_text(message_chunk)
+        if text: chunks.append(text); yield text
+    output = "".join(chunks)
+    if _check_output(output, output_schema, prompt_version, finish_reason): llm_cache.set(key, output)
+
+
+async def arun_chain(chain, prompt_version, bypass_cache=False, output_schema=None, max_tokens=None, **variables):
+    """Async counterpart of run_chain(); the LLM call is awaited on the shared async pool."""
+    rendered_prompt = chain.prompt.format(**variables)
+    key = _cache_key(chain, rendered_prompt, prompt_version, output_schema, max_tokens)
+    if not bypass_cache:
+        cached = await asyncio.to_thread(llm_cache.get, key)
+        if cached is not None: print(f"LLM cache hit ({prompt_version})"); return cached
+
+    async def call(llm):
+        if _lane(prompt_version) in hedge_policies:
+            message = AIMessageChunk(content="")
+            async for message_chunk in _acompletion_stream(llm, output_schema, max_tokens, rendered_prompt, prompt_version, first_chunk_wins=False): message += message_chunk
+            return message
+        return await _ainvoke(llm, _bind_output(llm, output_schema, max_tokens), rendered_prompt, prompt_version, max_tokens)
+
+    async def complete():
+        message = await _awith_failover(chain.llm, prompt_version, rendered_prompt, output_schema, max_tokens, call)
+        output = _message_text(message)
+        if _check_output(output, output_schema, prompt_version, message.response_metadata.get("finish_reason")): await asyncio.to_thread(llm_cache.set, key, output)
+        return output
+
+    async def recheck(): return await asyncio.to_thread(llm_cache.get, key)
+    return await llm_calls.ado(key, complete, recheck=None if bypass_cache else recheck)
+
+
+async def astream_chain(chain, prompt_version, bypass_cache=False, output_schema=None, max_tokens=None, **variables):
+    """Async counterpart of stream_chain()."""
+    rendered_prompt = chain.prompt.format(**variables)
+    key = _cache_key(chain, rendered_prompt, prompt_version, output_schema, max_tokens)
+    if not bypass_cache:
+        cached = await asyncio.to_thread(llm_cache.get, key)
+        if cached is not None: print(f"LLM cache hit ({prompt_version})"); yield cached; return
+    chunks = []; finish_reason = None
+    async for message_chunk in _astream_with_failover(chain.llm, prompt_version, rendered_prompt, output_schema, max_tokens, lambda llm: _acompletion_stream(llm, output_schema, max_tokens, rendered_prompt, prompt_version)):
+        finish_reason = message_chunk.response_metadata.get("finish_reason") or finish_reason
+        text = _message_text(message_chunk)
+        if text: chunks.append(text); yield text
+    output = "".join(chunks)
+    if _check_output(output, output_schema, prompt_version, finish_reason): await asyncio.to_thread(llm_cache.set, key, output)
+
+
+_warm_up_lock = threading.Lock(); _warmed_up = False
+
+def warm_up():
+    """
+    Opens a TLS connection to the Azure endpoint in a daemon thread so the first LLM call skips the handshake.
+    Called from app startup; runs once per process and only when LLM_POOL_WARMUP is on.
+    """
+    global _warmed_up
+    if not LLM_POOL_WARMUP or _warmed_up: return
+    with _warm_up_lock:
+        if _warmed_up: return
+        _warmed_up = True
+    def _connect():
+        try: _http_client.get(AZURE_OPENAI_ENDPOINT, timeout=10)
+        except httpx.HTTPError as e: print(f"LLM connection pool warm-up failed: {e}")
+    threading.Thread(target=_connect, name="llm-pool-warmup", daemon=True).start()
@@ -0,0 +1,229 @@
+import asyncio
+import contextvars
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from collections import deque
+
+# --- Configuration ---
+# Prompt families whose LLM calls may be hedged, comma-separated (e.g. "insight"). Empty = hedging off.
+LLM_HEDGE_LANES = [lane.strip() for lane in os.getenv("LLM_HEDGE_LANES", "").split(",") if lane.strip()]
+# Deployment that receives the duplicate call; empty = the primary's own deployment.
+LLM_HEDGE_DEPLOYMENT = os.getenv("LLM_HEDGE_DEPLOYMENT", "")
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))  # Hedge calls slower to first token than this share of recent calls
+LLM_HEDGE_MAX_RATE = float(os.getenv("LLM_HEDGE_MAX_RATE", "0.05"))  # At most this fraction of a family's recent calls are hedged
+# Per-family overrides of the rate cap, e.g. LLM_HEDGE_MAX_RATES='{"insight": 0.1}'
+HEDGE_MAX_RATES = json.loads(os.getenv("LLM_HEDGE_MAX_RATES", "{}"))
+LLM_HEDGE_WINDOW = int(os.getenv("LLM_HEDGE_WINDOW", "200"))  # Recent calls the percentile and the rate cap look at
+LLM_HEDGE_MIN_SAMPLES = 20  # Below this the fixed initial delay is used
+LLM_HEDGE_INITIAL_DELAY = float(os.getenv("LLM_HEDGE_INITIAL_DELAY", "30"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2"))
+LLM_HEDGE_MAX_DELAY = float(os.getenv("LLM_HEDGE_MAX_DELAY", "45"))
+
+_runner = contextvars.ContextVar("llm_hedge_runner", default=None)
+
+
+class HedgePolicy:
+    """
+    When to send a duplicate of a slow LLM call for one prompt family. The hedge delay is the
+    LLM_HEDGE_PERCENTILE of the family's recent first-token latencies, and hedges are capped at
+    max_rate of its recent calls so the extra spend stays bounded.
+    """
+
+    def __init__(self, lane, percentile=LLM_HEDGE_PERCENTILE, max_rate=LLM_HEDGE_MAX_RATE):
+        self.lane = lane
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._latencies = deque(maxlen=LLM_HEDGE_WINDOW)  # primary first-token seconds (a lower bound when it was cancelled first)
+        self._hedged = deque(maxlen=LLM_HEDGE_WINDOW)  # per recent call: whether it was hedged
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """Seconds to wait for the primary's first token before hedging."""
+        with self._lock: latencies = sorted(self._latencies)
+        if len(latencies) < LLM_HEDGE_MIN_SAMPLES: return LLM_HEDGE_INITIAL_DELAY
+        return min(LLM_HEDGE_MAX_DELAY, max(LLM_HEDGE_MIN_DELAY, latencies[int(self.percentile / 100 * (len(latencies) - 1))]))
+
+    def allow(self):
+        """True while the family's recent hedge count is under its budget (always at least one)."""
+        with self._lock: return sum(self._hedged) < max(1.0, self.max_rate * len(self._hedged))
+
+    def record(self, primary_latency, hedged, hedge_won):
+        with self._lock:
+            if primary_latency is not None: self._latencies.append(primary_latency)
+            self._hedged.append(hedged)
+            self.hedges += hedged; self.hedge_wins += hedge_won
+
+
+hedge_policies = {lane: HedgePolicy(lane, max_rate=float(HEDGE_MAX_RATES.get(lane, LLM_HEDGE_MAX_RATE))) for lane in LLM_HEDGE_LANES}
+
+
+class _Race:
+    """Bookkeeping shared by hedged_stream() and ahedged_stream(): who started when, who produced what."""
+
+    def __init__(self, policy, first_chunk_wins):
+        self.policy = policy
+        self.first_chunk_wins = first_chunk_wins
+        self.start = time.monotonic()
+        self.first_chunk_at = [None, None]
+        self.chunks = [[], []]
+        self.running = {0}
+        self.hedge_started = False
+        self.winner = None
+
+    def on_chunk(self, index, chunk):
+        """Chunks to pass on now. In first-chunk mode the first runner to produce one wins; otherwise chunks are held until a runner finishes."""
+        if self.first_chunk_at[index] is None: self.first_chunk_at[index] = time.monotonic()
+        if self.winner is None and self.first_chunk_wins: self.winner = index
+        if self.winner == index: return [chunk]
+        if self.winner is None: self.chunks[index].append(chunk)
+        return []
+
+    def on_done(self, index):
+        """Held chunks to pass on when index finished first, else []."""
+        self.running.discard(index)
+        if self.winner is None: self.winner = index; return self.chunks[index]
+        return []
+
+    def on_error(self, index, error):
+        """Re-raises unless the other runner can still win."""
+        self.running.discard(index)
+        if self.winner == index or not self.running: raise error
+        print(f"LLM {self.policy.lane} {'hedge' if index else 'primary'} failed ({type(error).__name__}); waiting for the {'primary' if index else 'hedge'}")
+
+    def start_hedge(self):
+        self.hedge_started = True; self.running.add(1)
+
+    def finish(self):
+        hedged = self.hedge_started
+        primary_latency = self.first_chunk_at[0] - self.start if self.first_chunk_at[0] is not None else time.monotonic() - self.start
+        self.policy.record(primary_latency, hedged, hedged and self.winner == 1)
+        if hedged: print(f"LLM {self.policy.lane} call hedged; {'hedge' if self.winner == 1 else 'primary'} won")
+
+
+class _Runner:
+    """One side of a sync race: its thread's in-flight HTTP response, so the other side can abort it."""
+
+    def __init__(self):
+        self.response = None
+        self.cancelled = threading.Event()
+
+    def abort(self):
+        """Stops the runner now: shutting its socket down wakes a read blocked waiting for the first token."""
+        self.cancelled.set(); response = self.response
+        if response is None or response.is_closed: return
+        stream = response.extensions.get("network_stream")
+        sock = stream.get_extra_info("socket") if stream is not None else None
+        try:
+            if sock is not None: sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+
+def track_response(response):
+    """httpx response hook for the sync LLM client: lets hedged_stream() abort the loser's response."""
+    runner = _runner.get()
+    if runner is None: return
+    runner.response = response
+    if runner.cancelled.is_set(): runner.abort()  # Lost while the request was in flight
+
+
+def hedge_cancelled():
+    """True inside a sync race runner that has lost (its failures must not be retried)."""
+    runner = _runner.get()
+    return runner is not None and runner.cancelled.is_set()
+
+
+def _run(index, chunks, events, runner):
+    _runner.set(runner)
+    try:
+        for chunk in chunks:
+            if runner.cancelled.is_set(): break
+            events.put((index, "chunk", chunk))
+        else: events.put((index, "done", None))
+    except Exception as e: events.put((index, "error", e))
+    finally:
+        close = getattr(chunks, "close", None)
+        if close: close()
+
+
+def hedged_stream(policy, primary, hedge, first_chunk_wins=True):
+    """
+    Yields the chunks of primary() (a chunk iterator factory). If it has produced nothing after
+    policy.delay() and the budget allows, hedge() is started as well (it returns None when the
+    duplicate cannot be sent). With first_chunk_wins the first runner to produce a chunk is
+    streamed; otherwise the first to finish wins. The loser's HTTP response is aborted (requires
+    track_response() on the client) and its chunk iterator closed.
+    """
+    race = _Race(policy, first_chunk_wins); events = queue.Queue(); runners = [_Runner(), _Runner()]
+    threading.Thread(target=_run, args=(0, primary(), events, runners[0]), name=f"llm-{policy.lane}-primary", daemon=True).start()
+    hedge_at = race.start + policy.delay()
+    try:
+        while True:
+            try: index, kind, value = events.get(timeout=None if hedge_at is None else max(0.0, hedge_at - time.monotonic()))
+            except queue.Empty:
+                hedge_at = None
+                hedge_chunks = hedge() if policy.allow() else None
+                if hedge_chunks is not None:
+                    race.start_hedge()
+                    threading.Thread(target=_run, args=(1, hedge_chunks, events, runners[1]), name=f"llm-{policy.lane}-hedge", daemon=True).start()
+                continue
+            if race.winner is not None and index != race.winner: continue
+            if kind == "chunk": passed = race.on_chunk(index, value)
+            elif kind == "done": passed = race.on_done(index)
+            else: race.on_error(index, value); continue
+            if race.winner is not None and not runners[1 - race.winner].cancelled.is_set(): runners[1 - race.winner].abort()
+            if race.first_chunk_at[0] is not None: hedge_at = None  # The primary is producing; no hedge
+            yield from passed
+            if kind == "done" and index == race.winner: return
+    finally:
+        for runner in runners: runner.abort()
+        race.finish()
+
+
+async def _arun(index, chunks, events):
+    try:
+        async for chunk in chunks: await events.put((index, "chunk", chunk))
+        await events.put((index, "done", None))
+    except asyncio.CancelledError: raise
+    except Exception as e: await events.put((index, "error", e))
+    finally:
+        aclose = getattr(chunks, "aclose", None)
+        if aclose: await aclose()
+
+
+async def ahedged_stream(policy, primary, hedge, first_chunk_wins=True):
+    """
+    Async counterpart of hedged_stream(): primary() returns an async iterator and hedge() is a
+    coroutine function resolving to one (or None). The loser's task is cancelled, which
+    interrupts its pending read and closes its iterator and response.
+    """
+    race = _Race(policy, first_chunk_wins); events = asyncio.Queue()
+    tasks = [asyncio.create_task(_arun(0, primary(), events)), None]
+    hedge_at = race.start + policy.delay()
+    try:
+        while True:
+            try: index, kind, value = await asyncio.wait_for(events.get(), None if hedge_at is None else max(0.0, hedge_at - time.monotonic()))
+            except asyncio.TimeoutError:
+                hedge_at = None
+                hedge_chunks = await hedge() if policy.allow() else None
+                if hedge_chunks is not None:
+                    race.start_hedge()
+                    tasks[1] = asyncio.create_task(_arun(1, hedge_chunks, events))
+                continue
+            if race.winner is not None and index != race.winner: continue
+            if kind == "chunk": passed = race.on_chunk(index, value)
+            elif kind == "done": passed = race.on_done(index)
+            else: race.on_error(index, value); continue
+            if race.winner is not None and tasks[1 - race.winner] is not None: tasks[1 - race.winner].cancel()
+            if race.first_chunk_at[0] is not None: hedge_at = None
+            for chunk in passed: yield chunk
+            if kind == "done" and index == race.winner: return
+    finally:
+        for task in tasks:
+            if task is not None: task.cancel()
+        race.finish()
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+
+# --- Configuration ---
+# Shared by every worker on the host so their combined traffic stays under the deployment quota.
+LLM_RATE_LIMIT_DB_PATH = os.getenv("LLM_RATE_LIMIT_DB_PATH", os.path.join(tempfile.gettempdir(), "dasaapp_llm_rate_limit.sqlite3"))
+# Set to the deployment quota (Azure portal -> Quotas). 0 = that dimension is not limited client-side
+# (429 responses still pause the deployment). With no limit configured at all the limiter is off, and
+# retries stay with the OpenAI SDK.
+AZURE_RPM_LIMIT = int(os.getenv("AZURE_RPM_LIMIT", "0"))
+AZURE_TPM_LIMIT = int(os.getenv("AZURE_TPM_LIMIT", "0"))
+# Per-deployment overrides, e.g. AZURE_DEPLOYMENT_LIMITS='{"gpt-4o": [450, 75000]}' ([rpm, tpm])
+DEPLOYMENT_LIMITS = {name: tuple(value) for name, value in json.loads(os.getenv("AZURE_DEPLOYMENT_LIMITS", "{}")).items()}
+LLM_RATE_LIMIT_ENABLED = os.getenv("LLM_RATE_LIMIT_ENABLED", "1") == "1" and bool(AZURE_RPM_LIMIT or AZURE_TPM_LIMIT or any(any(limits) for limits in DEPLOYMENT_LIMITS.values()))
+LLM_RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("LLM_RATE_LIMIT_MAX_WAIT_SECONDS", "120"))  # Longest a call queues before failing
+# Azure enforces quotas over ~10 s windows, so the buckets hold 10 seconds' worth rather than a full minute.
+BURST_SECONDS = 10
+MIN_RATE_SCALE = 0.1  # Floor for the 429-adapted fraction of the configured limits
+RATE_DECREASE_FACTOR = 0.7  # Multiplicative decrease per 429 ...
+RATE_INCREASE_STEP = 0.02  # ... additive increase per successful call
+DEFAULT_RETRY_AFTER_SECONDS = 2.0
+_TURN_POLL_SECONDS = 0.05
+
+_DEPLOYMENT_RE = re.compile(r"/deployments/([^/]+)/")
+
+
+class RateLimitTimeout(Exception):
+    """An LLM call waited longer than LLM_RATE_LIMIT_MAX_WAIT_SECONDS for quota."""
+
+
+class AzureRateLimiter:
+    """
+    Client-side requests/min and tokens/min budget per Azure OpenAI deployment. Token buckets live
+    in SQLite so all workers on a host share them; 429 responses pause the deployment for the
+    retry-after period and scale the refill rate down (AIMD), successes scale it back up. Waiting
+    calls are admitted round-robin across lanes (one per prompt family), FIFO within a lane.
+    """
+
+    def __init__(self, db_path=LLM_RATE_LIMIT_DB_PATH, enabled=LLM_RATE_LIMIT_ENABLED):
+        self.db_path = db_path
+        self.enabled = enabled and bool(db_path)
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._lanes = {}  # deployment -> OrderedDict(lane -> deque of waiting tickets)
+        self._next_lane = {}  # deployment -> lane index served next
+        self._queued = {}  # deployment -> waiting tickets across lanes (read without the lock by wait_estimate)
+        self._snapshots = {}  # deployment -> bucket state as of this worker's last transaction (for wait_estimate)
+        if self.enabled:
+            try: self._connection().execute("CREATE TABLE IF NOT EXISTS llm_rate_buckets (deployment TEXT PRIMARY KEY, requests REAL NOT NULL, tokens REAL NOT NULL, updated_at REAL NOT NULL, scale REAL NOT NULL, blocked_until REAL NOT NULL)")
+            except sqlite3.Error as e: print(f"LLM rate limiter disabled ({self.db_path}): {e}"); self.enabled = False
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    # --- Shared buckets ---
+    @staticmethod
+    def limits(deployment):
+        return DEPLOYMENT_LIMITS.get(deployment, (AZURE_RPM_LIMIT, AZURE_TPM_LIMIT))
+
+    def _refill(self, deployment, saved, now):
+        """saved bucket state (None = never used) refilled up to now."""
+        rpm, tpm = self.limits(deployment)
+        if saved is None: return {"requests": rpm * BURST_SECONDS / 60, "tokens": tpm * BURST_SECONDS / 60, "scale": 1.0, "blocked_until": 0.0}
+        elapsed = max(0.0, now - saved["updated_at"]); scale = saved["scale"]
+        return {"requests": min(rpm * BURST_SECONDS / 60, saved["requests"] + elapsed * rpm * scale / 60),
+                "tokens": min(tpm * BURST_SECONDS / 60, saved["tokens"] + elapsed * tpm * scale / 60), "scale": scale, "blocked_until": saved["blocked_until"]}
+
+    def _state(self, conn, deployment, now):
+        """The deployment's bucket state refilled up to now."""
+        row = conn.execute("SELECT requests, tokens, updated_at, scale, blocked_until FROM llm_rate_buckets WHERE deployment = ?", (deployment,)).fetchone()
+        return self._refill(deployment, row and dict(zip(("requests", "tokens", "updated_at", "scale", "blocked_until"), row)), now)
+
+    def _update(self, deployment, change):
+        """Runs change(state, now) -> result on the deployment's refilled bucket state inside one write transaction."""
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            state = self._state(conn, deployment, now)
+            result = change(state, now)
+            conn.execute("INSERT OR REPLACE INTO llm_rate_buckets VALUES (?, ?, ?, ?, ?, ?)", (deployment, state["requests"], state["tokens"], now, state["scale"], state["blocked_until"]))
+            conn.execute("COMMIT")
+            self._snapshots[deployment] = dict(state, updated_at=now)
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK"); raise
+
+    def _wait(self, deployment, state, now, tokens):
+        """Seconds until state can admit one call of `tokens` (0 = now)."""
+        rpm, tpm = self.limits(deployment)
+        if now < state["blocked_until"]: return state["blocked_until"] - now
+        need_tokens = min(tokens, tpm * BURST_SECONDS / 60)  # A call bigger than the bucket goes through once it is full
+        waits = [0.0]
+        if rpm and state["requests"] < 1: waits.append((1 - state["requests"]) * 60 / (rpm * state["scale"]))
+        if tpm and state["tokens"] < need_tokens: waits.append((need_tokens - state["tokens"]) * 60 / (tpm * state["scale"]))
+        return max(waits)
+
+    def _take(self, deployment, tokens):
+        """Debits one request and `tokens` when both buckets allow; returns 0, or the seconds until they will."""
+        rpm, tpm = self.limits(deployment)
+
+        def take(state, now):
+            wait = self._wait(deployment, state, now, tokens)
+            if wait: return wait
+            if rpm: state["requests"] -= 1
+            if tpm: state["tokens"] -= min(tokens, tpm * BURST_SECONDS / 60)
+            return 0.0
+        return self._update(deployment, take)
+
+    def wait_estimate(self, deployment, tokens):
+        """
+        Estimate of how long a call of `tokens` would queue for the deployment (for routing). Works from
+        the bucket as this worker last saw it, so it never touches SQLite and is safe on the event loop.
+        """
+        if not self.enabled: return 0.0
+        rpm, _ = self.limits(deployment); now = time.time()
+        state = self._refill(deployment, self._snapshots.get(deployment), now)
+        queued = self._queued.get(deployment, 0)
+        return self._wait(deployment, state, now, tokens) + (queued * 60 / (rpm * state["scale"]) if rpm else 0.0)
+
+    def record_response(self, deployment, status_code, headers):
+        """Adapts the deployment's budget from an Azure response (status plus x-ratelimit/retry-after headers)."""
+        if not self.enabled: return
+        remaining_requests = headers.get("x-ratelimit-remaining-requests"); remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+
+        def adapt(state, now):
+            if status_code == 429:
+                retry_after_ms = headers.get("retry-after-ms"); retry_after = headers.get("retry-after")
+                try: delay = float(retry_after_ms) / 1000 if retry_after_ms else float(retry_after) if retry_after else DEFAULT_RETRY_AFTER_SECONDS
+                except ValueError: delay = DEFAULT_RETRY_AFTER_SECONDS
+                state["blocked_until"] = max(state["blocked_until"], now + delay)
+                state["scale"] = max(MIN_RATE_SCALE, state["scale"] * RATE_DECREASE_FACTOR)
+                print(f"Azure 429 for {deployment}: paused {delay:.1f}s, rate scale {state['scale']:.2f}")
+            elif status_code < 400: state["scale"] = min(1.0, state["scale"] + RATE_INCREASE_STEP)
+            # The server's own view of the quota window (covers traffic from other hosts).
+            if remaining_requests and remaining_requests.isdigit(): state["requests"] = min(state["requests"], float(remaining_requests))
+            if remaining_tokens and remaining_tokens.isdigit(): state["tokens"] = min(state["tokens"], float(remaining_tokens))
+        try: self._update(deployment, adapt)
+        except sqlite3.Error as e: print(f"LLM rate limiter write error: {e}")
+
+    def observe_response(self, response):
+        """httpx response event hook for the Azure OpenAI client pool."""
+        match = _DEPLOYMENT_RE.search(response.request.url.path)
+        if match: self.record_response(match.group(1), response.status_code, response.headers)
+
+    async def aobserve_response(self, response):
+        await asyncio.to_thread(self.observe_response, response)
+
+    # --- Fair admission ---
+    def _enqueue(self, deployment, lane):
+        ticket = object()
+        self._lanes.setdefault(deployment, OrderedDict()).setdefault(lane, deque()).append(ticket)
+        self._queued[deployment] = self._queued.get(deployment, 0) + 1
+        return ticket
+
+    def _dequeue(self, deployment, lane, ticket):
+        queue = self._lanes[deployment][lane]
+        if ticket in queue: queue.remove(ticket); self._queued[deployment] -= 1
+        self._cond.notify_all()
+
+    def _attempt(self, deployment, lane, ticket, tokens):
+        """(granted, seconds to wait before trying again). Only the ticket whose turn it is may draw on the bucket."""
+        lanes = self._lanes[deployment]; names = list(lanes); start = self._next_lane.get(deployment, 0) % len(names)
+        turn_lane = next(name for name in names[start:] + names[:start] if lanes[name])
+        if turn_lane != lane or lanes[lane][0] is not ticket: return False, _TURN_POLL_SECONDS
+        try: wait = self._take(deployment, tokens)
+        except sqlite3.Error as e: print(f"LLM rate limiter read error, admitting call: {e}"); wait = 0.0
+        if wait: return False, wait
+        lanes[lane].popleft(); self._queued[deployment] -= 1; self._next_lane[deployment] = names.index(lane) + 1
+        self._cond.notify_all()
+        return True, 0.0
+
+    def acquire(self, deployment, tokens, lane="default"):
+        """Blocks until the call may be sent; raises RateLimitTimeout after LLM_RATE_LIMIT_MAX_WAIT_SECONDS."""
+        if not self.enabled: return
+        deadline = time.monotonic() + LLM_RATE_LIMIT_MAX_WAIT_SECONDS
+        with self._cond:
+            ticket = self._enqueue(deployment, lane)
+            try:
+                while True:
+                    granted, wait = self._attempt(deployment, lane, ticket, tokens)
+                    if granted: return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0: raise RateLimitTimeout(f"No Azure OpenAI quota for {deployment} within {LLM_RATE_LIMIT_MAX_WAIT_SECONDS:.0f}s")
+                    self._cond.wait(min(wait, remaining))
+            finally: self._dequeue(deployment, lane, ticket)
+
+    def try_acquire(self, deployment, tokens):
+        """Non-blocking admission for optional calls (hedges): True only when nobody is queued and quota is free now."""
+        if not self.enabled: return True
+        with self._cond:
+            if any(self._lanes.get(deployment, {}).values()): return False
+            try: return not self._take(deployment, tokens)
+            except sqlite3.Error as e: print(f"LLM rate limiter read error: {e}"); return False
+
+    async def atry_acquire(self, deployment, tokens):
+        """Async counterpart of try_acquire(); the lock and the SQLite transaction run in a worker thread."""
+        if not self.enabled: return True
+        return await asyncio.to_thread(self.try_acquire, deployment, tokens)
+
+    def _locked(self, method, *args):
+        with self._cond: return method(*args)
+
+    async def aacquire(self, deployment, tokens, lane="default"):
+        """Async counterpart of acquire(); the lock and the SQLite transaction run in a worker thread, waits use asyncio.sleep."""
+        if not self.enabled: return
+        deadline = time.monotonic() + LLM_RATE_LIMIT_MAX_WAIT_SECONDS
+        ticket = await asyncio.to_thread(self._locked, self._enqueue, deployment, lane)
+        try:
+            while True:
+                granted, wait = await asyncio.to_thread(self._locked, self._attempt, deployment, lane, ticket, tokens)
+                if granted: return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: raise RateLimitTimeout(f"No Azure OpenAI quota for {deployment} within {LLM_RATE_LIMIT_MAX_WAIT_SECONDS:.0f}s")
+                await asyncio.sleep(min(wait, remaining))
+        finally: await asyncio.to_thread(self._locked, self._dequeue, deployment, lane, ticket)
+
+azure_rate_limiter = AzureRateLimiter()
@@ -0,0 +1,104 @@
+import json
+import os
+import random
+import threading
+import time
+
+from circuit_breaker import circuit_breaker
+from llm_rate_limiter import azure_rate_limiter
+
+# --- Configuration ---
+# Extra Azure OpenAI deployments, keyed by deployment name (unique across endpoints). Omitted fields
+# fall back to the AZURE_OPENAI_* settings; context_tokens/structured_output describe what the model can do:
+# LLM_DEPLOYMENTS='{"gpt-4o-mini": {"endpoint": "https://eastus.openai.azure.com/", "api_key_env": "AZURE_OPENAI_API_KEY_EASTUS",
+#                   "api_version": "2024-08-01-preview", "context_tokens": 128000, "structured_output": ["tools", "json_schema"]}}'
+DEPLOYMENTS = json.loads(os.getenv("LLM_DEPLOYMENTS", "{}"))
+# Candidate deployments per pipeline stage (prompt family: "fetch-summary", "insight", "insight-summary"),
+# most preferred first. Stages without a route use the chain's own deployment.
+# LLM_ROUTES='{"fetch-summary": ["gpt-4o-mini"], "insight": ["gpt-4o", "gpt-4o-eastus"], "insight-summary": ["gpt-4o-mini", "gpt-4o"]}'
+ROUTES = json.loads(os.getenv("LLM_ROUTES", "{}"))
+LLM_ROUTER_EWMA_ALPHA = float(os.getenv("LLM_ROUTER_EWMA_ALPHA", "0.2"))
+LLM_ROUTER_MAX_ERROR_RATE = float(os.getenv("LLM_ROUTER_MAX_ERROR_RATE", "0.5"))  # Error EWMA above which a deployment is skipped ...
+LLM_ROUTER_COOLDOWN_SECONDS = float(os.getenv("LLM_ROUTER_COOLDOWN_SECONDS", "30"))  # ... until this long after its last failure
+LLM_ROUTER_SPREAD = float(os.getenv("LLM_ROUTER_SPREAD", "0.2"))  # Candidates within this fraction of the best score share the traffic
+
+
+def deployment_breaker(deployment):
+    """Circuit breaker for one Azure OpenAI deployment."""
+    return circuit_breaker(f"azure-openai:{deployment}")
+
+
+class _Health:
+    __slots__ = ("latency", "errors", "calls", "last_failure")
+
+    def __init__(self):
+        self.latency = None  # EWMA seconds per successful call
+        self.errors = 0.0  # EWMA failure rate
+        self.calls = 0
+        self.last_failure = 0.0
+
+
+class DeploymentRouter:
+    """
+    Picks the Azure OpenAI deployment for each LLM call of a routed stage: candidates that cannot
+    serve the call (context size, structured-output mode) are dropped, recently failing ones and
+    those with an open circuit breaker sit out, and the rest are scored by latency EWMA plus expected rate-limiter queueing,
+    inflated by the error EWMA. Near-best candidates share the load; failures fail over in order.
+    """
+
+    def __init__(self, routes=ROUTES, deployments=DEPLOYMENTS, limiter=azure_rate_limiter):
+        self.routes = routes
+        self.deployments = deployments
+        self.limiter = limiter
+        self._health = {}  # (stage, deployment) -> _Health
+        self._lock = threading.Lock()
+
+    def routed(self, stage):
+        return bool(self.routes.get(stage))
+
+    def route_key(self, stage):
+        """Stable name for the stage's route, used in place of the deployment in LLM cache keys."""
+        return "route:" + ",".join(self.routes[stage])
+
+    def _health_of(self, stage, deployment):
+        key = (stage, deployment)
+        health = self._health.get(key)
+        if health is None:
+            with self._lock: health = self._health.setdefault(key, _Health())
+        return health
+
+    def can_serve(self, deployment, tokens, structured_output=None):
+        """Whether deployment meets a call's requirements: tokens within its context, its structured-output mode supported."""
+        spec = self.deployments.get(deployment, {})
+        if spec.get("context_tokens") and tokens > spec["context_tokens"]: return False
+        if structured_output and "structured_output" in spec and structured_output not in spec["structured_output"]: return False
+        return True
+
+    def choose(self, stage, tokens, structured_output=None, exclude=()):
+        """Deployment for the next call of stage (None when no untried candidate can serve it)."""
+        candidates = [d for d in self.routes.get(stage, ()) if d not in exclude and self.can_serve(d, tokens, structured_output)]
+        if not candidates: return None
+        now = time.time()
+        healthy = [d for d in candidates if deployment_breaker(d).available() and not (self._health_of(stage, d).errors > LLM_ROUTER_MAX_ERROR_RATE and now - self._health_of(stage, d).last_failure < LLM_ROUTER_COOLDOWN_SECONDS)]
+        candidates = healthy or candidates  # All unhealthy: still try, best first
+        known = [self._health_of(stage, d).latency for d in candidates if self._health_of(stage, d).latency is not None]
+        scores = {}
+        for deployment in candidates:
+            health = self._health_of(stage, deployment)
+            # An untried deployment is assumed as fast as the best known one, so it gets explored.
+            latency = health.latency if health.latency is not None else min(known, default=0.0)
+            scores[deployment] = (latency + self.limiter.wait_estimate(deployment, tokens)) / max(0.05, 1 - health.errors)
+        best = min(scores.values())
+        return random.choice([d for d in candidates if scores[d] <= best * (1 + LLM_ROUTER_SPREAD)])
+
+    def record(self, stage, deployment, seconds, ok):
+        """Feeds one call's outcome into the (stage, deployment) EWMAs."""
+        health = self._health_of(stage, deployment); alpha = LLM_ROUTER_EWMA_ALPHA
+        with self._lock:
+            health.calls += 1
+            health.errors = health.errors * (1 - alpha) + (0.0 if ok else alpha)
+            if ok: health.latency = seconds if health.latency is None else health.latency * (1 - alpha) + seconds * alpha
+            else: health.last_failure = time.time()
+
+
+llm_router = DeploymentRouter()
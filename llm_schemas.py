@@ -0,0 +1,110 @@
+import re
+
+from streaming_json import parse_llm_json
+
+# JSON Schemas for the three LLM responses, taken from the example structures in the prompts.
+# Sent to the model as the function/response_format schema (llm_clients) and checked on receipt.
+# Extra keys are allowed wherever the app adds its own (ICDCodeDescriptions, the demographic fields).
+
+MAX_SCHEMA_ERRORS = 20
+
+_TEXT = {"type": "string"}
+_CODES = {"type": "array", "items": {"type": "string"}, "maxItems": 200}
+_DESCRIBED = {"type": "object", "properties": {"Description": _TEXT}, "required": ["Description"]}
+_CODE_GROUP_MAP = {
+    "type": "object",
+    "patternProperties": {"^Group[0-9]+$": {"type": "object", "properties": {"GroupName": _TEXT, "GroupDescription": _TEXT, "ICDCodes": _CODES}, "required": ["GroupName", "GroupDescription", "ICDCodes"]}},
+    "additionalProperties": False,
+    "maxProperties": 8,
+}
+_CODE_GROUP_LIST = {"type": "array", "items": {"type": "object", "properties": {"Group": _TEXT, "GroupName": _TEXT, "ICDCodes": _CODES}, "required": ["Group", "GroupName", "ICDCodes"]}}
+
+FETCH_SUMMARY_SCHEMA = {
+    "title": "market_definition_summary",
+    "description": "Market definition summary of one clinical trial.",
+    "type": "object",
+    "properties": {"MarketDefinitionSummary": {
+        "type": "object",
+        "properties": {
+            "BroadMarketDefinition": {"type": "object", "properties": {"Description": _TEXT, "ICDCodes": _CODES}, "required": ["Description", "ICDCodes"]},
+            "AddressableMarketDefinition": _DESCRIBED,
+            "PatientAttributes": {"type": "object", "properties": {"AgeRange": _TEXT, "SubGroups": {"type": "array", "items": _TEXT}, "Gender": _TEXT, "ASAClassICDCodes": _CODES}, "required": ["AgeRange", "SubGroups", "Gender", "ASAClassICDCodes"]},
+            "ExclusionICDCodes": _CODES,
+        },
+        "required": ["BroadMarketDefinition", "AddressableMarketDefinition", "PatientAttributes", "ExclusionICDCodes"],
+    }},
+    "required": ["MarketDefinitionSummary"],
+}
+
+INSIGHT_SCHEMA = {
+    "title": "trial_insights",
+    "description": "ICD-10 based market definition insights for one clinical trial.",
+    "type": "object",
+    "properties": {
+        "BroadMarketDefinition": {"type": "object", "properties": {"BroadMarketDescription": _TEXT, "ICDCodes": _CODES}, "required": ["BroadMarketDescription", "ICDCodes"]},
+        "AddressableMarketDefinition": _TEXT,
+        "AddressableMarketCriteriaByPatientAttribute": {"type": "object", "properties": {"AdditionalICDCodesRequired": _CODE_GROUP_MAP, "ICDCodesToExclude": _CODE_GROUP_MAP}, "required": ["AdditionalICDCodesRequired", "ICDCodesToExclude"]},
+    },
+    "required": ["BroadMarketDefinition", "AddressableMarketDefinition", "AddressableMarketCriteriaByPatientAttribute"],
+}
+
+INSIGHT_SUMMARY_SCHEMA = {
+    "title": "insight_summary",
+    "description": "Summary of the market definition insights of one clinical trial.",
+    "type": "object",
+    "properties": {"MarketDefinitionSummary": {
+        "type": "object",
+        "properties": {
+            "BroadMarketDefinition": {"type": "object", "properties": {"Description": _TEXT, "ICDCodes": _CODES}, "required": ["Description", "ICDCodes"]},
+            "AddressableMarketDefinition": _DESCRIBED,
+            "PatientAttributes": {"type": "object", "properties": {"AgeRange": _TEXT, "AgeGroups": {"type": "array", "items": _TEXT}, "Gender": _TEXT}, "required": ["AgeRange", "AgeGroups", "Gender"]},
+            "InclusionICDCodes": _CODE_GROUP_LIST,
+            "ExclusionICDCodes": _CODE_GROUP_LIST,
+        },
+        "required": ["BroadMarketDefinition", "AddressableMarketDefinition", "PatientAttributes", "InclusionICDCodes", "ExclusionICDCodes"],
+    }},
+    "required": ["MarketDefinitionSummary"],
+}
+
+_TYPES = {"object": dict, "array": list, "string": str, "boolean": bool, "null": type(None), "number": (int, float), "integer": int}
+
+
+def _is_type(value, name):
+    if name in ("number", "integer") and isinstance(value, bool): return False
+    return isinstance(value, _TYPES[name])
+
+
+def _validate(value, schema, path, errors):
+    expected = schema.get("type")
+    if expected and not any(_is_type(value, name) for name in ([expected] if isinstance(expected, str) else expected)):
+        errors.append(f"{path}: expected {expected}, got {type(value).__name__}"); return
+    if "enum" in schema and value not in schema["enum"]: errors.append(f"{path}: {value!r} is not one of {schema['enum']}")
+    if isinstance(value, dict):
+        for key in schema.get("required", ()):
+            if key not in value: errors.append(f"{path}: missing '{key}'")
+        if "maxProperties" in schema and len(value) > schema["maxProperties"]: errors.append(f"{path}: more than {schema['maxProperties']} entries")
+        properties = schema.get("properties", {}); patterns = schema.get("patternProperties", {}); additional = schema.get("additionalProperties", True)
+        for key, item in value.items():
+            subschema = properties.get(key) or next((s for pattern, s in patterns.items() if re.search(pattern, key)), None)
+            if subschema is not None: _validate(item, subschema, f"{path}.{key}", errors)
+            elif additional is False: errors.append(f"{path}: unexpected key '{key}'")
+            elif isinstance(additional, dict): _validate(item, additional, f"{path}.{key}", errors)
+    elif isinstance(value, list):
+        if "maxItems" in schema and len(value) > schema["maxItems"]: errors.append(f"{path}: more than {schema['maxItems']} items")
+        if "items" in schema:
+            for i, item in enumerate(value): _validate(item, schema["items"], f"{path}[{i}]", errors)
+
+
+def validate(instance, schema):
+    """Schema errors for instance ("$.Path: message"), at most MAX_SCHEMA_ERRORS; empty when valid."""
+    errors = []; _validate(instance, schema, "$", errors)
+    return errors[:MAX_SCHEMA_ERRORS]
+
+
+def schema_report(instance, schema):
+    """{"schema", "valid", "errors"} for a response body; instance may be a parsed object or the raw LLM text."""
+    if isinstance(instance, str):
+        try: instance, _ = parse_llm_json(instance)
+        except ValueError as e: return {"schema": schema["title"], "valid": False, "errors": [str(e)]}
+    errors = validate(instance, schema)
+    return {"schema": schema["title"], "valid": not errors, "errors": errors}
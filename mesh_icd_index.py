@@ -0,0 +1,213 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from icd_index import ICD10CM_PRELOAD, ICD10CM_TABLE_PATH, ICD10CMIndex, icd10cm_index
+from trial_mirror import TRIAL_MIRROR_DB_PATH, TrialMirror
+from trial_projection import extract_mesh_terms, parse_projected_study
+
+# --- Configuration ---
+# SQLite file with the ICD description search index and the precomputed MeSH term -> ICD candidates.
+# Unset = no ICD candidates in the insight prompt. Build it once per deploy with `python mesh_icd_index.py build`.
+MESH_ICD_INDEX_DB_PATH = os.getenv("MESH_ICD_INDEX_DB_PATH")
+MESH_ICD_ENABLED = os.getenv("MESH_ICD_ENABLED", "1") == "1"
+# Optional curated mapping ("MeSH term<TAB>ICD code" per line, e.g. from UMLS); takes precedence over lexical matches.
+MESH_ICD_MAPPING_PATH = os.getenv("MESH_ICD_MAPPING_PATH")
+MESH_ICD_CANDIDATES_PER_TERM = int(os.getenv("MESH_ICD_CANDIDATES_PER_TERM", "6"))
+MESH_ICD_ANCESTOR_CANDIDATES = int(os.getenv("MESH_ICD_ANCESTOR_CANDIDATES", "2"))  # Ancestor terms are broad; keep only their best matches
+MESH_ICD_MAX_CANDIDATES = int(os.getenv("MESH_ICD_MAX_CANDIDATES", "40"))
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+# MeSH qualifiers that never appear in ICD-10-CM titles and would only block an AND match.
+_IGNORED_WORDS = {"and", "of", "the", "diseases", "disease", "disorders", "syndrome", "conditions", "nos"}
+# MeSH wording -> ICD-10-CM wording.
+_SYNONYMS = {"neoplasms": "neoplasm", "neoplasm": "neoplasm", "carcinoma": "neoplasm", "cancer": "neoplasm", "tumors": "neoplasm", "tumor": "neoplasm", "diabetes": "diabetes"}
+
+
+def _dotted(code):
+    return f"{code[:3]}.{code[3:]}" if len(code) > 3 else code
+
+
+class MeshICDIndex:
+    """
+    Candidate ICD-10-CM codes for a trial's condition MeSH terms, so the insight prompt can offer
+    the model a short list to choose from. Each term is matched once against the ICD-10-CM titles
+    (SQLite FTS5, BM25) and the result is stored; `build` precomputes every term in the mirror.
+    """
+
+    def __init__(self, db_path=MESH_ICD_INDEX_DB_PATH, icd_index=icd10cm_index, mapping_path=MESH_ICD_MAPPING_PATH):
+        self.db_path = db_path
+        self.icd_index = icd_index
+        self.mapping_path = mapping_path
+        self._mapping = None
+        self._ready = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mesh-icd-store")
+        self._storing = set()  # Terms queued for _store()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _ensure_ready(self):
+        """
+        Creates the ICD title search table from the ICD-10-CM index the first time; False when unavailable.
+        Workers sharing the file build it once: the source check is repeated under the write lock.
+        """
+        if self._ready: return True
+        if not MESH_ICD_ENABLED or not self.db_path or not self.icd_index.enabled: return False
+        with self._lock:
+            if self._ready: return True
+            try:
+                conn = self._connection(); source = f"{self.icd_index.table_path}:{len(self.icd_index)}"
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+                conn.execute("CREATE TABLE IF NOT EXISTS mesh_icd (mesh_term TEXT NOT NULL, rank INTEGER NOT NULL, icd_code TEXT NOT NULL, PRIMARY KEY (mesh_term, rank))")
+                conn.execute("CREATE TABLE IF NOT EXISTS mesh_terms_done (mesh_term TEXT PRIMARY KEY, computed_at REAL NOT NULL)")
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS icd_fts USING fts5(code UNINDEXED, description, tokenize='porter unicode61')")
+                current = lambda: (conn.execute("SELECT value FROM meta WHERE key = 'icd_source'").fetchone() or [None])[0] == source
+                if not current():
+                    start_time = time.time()
+                    conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        if not current():  # Another worker may have built it while we waited for the lock
+                            conn.execute("DELETE FROM icd_fts"); conn.execute("DELETE FROM mesh_icd"); conn.execute("DELETE FROM mesh_terms_done")
+                            conn.executemany("INSERT INTO icd_fts VALUES (?, ?)", self.icd_index.items())
+                            conn.execute("INSERT OR REPLACE INTO meta VALUES ('icd_source', ?)", (source,))
+                            print(f"MeSH->ICD index: ICD title search built ({(time.time() - start_time) * 1000:.0f} ms)")
+                        conn.execute("COMMIT")
+                    except BaseException:
+                        conn.execute("ROLLBACK"); raise
+            except sqlite3.Error as e: print(f"MeSH->ICD index disabled ({self.db_path}): {e}"); return False
+            self._ready = True
+        return True
+
+    def _curated(self, term):
+        if self._mapping is None:
+            mapping = {}
+            if self.mapping_path and os.path.exists(self.mapping_path):
+                with open(self.mapping_path, encoding="utf-8") as mapping_file:
+                    for line in mapping_file:
+                        mesh_term, _, code = line.rstrip("\r\n").partition("\t")
+                        if mesh_term and code: mapping.setdefault(mesh_term.strip().lower(), []).append(code.strip().upper().replace(".", ""))
+            self._mapping = mapping
+        return self._mapping.get(term.lower(), [])
+
+    def _match(self, term):
+        """Undotted ICD codes whose titles contain every meaningful word of term, best BM25 first."""
+        words = [_SYNONYMS.get(w, w) for w in _WORD_RE.findall(term.lower()) if w not in _IGNORED_WORDS]
+        if not words: return []
+        expression = " AND ".join(f'"{w}"' for w in dict.fromkeys(words))
+        rows = self._connection().execute("SELECT code FROM icd_fts WHERE icd_fts MATCH ? ORDER BY bm25(icd_fts), length(code) LIMIT ?", (expression, MESH_ICD_CANDIDATES_PER_TERM * 4)).fetchall()
+        codes = []
+        # Categories first (a better market definition than one leaf), BM25 order within a level.
+        for (code,) in sorted(rows, key=lambda row: len(row[0])):
+            # A matching category makes its own subcodes redundant in a candidate list.
+            if not any(code.startswith(kept) for kept in codes): codes.append(code)
+            if len(codes) >= MESH_ICD_CANDIDATES_PER_TERM: break
+        return codes
+
+    def _stored(self, term):
+        """The stored candidate codes for term, or None when it has not been computed yet."""
+        conn = self._connection()
+        if not conn.execute("SELECT 1 FROM mesh_terms_done WHERE mesh_term = ?", (term,)).fetchone(): return None
+        return [code for (code,) in conn.execute("SELECT icd_code FROM mesh_icd WHERE mesh_term = ? ORDER BY rank", (term,))]
+
+    def _store(self, term, codes):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM mesh_icd WHERE mesh_term = ?", (term,))
+            conn.executemany("INSERT INTO mesh_icd VALUES (?, ?, ?)", [(term, rank, code) for rank, code in enumerate(codes)])
+            conn.execute("INSERT OR REPLACE INTO mesh_terms_done VALUES (?, ?)", (term, time.time()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK"); raise
+
+    def _store_later(self, term, codes):
+        """Best-effort write-through off the request path; a failed write only means the term is matched again next time."""
+        with self._lock:
+            if term in self._storing: return
+            self._storing.add(term)
+
+        def store():
+            try: self._store(term, codes)
+            except sqlite3.Error as e: print(f"MeSH->ICD index: could not store '{term}': {e}")
+            finally:
+                with self._lock: self._storing.discard(term)
+        self._store_executor.submit(store)
+
+    def codes_for_term(self, term, store=True):
+        """Candidate codes (undotted) for one MeSH term, computed once and stored (in the background unless store)."""
+        codes = self._stored(term)
+        if codes is not None: return codes
+        codes = list(dict.fromkeys(self._curated(term) + self._match(term)))
+        if store: self._store(term, codes)
+        else: self._store_later(term, codes)
+        return codes
+
+    def candidates(self, mesh_terms, mesh_ancestors=()):
+        """
+        [(dotted_code, description)] for a trial: the condition terms' matches first, then the
+        broader ancestor terms', up to MESH_ICD_MAX_CANDIDATES. Empty when the index is unavailable.
+        """
+        if not (mesh_terms or mesh_ancestors) or not self._ensure_ready(): return []
+        candidates = {}
+        try:
+            for term, limit in [(t, None) for t in mesh_terms] + [(t, MESH_ICD_ANCESTOR_CANDIDATES) for t in mesh_ancestors]:
+                if len(candidates) >= MESH_ICD_MAX_CANDIDATES: break  # Later terms are not looked up at all
+                for code in self.codes_for_term(term, store=False)[:limit]:
+                    candidates.setdefault(code, self.icd_index.describe(code) or "")
+                    if len(candidates) >= MESH_ICD_MAX_CANDIDATES: break
+        except sqlite3.Error as e: print(f"MeSH->ICD lookup error: {e}")
+        return [(_dotted(code), description) for code, description in candidates.items()]
+
+    def build_from_mirror(self, mirror, progress_every=50000):
+        """Precomputes candidates for every condition/ancestor MeSH term in a TrialMirror. Returns a stats dict."""
+        if not self._ensure_ready(): raise RuntimeError("ICD-10-CM table unavailable")
+        start_time = time.time(); terms = set(); studies = 0
+        spec = {"derivedSection": {"conditionBrowseModule": None}}
+        for (body,) in mirror._connection().execute("SELECT body FROM studies"):
+            mesh_terms, mesh_ancestors = extract_mesh_terms(parse_projected_study(zlib.decompress(body).decode("utf-8"), spec).get("derivedSection"))
+            terms.update(mesh_terms); terms.update(mesh_ancestors); studies += 1
+            if progress_every and studies % progress_every == 0: print(f"MeSH->ICD index: {studies} studies scanned ({time.time() - start_time:.0f}s)")
+        for term in sorted(terms): self.codes_for_term(term)
+        return {"studies": studies, "mesh_terms": len(terms), "duration_seconds": round(time.time() - start_time, 2)}
+
+
+mesh_icd_index = MeshICDIndex()
+
+if ICD10CM_PRELOAD and MESH_ICD_ENABLED and __name__ != "__main__":
+    threading.Thread(target=mesh_icd_index._ensure_ready, name="mesh-icd-load", daemon=True).start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MeSH term -> ICD-10-CM candidate index.")
+    parser.add_argument("--db", default=MESH_ICD_INDEX_DB_PATH, help="Index SQLite path (default: $MESH_ICD_INDEX_DB_PATH)")
+    parser.add_argument("--table", default=ICD10CM_TABLE_PATH, help="ICD-10-CM table (default: $ICD10CM_TABLE_PATH)")
+    parser.add_argument("--mirror", default=TRIAL_MIRROR_DB_PATH, help="Trial mirror SQLite path (default: $TRIAL_MIRROR_DB_PATH)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="Precompute candidates for every MeSH term in the trial mirror")
+    query_parser = subparsers.add_parser("query", help="Show candidates for MeSH terms")
+    query_parser.add_argument("terms", nargs="+")
+    args = parser.parse_args()
+    if not args.db: parser.error("--db or MESH_ICD_INDEX_DB_PATH is required")
+
+    index = MeshICDIndex(args.db, ICD10CMIndex(args.table))
+    if args.command == "build":
+        if not args.mirror: parser.error("--mirror or TRIAL_MIRROR_DB_PATH is required")
+        print(index.build_from_mirror(TrialMirror(args.mirror)))
+    else:
+        start_time = time.perf_counter()
+        print(json.dumps(index.candidates(args.terms), indent=2))
+        print(f"{(time.perf_counter() - start_time) * 1000:.1f} ms")
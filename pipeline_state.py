@@ -0,0 +1,87 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import msgpack
+
+from trial_record import TrialRecord
+
+# --- Configuration ---
+PIPELINE_STATE_MAX_ENTRIES = int(os.getenv("PIPELINE_STATE_MAX_ENTRIES", "4096"))
+PIPELINE_STATE_TTL_SECONDS = int(os.getenv("PIPELINE_STATE_TTL_SECONDS", "3600"))  # 1 hour
+# Optional SQLite file so a handle issued by one gunicorn worker resolves in the others. Unset = memory only.
+PIPELINE_STATE_DB_PATH = os.getenv("PIPELINE_STATE_DB_PATH")
+
+
+class PipelineStateStore:
+    """
+    Server-side state between /fetch_and_summarize and /generate_insights, keyed by a short
+    opaque handle, so clients need not post processed_data/original_input back.
+    Bounded LRU in memory with a TTL, optionally shared across workers through SQLite.
+    """
+
+    def __init__(self, max_entries=PIPELINE_STATE_MAX_ENTRIES, ttl_seconds=PIPELINE_STATE_TTL_SECONDS, db_path=PIPELINE_STATE_DB_PATH):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self._entries = OrderedDict()  # handle -> (stored_at, (trial_record, original_input))
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if self.db_path:
+            try: self._connection().execute("CREATE TABLE IF NOT EXISTS pipeline_state (handle TEXT PRIMARY KEY, stored_at REAL NOT NULL, body BLOB NOT NULL)")
+            except sqlite3.Error as e: print(f"Pipeline state disk store disabled ({self.db_path}): {e}"); self.db_path = None
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _is_fresh(self, stored_at):
+        return (time.time() - stored_at) < self.ttl_seconds
+
+    def put(self, trial_record, original_input):
+        """Stores the state and returns its new handle."""
+        handle = secrets.token_urlsafe(12); stored_at = time.time()
+        self._remember(handle, (trial_record, original_input), stored_at)
+        if self.db_path:
+            body = msgpack.packb([trial_record.to_bytes(), original_input], use_bin_type=True)
+            try:
+                conn = self._connection()
+                conn.execute("INSERT OR REPLACE INTO pipeline_state (handle, stored_at, body) VALUES (?, ?, ?)", (handle, stored_at, body))
+                conn.execute("DELETE FROM pipeline_state WHERE stored_at < ?", (stored_at - self.ttl_seconds,))
+            except sqlite3.Error as e: print(f"Pipeline state write error: {e}")
+        return handle
+
+    def get(self, handle):
+        """Returns (trial_record, original_input), or None for an unknown or expired handle."""
+        with self._lock:
+            entry = self._entries.get(handle)
+            if entry is not None:
+                if self._is_fresh(entry[0]):
+                    self._entries.move_to_end(handle)
+                    return entry[1]
+                del self._entries[handle]
+        if not self.db_path: return None
+        try: row = self._connection().execute("SELECT stored_at, body FROM pipeline_state WHERE handle = ?", (handle,)).fetchone()
+        except sqlite3.Error as e: print(f"Pipeline state read error: {e}"); return None
+        if not row or not self._is_fresh(row[0]): return None
+        try: record_bytes, original_input = msgpack.unpackb(row[1], raw=False); state = (TrialRecord.from_bytes(record_bytes), original_input)
+        except (ValueError, TypeError) as e: print(f"Pipeline state discarding unreadable entry: {e}"); return None
+        self._remember(handle, state, row[0])
+        return state
+
+    def _remember(self, handle, state, stored_at):
+        with self._lock:
+            self._entries[handle] = (stored_at, state)
+            self._entries.move_to_end(handle)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+pipeline_state = PipelineStateStore()
@@ -0,0 +1,138 @@
+import json
+import os
+import re
+import threading
+
+# --- Configuration ---
+# Shared token budget for inclusion + exclusion criteria in a prompt. 0 = no limit.
+CRITERIA_TOKEN_BUDGET = int(os.getenv("CRITERIA_TOKEN_BUDGET", "1500"))
+CRITERIA_DROP_BOILERPLATE = os.getenv("CRITERIA_DROP_BOILERPLATE", "1") == "1"
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")  # gpt-35-turbo / gpt-4
+# tiktoken downloads its BPE file on first use unless it is already in TIKTOKEN_CACHE_DIR; the deploy
+# workflow pre-fetches it into data/tiktoken so App Service never downloads it on a request.
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "tiktoken"))
+
+_BULLET_RE = re.compile(r"^\s*(?:[-*•·▪◦]|\(?\d{1,2}[.)]|\(?[a-zA-Z]\))\s+")
+_SPACE_RE = re.compile(r"\s+")
+_DEDUPE_STRIP_RE = re.compile(r"[^\w ]+")
+# Items every trial carries and which never map to a diagnosis code.
+_BOILERPLATE_RES = [re.compile(p, re.IGNORECASE) for p in (
+    r"\b(?:sign(?:ed)?|provide|give|written|willing(?:ness)?|able|ability|capable)\b.{0,60}\binformed consent\b",
+    r"\b(?:willing|able|ability)\b.{0,40}\bcomply\b.{0,40}\b(?:protocol|study|procedures|visits|requirements)\b",
+    r"^(?:any )?(?:other )?(?:condition|circumstance|situation)s?\b.{0,120}\b(?:investigator|opinion|judg(?:e)?ment)\b",
+)]
+# Contraception requirements are boilerplate too, unless the item also excludes pregnancy or breastfeeding.
+_CONTRACEPTION_RE = re.compile(r"\b(?:contracepti\w*|birth control|barrier method)\b", re.IGNORECASE)
+_PREGNANCY_RE = re.compile(r"\b(?:pregnan\w*|breast[- ]?feed\w*|lactat\w*|nursing)\b", re.IGNORECASE)
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """The tiktoken encoding, loaded once; False when unavailable (token counts are then estimated)."""
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+                except Exception as e: print(f"Tokenizer '{TOKENIZER_ENCODING}' unavailable, estimating token counts: {e}"); _encoding = False
+    return _encoding
+
+
+def count_tokens(text):
+    if not text: return 0
+    encoding = _get_encoding()
+    return len(encoding.encode(text, disallowed_special=())) if encoding else (len(text) + 3) // 4
+
+
+def tokenizer_name():
+    return TOKENIZER_ENCODING if _get_encoding() else "estimate"
+
+
+def split_criteria_items(text):
+    """
+    Splits a criteria section into items: one per top-level bullet, with wrapped lines and indented
+    sub-bullets folded into their parent ("... defined as: ANC >= 1.5; Platelets >= 100"), or one per
+    line when the text has no bullets.
+    """
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not any(_BULLET_RE.match(line) for line in lines): return [_SPACE_RE.sub(" ", line).strip() for line in lines]
+    items = []; parent_indent = None; has_children = False
+    for line in lines:
+        stripped = line.strip(); indent = len(line) - len(line.lstrip())
+        if _BULLET_RE.match(line):
+            if items and parent_indent is not None and indent > parent_indent:
+                items[-1] += ("; " if has_children else " ") + _BULLET_RE.sub("", line).strip(); has_children = True; continue
+            items.append(_BULLET_RE.sub("", line)); parent_indent = indent; has_children = False
+        elif not items or (items[-1].endswith(":") and not has_children) or stripped.endswith(":"):
+            items.append(stripped); parent_indent = None; has_children = False
+        else: items[-1] += " " + stripped
+    return [_SPACE_RE.sub(" ", item).strip() for item in items]
+
+
+def _is_boilerplate(item):
+    if _CONTRACEPTION_RE.search(item) and not _PREGNANCY_RE.search(item): return True
+    return any(pattern.search(item) for pattern in _BOILERPLATE_RES)
+
+
+def _clean_items(text, seen, stats):
+    items = []
+    for item in split_criteria_items(text):
+        stats["items_before"] += 1
+        key = _SPACE_RE.sub(" ", _DEDUPE_STRIP_RE.sub(" ", item.lower())).strip()
+        if not key or key in seen: stats["duplicates_removed"] += 1; continue
+        if CRITERIA_DROP_BOILERPLATE and _is_boilerplate(item): stats["boilerplate_removed"] += 1; continue
+        seen.add(key); items.append(item)
+    return items
+
+
+def _fit_items(items, budget, stats):
+    """Keeps items in their original order (most trials list key criteria first) while they fit the budget."""
+    kept = []; used = 0
+    for item in items:
+        cost = count_tokens(item) + 2  # bullet + newline
+        if used + cost > budget: break
+        kept.append(item); used += cost
+    omitted = len(items) - len(kept)
+    if omitted: stats["items_truncated"] += omitted; kept.append(f"[{omitted} further criteria omitted for length]")
+    return kept
+
+
+def _is_placeholder(text):
+    return not isinstance(text, str) or text in ("Not provided", "Not specified")
+
+
+def compact_criteria(inclusion, exclusion, token_budget=CRITERIA_TOKEN_BUDGET):
+    """
+    Prompt-ready inclusion/exclusion criteria: split into items, duplicates (also across the two
+    sections) and boilerplate removed, whitespace normalized, and cut to token_budget shared
+    between both sections in proportion to their size. Returns (inclusion, exclusion, stats).
+    """
+    stats = {"tokenizer": tokenizer_name(), "tokens_before": count_tokens(inclusion if isinstance(inclusion, str) else "") + count_tokens(exclusion if isinstance(exclusion, str) else ""),
+             "tokens_after": 0, "items_before": 0, "items_after": 0, "duplicates_removed": 0, "boilerplate_removed": 0, "items_truncated": 0}
+    seen = set()
+    sections = [None if _is_placeholder(text) else _clean_items(text, seen, stats) for text in (inclusion, exclusion)]
+    section_tokens = [sum(count_tokens(item) + 2 for item in items) if items else 0 for items in sections]
+    if token_budget and sum(section_tokens) > token_budget:
+        sections = [_fit_items(items, token_budget * tokens // sum(section_tokens), stats) if items else items for items, tokens in zip(sections, section_tokens)]
+    results = []
+    for original, items in zip((inclusion, exclusion), sections):
+        if items is None: results.append(original); continue
+        stats["items_after"] += sum(1 for item in items if not item.endswith("omitted for length]"))
+        results.append("\n".join(f"* {item}" for item in items) or "Not provided")
+    stats["tokens_after"] = count_tokens(results[0] if isinstance(results[0], str) else "") + count_tokens(results[1] if isinstance(results[1], str) else "")
+    return results[0], results[1], stats
+
+
+def minify_json(payload):
+    """Compact JSON for prompts: no indentation or separator padding, non-ASCII kept as-is (fewer tokens)."""
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+
+def minify_json_with_stats(payload):
+    """(minified_json, {"tokenizer", "tokens_before", "tokens_after"}); tokens_before is the indent=2 form."""
+    minified = minify_json(payload)
+    return minified, {"tokenizer": tokenizer_name(), "tokens_before": count_tokens(json.dumps(payload, indent=2)), "tokens_after": count_tokens(minified)}
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+
+try: import fcntl
+except ImportError: fcntl = None  # Windows: coalescing stays within the process
+
+# --- Configuration ---
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1") == "1"
+# Directory for lock files shared by the gunicorn workers on a host. Unset = coalesce within a worker only.
+SINGLE_FLIGHT_LOCK_DIR = os.getenv("SINGLE_FLIGHT_LOCK_DIR")
+SINGLE_FLIGHT_LOCK_STRIPES = int(os.getenv("SINGLE_FLIGHT_LOCK_STRIPES", "1024"))  # Keys hash onto this many lock files per flight
+SINGLE_FLIGHT_WAIT_SECONDS = float(os.getenv("SINGLE_FLIGHT_WAIT_SECONDS", "180"))  # Longest a duplicate waits before doing the work itself
+_LOCK_POLL_SECONDS = 0.05
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent work: while a call for a key is in flight, callers with the same
+    key wait for its result instead of repeating it. Within a worker this covers threads (do) or
+    the event loop (ado); with SINGLE_FLIGHT_LOCK_DIR set, workers also serialize on a per-key file
+    lock and a waiter calls `recheck` (typically a shared-cache lookup) before doing the work itself.
+    """
+
+    def __init__(self, name, lock_dir=SINGLE_FLIGHT_LOCK_DIR, enabled=SINGLE_FLIGHT_ENABLED):
+        self.name = name
+        self.enabled = enabled
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.coalesced = 0
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        if self.lock_dir:
+            try: os.makedirs(self.lock_dir, exist_ok=True)
+            except OSError as e: print(f"Single-flight {name}: cross-worker locking disabled ({self.lock_dir}): {e}"); self.lock_dir = None
+
+    def _lock_path(self, key):
+        stripe = int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:8], 16) % SINGLE_FLIGHT_LOCK_STRIPES
+        return os.path.join(self.lock_dir, f"{self.name}-{stripe}.lock")
+
+    def _acquire_file_lock(self, key):
+        """Open lock file with an exclusive flock, or None when not configured or it stays busy past the wait limit."""
+        if not self.lock_dir: return None
+        deadline = time.monotonic() + SINGLE_FLIGHT_WAIT_SECONDS
+        try:
+            lock_file = open(self._lock_path(key), "a+")
+            while True:
+                try: fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB); return lock_file
+                except BlockingIOError:
+                    if time.monotonic() > deadline: lock_file.close(); return None
+                    time.sleep(_LOCK_POLL_SECONDS)
+        except OSError as e: print(f"Single-flight {self.name} lock error: {e}"); return None
+
+    @staticmethod
+    def _release_file_lock(lock_file):
+        if lock_file is None: return
+        try: fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally: lock_file.close()
+
+    def _run_locked(self, key, fn, recheck):
+        lock_file = self._acquire_file_lock(key)
+        try:
+            # Another worker may have finished the same work while this one waited for the lock.
+            if lock_file is not None and recheck is not None:
+                result = recheck()
+                if result is not None: self.coalesced += 1; return result
+            return fn()
+        finally: self._release_file_lock(lock_file)
+
+    def do(self, key, fn, recheck=None):
+        """fn() once per key at a time; concurrent callers get the same result (or exception)."""
+        if not self.enabled: return fn()
+        with self._lock:
+            call = self._calls.get(key); leader = call is None
+            if leader: call = self._calls[key] = _Call()
+        if not leader:
+            if call.done.wait(SINGLE_FLIGHT_WAIT_SECONDS):
+                self.coalesced += 1
+                if call.error is not None: raise call.error
+                return call.result
+            return self._run_locked(key, fn, recheck)  # Leader is stuck; do the work rather than wait forever
+        try: call.result = self._run_locked(key, fn, recheck)
+        except BaseException as e: call.error = e; raise
+        finally:
+            with self._lock: self._calls.pop(key, None)
+            call.done.set()
+        return call.result
+
+    async def ado(self, key, fn, recheck=None):
+        """Async counterpart of do(): fn and recheck are coroutine functions; waiters share one future."""
+        if not self.enabled: return await fn()
+        future = self._async_calls.get(key)
+        if future is not None:
+            try: result = await asyncio.wait_for(asyncio.shield(future), SINGLE_FLIGHT_WAIT_SECONDS)
+            except asyncio.TimeoutError: return await fn()
+            except asyncio.CancelledError:
+                if not future.cancelled(): raise
+                return await fn()  # The leader's request was cancelled (client went away); this one still wants the result
+            self.coalesced += 1
+            return result
+        future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+        lock_file = None
+        try:
+            lock_file = await asyncio.to_thread(self._acquire_file_lock, key)
+            result = await recheck() if lock_file is not None and recheck is not None else None
+            if result is None: result = await fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError: future.cancel(); raise
+        except Exception as e:
+            future.set_exception(e); future.exception()  # Mark retrieved: there may be no waiters
+            raise
+        finally:
+            self._async_calls.pop(key, None)
+            self._release_file_lock(lock_file)
+
+
+trial_fetches = SingleFlight("trial-fetch")  # keyed by NCT ID
+llm_calls = SingleFlight("llm-call")  # keyed by llm_cache.make_key() (rendered prompt, deployment, version)
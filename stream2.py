@@ -1,5 +1,6 @@
 import streamlit as st
 import requests
+import http_client
 from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
 from langchain_openai import AzureChatOpenAI
@@ -17,7 +18,7 @@ def is_valid_nct_format(nct_id):
 # --- Utility: Check NCT ID Existence ---
 def does_nct_id_exist(nct_id):
     url = f"https://clinicaltrials.gov/api/v2/studies/{nct_id}"
-    response = requests.get(url)
+    response = http_client.get(url)
     return response.status_code == 200
 
 # --- Alternative Suggestion Using Indication Search ---
@@ -27,7 +28,7 @@ def suggest_nct_ids_by_indication(indication):
     query = indication.strip().replace(" ", "+")
     url = f"https://clinicaltrials.gov/api/v2/studies?query.cond={query}&pageSize=3"
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
         if response.status_code == 200:
             results = response.json().get("studies", [])
             return [
@@ -46,7 +47,7 @@ def suggest_nct_ids_by_indication(indication):
 def get_clinical_trial_info(nct_id):
     base_url = "https://clinicaltrials.gov/api/v2/studies"
     try:
-        response = requests.get(f"{base_url}/{nct_id}")
+        response = http_client.get(f"{base_url}/{nct_id}")
         if response.status_code == 200:
             return response.json()
         else:
@@ -60,7 +61,7 @@ def fetch_and_extract_fda_products(indication):
     encoded_indication = requests.utils.quote(f'"{indication}"')
     url = f"https://api.fda.gov/drug/label.json?search=indications_and_usage:{encoded_indication}&limit=10"
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
         if response.status_code == 200:
             results = response.json().get("results", [])
             if not results:
@@ -0,0 +1,108 @@
+import json
+import re
+
+_PARTIAL_LITERAL_RE = re.compile(r"(?<=[:\[,\s])(?:t|tr|tru|f|fa|fal|fals|n|nu|nul)$")
+_PARTIAL_NUMBER_RE = re.compile(r"(?<=\d)[.eE+-]+$|(?<=[:\[,\s])-$")
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class IncrementalJSONParser:
+    """
+    Tolerant, incremental parser for the JSON object an LLM writes, fed chunk by chunk as tokens
+    arrive. Text before the first "{" (prose, a ```json fence) and after the object is ignored.
+    feed() returns the top-level members that closed in that chunk; finish() returns the whole
+    object, repairing trailing commas, a missing closing fence and a truncated tail on the way.
+    """
+
+    def __init__(self):
+        self._out = []  # cleaned JSON text of the root object so far
+        self._stack = []  # open containers
+        self._expect_key = []  # per open container: an object waiting for its next key
+        self._in_string = False
+        self._escape = False
+        self._key_start = None  # start of an object key whose ":" has not arrived yet
+        self._member_start = None  # start of the current root-level member in _out
+        self.started = False
+        self.done = False
+        self.repairs = []
+
+    def _repair(self, name):
+        if name not in self.repairs: self.repairs.append(name)
+
+    def _strip_trailing_comma(self):
+        out = self._out
+        while out and out[-1].isspace(): out.pop()
+        if out and out[-1] == ",": out.pop(); self._repair("trailing_comma")
+
+    def _emit_member(self, sections):
+        member = "".join(self._out[self._member_start:]).strip()
+        if member:
+            try: sections.extend(json.loads("{" + member + "}", strict=False).items())
+            except json.JSONDecodeError: pass  # left to finish(), which sees the whole object
+        self._member_start = len(self._out)
+
+    def feed(self, text):
+        """Consumes the next chunk; returns [(key, value)] for the root members it completed."""
+        sections = []
+        if self.done: return sections
+        out = self._out
+        for ch in text:
+            if not self.started:
+                if ch == "{": self.started = True; out.append(ch); self._stack.append("{"); self._expect_key.append(True); self._member_start = 1
+                continue
+            if self._in_string:
+                out.append(ch)
+                if self._escape: self._escape = False
+                elif ch == "\\": self._escape = True
+                elif ch == '"': self._in_string = False
+                continue
+            if ch == '"':
+                if self._stack[-1] == "{" and self._expect_key[-1]: self._key_start = len(out); self._expect_key[-1] = False
+                self._in_string = True; out.append(ch)
+            elif ch == ":":
+                self._key_start = None; out.append(ch)
+            elif ch == ",":
+                if self._stack[-1] == "{": self._expect_key[-1] = True
+                if len(self._stack) == 1: self._strip_trailing_comma(); self._emit_member(sections); self._member_start += 1
+                out.append(ch)
+            elif ch in "{[":
+                self._stack.append(ch); self._expect_key.append(ch == "{"); out.append(ch)
+            elif ch in "}]":
+                if _CLOSERS[self._stack[-1]] != ch: self._repair("mismatched_bracket"); continue
+                self._strip_trailing_comma()
+                if len(self._stack) == 1: self._emit_member(sections)
+                self._stack.pop(); self._expect_key.pop(); out.append(ch)
+                if not self._stack: self.done = True; break
+            elif ch == "`":  # closing fence while the object is still open: the output was cut short
+                self._repair("truncated"); self.done = True; break
+            else: out.append(ch)
+        return sections
+
+    def finish(self):
+        """
+        The complete object, closing whatever the output left open. Raises ValueError when no
+        object was found or it cannot be repaired.
+        """
+        if not self.started: raise ValueError("Could not find JSON block in LLM output.")
+        if not self._stack: text = "".join(self._out)
+        else:
+            self._repair("truncated")
+            out = list(self._out)
+            if self._in_string:
+                if self._escape: out.pop()
+                if self._key_start is not None: del out[self._key_start:]  # half-written key
+                else: out.append('"')
+            elif self._key_start is not None: del out[self._key_start:]  # key without a value
+            text = "".join(out).rstrip()
+            text = _PARTIAL_NUMBER_RE.sub("", _PARTIAL_LITERAL_RE.sub("null", text)).rstrip()
+            if text.endswith(","): text = text[:-1].rstrip()
+            if text.endswith(":"): text += "null"
+            text += "".join(_CLOSERS[opener] for opener in reversed(self._stack))
+        try: return json.loads(text, strict=False)
+        except json.JSONDecodeError as e: raise ValueError(f"Could not repair LLM JSON output: {e}")
+
+
+def parse_llm_json(text):
+    """(object, repairs) for a complete LLM response; see IncrementalJSONParser."""
+    parser = IncrementalJSONParser(); parser.feed(text)
+    return parser.finish(), parser.repairs
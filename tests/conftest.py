@@ -0,0 +1,6 @@
+import os
+
+# Keep module imports side-effect free: no background table loads, network warm-up or shared disk stores.
+os.environ.setdefault("ICD10CM_PRELOAD", "0")
+os.environ.setdefault("LLM_POOL_WARMUP", "0")
+os.environ.setdefault("LLM_RATE_LIMIT_ENABLED", "0")
@@ -0,0 +1,86 @@
+import pytest
+
+import circuit_breaker as circuit_breaker_module
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+class Clock:
+    def __init__(self): self.now = 1000.0
+    def __call__(self): return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(); monkeypatch.setattr(circuit_breaker_module.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker("test", failure_threshold=3, reset_seconds=30, enabled=True)
+
+
+def trip(breaker):
+    for _ in range(breaker.failure_threshold): breaker.record(False)
+
+
+def test_opens_after_consecutive_failures(breaker):
+    breaker.record(False); breaker.record(False)
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert not breaker.allow() and not breaker.available()
+    assert breaker.rejected == 1
+
+
+def test_success_resets_the_failure_count(breaker):
+    breaker.record(False); breaker.record(False); breaker.record(True); breaker.record(False)
+    assert breaker.state == "closed"
+
+
+def test_check_raises_while_open(breaker):
+    trip(breaker)
+    with pytest.raises(CircuitOpenError): breaker.check()
+
+
+def test_half_open_lets_one_probe_through(breaker, clock):
+    trip(breaker); clock.now += 30
+    assert breaker.state == "half_open" and breaker.available()
+    assert breaker.allow()
+    assert not breaker.allow() and not breaker.available()  # probe in flight
+
+
+def test_successful_probe_closes(breaker, clock):
+    trip(breaker); clock.now += 30; breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed" and breaker.failures == 0
+
+
+def test_failed_probe_reopens(breaker, clock):
+    trip(breaker); clock.now += 30; breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+def test_abandoned_probe_stops_blocking(breaker, clock):
+    trip(breaker); clock.now += 30; breaker.allow()
+    clock.now += 30
+    assert breaker.allow()
+
+
+def test_slow_calls_count_as_failures(clock):
+    breaker = CircuitBreaker("slow", failure_threshold=2, reset_seconds=30, slow_call_seconds=5, enabled=True)
+    breaker.record(True, seconds=6); breaker.record(True, seconds=4)
+    assert breaker.failures == 0
+    breaker.record(True, seconds=6); breaker.record(True, seconds=7)
+    assert breaker.state == "open"
+
+
+def test_disabled_never_opens(clock):
+    breaker = CircuitBreaker("off", failure_threshold=1, enabled=False)
+    breaker.record(False); breaker.record(False)
+    assert breaker.allow() and breaker.state == "closed"
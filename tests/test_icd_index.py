@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+import icd_index
+from icd_index import ICD10CMIndex, without_code_descriptions
+
+TABLE = """E10\tType 1 diabetes mellitus
+E10.9\tType 1 diabetes mellitus without complications
+E11\tType 2 diabetes mellitus
+E11.6\tType 2 diabetes mellitus with other specified complications
+E11.65\tType 2 diabetes mellitus with hyperglycemia
+E11.9\tType 2 diabetes mellitus without complications
+I10\tEssential (primary) hypertension
+I48.0\tParoxysmal atrial fibrillation
+I48.1\tPersistent atrial fibrillation
+I48.2\tChronic atrial fibrillation
+"""
+
+
+@pytest.fixture
+def index(tmp_path):
+    path = tmp_path / "codes.tsv"; path.write_text(TABLE, encoding="utf-8")
+    return ICD10CMIndex(str(path))
+
+
+@pytest.mark.parametrize("entry, codes", [
+    ("E11.9", ["E11.9"]),
+    ("e119", ["E11.9"]),
+    (" I10. ", ["I10"]),
+    ("I10 - Essential hypertension", ["I10"]),
+])
+def test_valid(index, entry, codes):
+    assert index.resolve(entry) == (codes, "valid")
+
+
+@pytest.mark.parametrize("entry, codes", [
+    ("I48.*", ["I48.0", "I48.1", "I48.2"]),
+    ("I48.-", ["I48.0", "I48.1", "I48.2"]),
+    ("E11.6X", ["E11.65"]),
+    ("E10-E11", ["E10", "E11"]),
+    ("I48.0 – I48.1", ["I48.0", "I48.1"]),
+])
+def test_expanded(index, entry, codes):
+    assert index.resolve(entry) == (codes, "expanded")
+
+
+@pytest.mark.parametrize("entry", ["Z99.9", "E12", "diabetes", "", "E12-E13"])
+def test_invalid(index, entry):
+    assert index.resolve(entry) == ([], "invalid")
+
+
+def test_too_broad_is_kept_as_written(index, monkeypatch):
+    monkeypatch.setattr(icd_index, "ICD_EXPANSION_LIMIT", 2)
+    assert index.resolve("I48.*") == (["I48.*"], "too_broad")
+    assert index.resolve("E10-I48") == (["E10-I48"], "too_broad")
+
+
+def test_clean_insights(index):
+    insights = {"Conditions": [{"ICDCodes": ["E11.9", "e11.9", "bogus", "I48.*"]}]}
+    cleaned, stats = index.clean_insights(insights)
+    entry = cleaned["Conditions"][0]
+    assert entry["ICDCodes"] == ["E11.9", "I48.0", "I48.1", "I48.2"]
+    assert entry["ICDCodeDescriptions"]["E11.9"] == "Type 2 diabetes mellitus without complications"
+    assert (stats["checked"], stats["valid"], stats["expanded"], stats["dropped"]) == (4, 2, 1, ["bogus"])
+    assert without_code_descriptions(cleaned) == {"Conditions": [{"ICDCodes": entry["ICDCodes"]}]}
+
+
+def test_missing_table_disables_validation(tmp_path):
+    index = ICD10CMIndex(str(tmp_path / "missing.tsv"))
+    assert not index.enabled
+    assert index.clean_insights({"ICDCodes": ["E11.9"]}) == ({"ICDCodes": ["E11.9"]}, None)
+
+
+@pytest.mark.skipif(not os.path.exists(icd_index.ICD10CM_TABLE_PATH), reason="bundled ICD-10-CM table not present")
+def test_bundled_table():
+    index = ICD10CMIndex()
+    assert index.resolve("E11.9") == (["E11.9"], "valid")
+    assert index.resolve("A00-Z99")[1] == "too_broad"
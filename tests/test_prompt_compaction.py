@@ -0,0 +1,54 @@
+import pytest
+
+import prompt_compaction
+from prompt_compaction import compact_criteria, count_tokens, minify_json, split_criteria_items
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    """Token counts by estimate, so results do not depend on whether the tiktoken encoding is available."""
+    monkeypatch.setattr(prompt_compaction, "_encoding", False)
+
+
+def test_split_folds_wrapped_lines_and_sub_bullets():
+    text = "* Adults aged 18 or over\n* Adequate organ function, defined as:\n    - ANC >= 1.5\n    - Platelets >= 100\n* Measurable disease per\n  RECIST 1.1"
+    assert split_criteria_items(text) == ["Adults aged 18 or over", "Adequate organ function, defined as: ANC >= 1.5; Platelets >= 100", "Measurable disease per RECIST 1.1"]
+
+
+def test_duplicates_and_boilerplate_removed():
+    inclusion = "* Signed informed consent\n* Type 2 diabetes\n* Willing to use contraception during the study"
+    exclusion = "* type 2 diabetes.\n* Pregnant or breastfeeding, or not using contraception"
+    kept_inclusion, kept_exclusion, stats = compact_criteria(inclusion, exclusion, token_budget=0)
+    assert kept_inclusion == "* Type 2 diabetes"
+    assert kept_exclusion == "* Pregnant or breastfeeding, or not using contraception"
+    assert (stats["duplicates_removed"], stats["boilerplate_removed"], stats["items_after"]) == (1, 2, 2)
+    assert stats["tokenizer"] == "estimate"
+
+
+def test_fits_budget_in_proportion_keeping_order():
+    inclusion = "\n".join(f"* Inclusion criterion number {i} with some detail" for i in range(20))
+    exclusion = "\n".join(f"* Exclusion criterion number {i} with some detail" for i in range(10))
+    budget = 150
+    kept_inclusion, kept_exclusion, stats = compact_criteria(inclusion, exclusion, token_budget=budget)
+    inclusion_items = kept_inclusion.splitlines(); exclusion_items = kept_exclusion.splitlines()
+    assert inclusion_items[0] == "* Inclusion criterion number 0 with some detail"
+    assert inclusion_items[-1].endswith("further criteria omitted for length]")
+    assert exclusion_items[-1].endswith("further criteria omitted for length]")
+    assert len(inclusion_items) > len(exclusion_items)  # inclusion is twice the size, so it gets twice the share
+    assert stats["items_after"] + stats["items_truncated"] == 30
+    kept = [item for item in inclusion_items + exclusion_items if not item.endswith("omitted for length]")]
+    assert sum(count_tokens(item[2:]) + 2 for item in kept) <= budget
+
+
+def test_under_budget_is_not_truncated():
+    kept_inclusion, _, stats = compact_criteria("* Age 18+\n* HbA1c 7-10%", "Not provided", token_budget=1500)
+    assert kept_inclusion == "* Age 18+\n* HbA1c 7-10%"
+    assert stats["items_truncated"] == 0
+
+
+def test_placeholders_pass_through():
+    assert compact_criteria("Not provided", None)[:2] == ("Not provided", None)
+
+
+def test_minify_json():
+    assert minify_json({"a": [1, 2], "b": "é"}) == '{"a":[1,2],"b":"é"}'
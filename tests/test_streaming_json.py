@@ -0,0 +1,50 @@
+import pytest
+
+from streaming_json import IncrementalJSONParser, parse_llm_json
+
+
+def test_plain_object():
+    assert parse_llm_json('{"a": 1, "b": [true, null]}') == ({"a": 1, "b": [True, None]}, [])
+
+
+def test_fenced_object_with_trailing_commas():
+    obj, repairs = parse_llm_json('```json\n{"a": [1, 2,], "b": {"c": "x",},}\n```')
+    assert obj == {"a": [1, 2], "b": {"c": "x"}}
+    assert repairs == ["trailing_comma"]
+
+
+def test_prose_around_the_object_is_ignored():
+    assert parse_llm_json('Here you go: {"a": "b"} Let me know!')[0] == {"a": "b"}
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": {"b": "x', {"a": {"b": "x"}}),
+    ('{"a": [1, 2', {"a": [1, 2]}),
+    ('{"a": tru', {"a": None}),
+    ('{"a": 1.', {"a": 1}),
+    ('{"a": 1, "b', {"a": 1}),
+    ('{"a": 1, "b":', {"a": 1, "b": None}),
+    ('```json\n{"a": [1\n```', {"a": [1]}),
+])
+def test_truncated_output_is_closed(text, expected):
+    obj, repairs = parse_llm_json(text)
+    assert obj == expected
+    assert "truncated" in repairs
+
+
+def test_escaped_quotes_stay_inside_strings():
+    assert parse_llm_json(r'{"a": "say \"hi\", {ok}"}')[0] == {"a": 'say "hi", {ok}'}
+
+
+def test_no_object_raises():
+    with pytest.raises(ValueError):
+        parse_llm_json("I cannot help with that.")
+
+
+def test_feed_returns_members_as_they_close():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"first": {"x": 1}') == []
+    assert parser.feed(', "second": [2') == [("first", {"x": 1})]
+    assert parser.feed("]}") == [("second", [2])]
+    assert parser.done
+    assert parser.finish() == {"first": {"x": 1}, "second": [2]}
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from trial_projection import STUDY_SPEC, extract_trial_fields, parse_projected_study
+
+STUDY = {
+    "protocolSection": {
+        "identificationModule": {"nctId": "NCT01234567", "briefTitle": "A \"quoted\" {title}"},
+        "sponsorCollaboratorsModule": {"leadSponsor": {"name": "Acme"}},
+        "statusModule": {"overallStatus": "RECRUITING"},
+        "conditionsModule": {"conditions": ["Type 2 Diabetes", "Obesity"]},
+        "armsInterventionsModule": {"interventions": [{"type": "DRUG", "name": "Metformin"}, {"type": "BEHAVIORAL", "name": "Diet"}]},
+        "eligibilityModule": {"eligibilityCriteria": "Inclusion Criteria:\n* Adults\n\nExclusion Criteria:\n* Pregnancy", "minimumAge": "18 Years", "sex": "ALL"},
+        "designModule": {"studyType": "INTERVENTIONAL", "phases": ["PHASE2"]},
+    },
+    "resultsSection": {"baselineCharacteristicsModule": {"measures": [[1, 2], {"x": "]}"}]}},
+    "derivedSection": {"conditionBrowseModule": {"meshes": [{"id": "D003924", "term": "Diabetes Mellitus, Type 2"}], "ancestors": [{"term": "Diabetes Mellitus"}]}},
+    "hasResults": True,
+}
+
+
+def project(study):
+    """The reference projection: full json.loads, then keep the STUDY_SPEC members."""
+    return {section: {module: value for module, value in study[section].items() if module in modules and value is not None}
+            for section, modules in STUDY_SPEC.items() if section in study}
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_matches_full_parse(indent):
+    assert parse_projected_study(json.dumps(STUDY, indent=indent)) == project(STUDY)
+
+
+def test_unwanted_sections_dropped():
+    result = parse_projected_study(json.dumps(STUDY))
+    assert set(result) == {"protocolSection", "derivedSection"}
+    assert "sponsorCollaboratorsModule" not in result["protocolSection"]
+
+
+def test_stops_once_everything_wanted_is_read():
+    text = json.dumps({"protocolSection": STUDY["protocolSection"], "derivedSection": STUDY["derivedSection"]})
+    assert parse_projected_study(text[:-1] + ', "documentSection": <not json') == project(STUDY)
+
+
+def test_null_and_missing_modules_left_out():
+    study = {"protocolSection": {"identificationModule": {"nctId": "NCT01234567"}, "statusModule": None}, "derivedSection": None}
+    assert parse_projected_study(json.dumps(study)) == {"protocolSection": {"identificationModule": {"nctId": "NCT01234567"}}}
+
+
+def test_not_an_object_raises():
+    with pytest.raises(ValueError):
+        parse_projected_study("[]")
+
+
+def test_extract_trial_fields():
+    result = parse_projected_study(json.dumps(STUDY))
+    fields = extract_trial_fields(result["protocolSection"], result.get("derivedSection"))
+    assert fields["NCT_ID"] == "NCT01234567"
+    assert fields["Conditions"] == "Type 2 Diabetes, Obesity"
+    assert fields["Drugs"] == "Metformin"
+    assert (fields["Inclusion_Criteria"], fields["Exclusion_Criteria"]) == ("* Adults", "* Pregnancy")
+    assert fields["Maximum_Age"] == "No maximum age specified"
+    assert (fields["MeSH_Terms"], fields["MeSH_Ancestors"]) == (["Diabetes Mellitus, Type 2"], ["Diabetes Mellitus"])
@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from trial_record import TrialRecord
+
+# --- Configuration ---
+TRIAL_CACHE_MAX_ENTRIES = int(os.getenv("TRIAL_CACHE_MAX_ENTRIES", "256"))
+TRIAL_CACHE_TTL_SECONDS = int(os.getenv("TRIAL_CACHE_TTL_SECONDS", "21600"))  # 6 hours
+# How long past its TTL an entry may still be served stale while it is refreshed (or while the upstream is down).
+TRIAL_CACHE_STALE_SECONDS = int(os.getenv("TRIAL_CACHE_STALE_SECONDS", "604800"))  # 7 days
+# Optional SQLite file shared by all gunicorn workers on the host. Unset = memory only.
+TRIAL_CACHE_DB_PATH = os.getenv("TRIAL_CACHE_DB_PATH")
+
+
+class TrialCache:
+    """
+    Cache for processed trials (TrialRecord) keyed by NCT ID.
+    Bounded LRU in memory with a TTL, optionally backed by a SQLite file so
+    that every worker process on the host shares the same fetched trials.
+    The disk store holds version-tagged msgpack records; other versions read as misses.
+    Expired entries are kept for stale_seconds so get_or_stale() can serve them while they refresh;
+    disk rows older than that are pruned on open and then at most once per TTL on write.
+    """
+
+    def __init__(self, max_entries=TRIAL_CACHE_MAX_ENTRIES, ttl_seconds=TRIAL_CACHE_TTL_SECONDS, db_path=TRIAL_CACHE_DB_PATH, stale_seconds=TRIAL_CACHE_STALE_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.db_path = db_path
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pruned_at = 0.0
+        if self.db_path:
+            try:
+                conn = self._connection()
+                conn.execute("CREATE TABLE IF NOT EXISTS trial_records (nct_id TEXT PRIMARY KEY, stored_at REAL NOT NULL, body BLOB NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS trial_records_stored_at ON trial_records (stored_at)")
+            except sqlite3.Error as e: print(f"Trial cache disk store disabled ({self.db_path}): {e}"); self.db_path = None
+            else: self._prune()
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _is_fresh(self, stored_at):
+        return (time.time() - stored_at) < self.ttl_seconds
+
+    def _lookup(self, key):
+        """(stored_at, value) of the newest copy in memory or on disk, fresh or not; None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if self._is_fresh(entry[0]): return entry
+        if not self.db_path: return entry
+        # Expired in memory: another worker may have refreshed the disk copy.
+        try: row = self._connection().execute("SELECT stored_at, body FROM trial_records WHERE nct_id = ?", (key,)).fetchone()
+        except sqlite3.Error as e: print(f"Trial cache read error {key}: {e}"); return entry
+        if not row or (entry is not None and row[0] <= entry[0]): return entry
+        try: value = TrialRecord.from_bytes(row[1])
+        except (ValueError, TypeError) as e: print(f"Trial cache discarding unreadable record {key}: {e}"); return entry
+        self._remember(key, value, row[0])
+        return row[0], value
+
+    def get(self, key):
+        """Returns the cached TrialRecord for key, or None on a miss or expired entry."""
+        entry = self._lookup(key)
+        return entry[1] if entry is not None and self._is_fresh(entry[0]) else None
+
+    def get_or_stale(self, key):
+        """
+        (record, stale) for stale-while-revalidate: a fresh record with stale=False, an expired one
+        still within stale_seconds past its TTL with stale=True, or (None, False).
+        """
+        entry = self._lookup(key)
+        if entry is None: return None, False
+        if self._is_fresh(entry[0]): return entry[1], False
+        if time.time() - entry[0] < self.ttl_seconds + self.stale_seconds: return entry[1], True
+        return None, False
+
+    def set(self, key, value):
+        stored_at = time.time()
+        self._remember(key, value, stored_at)
+        if not self.db_path: return
+        try: self._connection().execute("INSERT OR REPLACE INTO trial_records (nct_id, stored_at, body) VALUES (?, ?, ?)", (key, stored_at, value.to_bytes()))
+        except sqlite3.Error as e: print(f"Trial cache write error {key}: {e}")
+        if stored_at - self._pruned_at >= self.ttl_seconds: self._prune()
+
+    def _prune(self):
+        """Deletes disk rows too old for get_or_stale() to serve."""
+        self._pruned_at = now = time.time()
+        try: deleted = self._connection().execute("DELETE FROM trial_records WHERE stored_at < ?", (now - self.ttl_seconds - self.stale_seconds,)).rowcount
+        except sqlite3.Error as e: print(f"Trial cache prune error: {e}"); return
+        if deleted: print(f"Trial cache pruned {deleted} expired records")
+
+    def invalidate(self, key):
+        with self._lock: self._entries.pop(key, None)
+        if not self.db_path: return
+        try: self._connection().execute("DELETE FROM trial_records WHERE nct_id = ?", (key,))
+        except sqlite3.Error as e: print(f"Trial cache delete error {key}: {e}")
+
+    def _remember(self, key, value, stored_at):
+        with self._lock:
+            self._entries[key] = (stored_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+trial_cache = TrialCache()
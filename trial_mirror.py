@@ -0,0 +1,161 @@
+import argparse
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+import zlib
+
+from trial_projection import STUDY_SPEC, parse_projected_study
+
+# --- Configuration ---
+# SQLite file holding the local ClinicalTrials.gov mirror. Unset = mirror disabled (live API only).
+TRIAL_MIRROR_DB_PATH = os.getenv("TRIAL_MIRROR_DB_PATH")
+INGEST_BATCH_SIZE = 500
+READ_CHUNK_SIZE = 1 << 20
+
+
+def _last_update(study):
+    status_mod = study.get("protocolSection", {}).get("statusModule", {})
+    return (status_mod.get("lastUpdatePostDateStruct") or {}).get("date") or ""
+
+
+def _nct_id(study):
+    return study.get("protocolSection", {}).get("identificationModule", {}).get("nctId")
+
+
+def _iter_json_values(stream):
+    """
+    Yields the studies in a JSON text stream without loading the whole file: either a single
+    study object, or each element of a top-level array, decoded one at a time.
+    """
+    decoder = json.JSONDecoder(); buffer = ""; eof = False; in_array = None
+    while True:
+        buffer = buffer.lstrip(" \t\r\n," if in_array else " \t\r\n")
+        if in_array is None and buffer:
+            in_array = buffer[0] == "["
+            if in_array: buffer = buffer[1:]; continue
+        if in_array and buffer.startswith("]"): return
+        if buffer:
+            try:
+                value, end = decoder.raw_decode(buffer)
+                yield value; buffer = buffer[end:]
+                if not in_array: return
+                continue
+            except json.JSONDecodeError:
+                if eof: raise
+                # Value continues past the buffered text; read more and retry.
+        elif eof: return
+        chunk = stream.read(READ_CHUNK_SIZE)
+        if chunk: buffer += chunk
+        else: eof = True
+
+
+class TrialMirror:
+    """
+    Local, indexed copy of ClinicalTrials.gov study records keyed by NCT ID.
+    Records are stored zlib-compressed; each keeps the source member CRC and the study's
+    lastUpdatePostDate so re-ingesting a newer export only rewrites changed studies.
+    """
+
+    def __init__(self, db_path=TRIAL_MIRROR_DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return bool(self.db_path) and os.path.exists(self.db_path)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS studies (nct_id TEXT PRIMARY KEY, last_update TEXT NOT NULL, source_crc INTEGER, ingested_at REAL NOT NULL, body BLOB NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, nct_id, spec=STUDY_SPEC):
+        """
+        Returns the stored study document projected to spec (None = the full record), or None
+        when missing, unreadable or the mirror is disabled. Unprojected subtrees are dropped while parsing.
+        """
+        if not self.enabled: return None
+        try: row = self._connection().execute("SELECT body FROM studies WHERE nct_id = ?", (nct_id,)).fetchone()
+        except sqlite3.Error as e: print(f"Trial mirror read error {nct_id}: {e}"); return None
+        if not row: return None
+        try:
+            text = zlib.decompress(row[0]).decode("utf-8")
+            return json.loads(text) if spec is None else parse_projected_study(text, spec)
+        except (zlib.error, ValueError, IndexError) as e: print(f"Trial mirror record unreadable {nct_id}: {e}"); return None
+
+    def contains(self, nct_id):
+        if not self.enabled: return False
+        try: return self._connection().execute("SELECT 1 FROM studies WHERE nct_id = ?", (nct_id,)).fetchone() is not None
+        except sqlite3.Error: return False
+
+    def count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM studies").fetchone()[0]
+
+    def ingest_archive(self, zip_path, progress_every=10000):
+        """
+        Streams a ClinicalTrials.gov studies export (zip of per-study JSON files, or of JSON
+        arrays) into the mirror. Unchanged studies are skipped. Returns a stats dict.
+        """
+        conn = self._connection()
+        known = {}
+        for nct_id, last_update, source_crc in conn.execute("SELECT nct_id, last_update, source_crc FROM studies"):
+            known[nct_id] = (last_update, source_crc)
+        stats = {"seen": 0, "written": 0, "skipped": 0, "errors": 0}
+        pending = []; start_time = time.time()
+
+        def flush():
+            if not pending: return
+            with conn: conn.executemany("INSERT OR REPLACE INTO studies (nct_id, last_update, source_crc, ingested_at, body) VALUES (?, ?, ?, ?, ?)", pending)
+            pending.clear()
+
+        with zipfile.ZipFile(zip_path) as archive:
+            for member in archive.infolist():
+                if member.is_dir() or not member.filename.lower().endswith(".json"): continue
+                # Per-study members are named NCTxxxxxxxx.json; an identical CRC means nothing changed.
+                member_nct_id = os.path.splitext(os.path.basename(member.filename))[0].upper()
+                if member_nct_id in known and known[member_nct_id][1] == member.CRC:
+                    stats["seen"] += 1; stats["skipped"] += 1; continue
+                try:
+                    with archive.open(member) as raw, io.TextIOWrapper(raw, encoding="utf-8") as stream:
+                        for study in _iter_json_values(stream):
+                            stats["seen"] += 1
+                            nct_id = _nct_id(study) if isinstance(study, dict) else None
+                            if not nct_id: stats["errors"] += 1; continue
+                            last_update = _last_update(study)
+                            if nct_id in known and known[nct_id][0] and known[nct_id][0] >= last_update: stats["skipped"] += 1; continue
+                            crc = member.CRC if nct_id == member_nct_id else None
+                            pending.append((nct_id, last_update, crc, time.time(), zlib.compress(json.dumps(study, separators=(",", ":")).encode("utf-8"))))
+                            known[nct_id] = (last_update, crc); stats["written"] += 1
+                            if len(pending) >= INGEST_BATCH_SIZE: flush()
+                            if progress_every and stats["seen"] % progress_every == 0: print(f"Mirror ingest: {stats} ({time.time() - start_time:.0f}s)")
+                except (json.JSONDecodeError, UnicodeDecodeError, zipfile.BadZipFile) as e:
+                    print(f"Mirror ingest error in {member.filename}: {e}"); stats["errors"] += 1
+        flush()
+        stats["duration_seconds"] = round(time.time() - start_time, 2)
+        return stats
+
+
+trial_mirror = TrialMirror()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local ClinicalTrials.gov mirror.")
+    parser.add_argument("--db", default=TRIAL_MIRROR_DB_PATH, help="Mirror SQLite path (default: $TRIAL_MIRROR_DB_PATH)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = subparsers.add_parser("ingest", help="Ingest or re-ingest a studies JSON zip export")
+    ingest_parser.add_argument("zip_path")
+    subparsers.add_parser("stats", help="Print the number of mirrored studies")
+    args = parser.parse_args()
+    if not args.db: parser.error("--db or TRIAL_MIRROR_DB_PATH is required")
+
+    mirror = TrialMirror(args.db)
+    if args.command == "ingest": print(mirror.ingest_archive(args.zip_path))
+    print(f"{mirror.count()} studies in {args.db}")
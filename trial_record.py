@@ -0,0 +1,63 @@
+from dataclasses import dataclass, fields
+
+import msgpack
+
+# Bump whenever fields are added, removed or reordered; records with another tag are treated as cache misses.
+RECORD_FORMAT_VERSION = 2  # v2: MeSH terms and ancestors
+
+# process_trial_data() keys, in TrialRecord field order.
+PROCESSED_KEYS = ('NCT_ID', 'Brief_Title', 'Official_Title', 'Status', 'Conditions', 'Interventions', 'Intervention_Types', 'Minimum_Age', 'Maximum_Age', 'Sex', 'Inclusion_Criteria', 'Exclusion_Criteria', 'Drugs', 'Phase', 'Study_Type', 'MeSH_Terms', 'MeSH_Ancestors')
+
+
+@dataclass(slots=True)
+class TrialRecord:
+    """
+    Processed trial in a compact, typed form: the same fields as the process_trial_data() dict,
+    without a per-instance __dict__ or key strings. Serializes to a version-tagged msgpack array.
+    """
+    nct_id: str = None
+    brief_title: str = None
+    official_title: str = None
+    status: str = None
+    conditions: str = None
+    interventions: str = None
+    intervention_types: tuple = ()
+    minimum_age: str = None
+    maximum_age: str = None
+    sex: str = None
+    inclusion_criteria: str = None
+    exclusion_criteria: str = None
+    drugs: str = None
+    phase: str = None
+    study_type: str = None
+    mesh_terms: tuple = ()
+    mesh_ancestors: tuple = ()
+
+    @classmethod
+    def from_processed(cls, processed_data):
+        """Builds a record from a process_trial_data()-style dict (NCT_ID, Brief_Title, ...)."""
+        record = cls(*(processed_data.get(key) for key in PROCESSED_KEYS))
+        record.intervention_types = tuple(record.intervention_types or ()); record.mesh_terms = tuple(record.mesh_terms or ()); record.mesh_ancestors = tuple(record.mesh_ancestors or ())
+        return record
+
+    def to_processed(self):
+        """The process_trial_data()-style dict, as sent to clients and prompt builders."""
+        processed_data = dict(zip(PROCESSED_KEYS, self._values()))
+        processed_data['Intervention_Types'] = list(self.intervention_types); processed_data['MeSH_Terms'] = list(self.mesh_terms); processed_data['MeSH_Ancestors'] = list(self.mesh_ancestors)
+        return processed_data
+
+    def to_bytes(self):
+        return msgpack.packb([RECORD_FORMAT_VERSION, *self._values()], use_bin_type=True)
+
+    def _values(self):
+        return [getattr(self, name) for name in _FIELD_NAMES]
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Inverse of to_bytes(). Raises ValueError for payloads written by another format version."""
+        values = msgpack.unpackb(data, raw=False, use_list=False)
+        if not values or values[0] != RECORD_FORMAT_VERSION: raise ValueError(f"Unsupported TrialRecord format: {values[:1]}")
+        return cls(*values[1:])
+
+
+_FIELD_NAMES = tuple(field.name for field in fields(TrialRecord))